@@ -1,19 +1,30 @@
-from datasette import hookimpl, Forbidden
+from datasette import hookimpl, Forbidden, Response
 from datasette.permissions import Action
-import itsdangerous
+from collections import namedtuple
+import asyncio
 import json
+import math
 import secrets
-import sqlite_utils
+import sqlite3
 import time
-from markupsafe import Markup
-from .views import (
-    create_api_token,
-    check_permission,
-    tokens_index,
-    token_details,
-    Config,
-)
-from .migrations import migration
+from .config import Config
+from .events import get_event_log
+from .index import get_token_index, tokens_changed
+from .metrics import get_metrics
+from .ratelimit import get_rate_limiter, TokenRateLimited
+from .schema import migrate, pending_migrations
+from .timing import annotate, current_timing, stage
+from .utils import instance_state, run_in_background, LRUDict
+
+# How many tokens to remember last_used_timestamp writes for
+TOUCHED_MAX_SIZE = 10_000
+# Last-known-good cache used when lookups exceed lookup_timeout_ms
+DEFAULT_STALE_SECONDS = 60
+DEFAULT_STALE_CACHE_SIZE = 10_000
+
+# Result of looking up a managed token - actor is None if it is not active
+Lookup = namedtuple("Lookup", ("actor", "expires_at", "rate_limit"))
+INACTIVE = Lookup(None, None, None)
 
 TOKEN_STATUSES = {
     "A": "Active",
@@ -22,6 +33,10 @@ TOKEN_STATUSES = {
 }
 
 
+# Modules only needed when managed tokens are in use are imported inside the
+# functions that use them, to keep the cost of importing the plugin down
+
+
 @hookimpl
 def table_actions(datasette, actor, database, table):
     if actor and table == "_datasette_auth_tokens":
@@ -30,10 +45,12 @@ def table_actions(datasette, actor, database, table):
 
 @hookimpl
 def menu_links(datasette, actor):
-    if not actor:
+    if not actor or not Config(datasette).enabled:
         return
 
     async def inner():
+        from .views import check_permission
+
         try:
             await check_permission(datasette, actor)
         except Forbidden:
@@ -54,14 +71,36 @@ def startup(datasette):
     if not config.enabled:
         return
 
-    db = config.db
-
     async def inner():
-        def migrate(conn):
-            db = sqlite_utils.Database(conn)
-            migration.apply(db)
+        from .backfill import backfills, run_backfills
+        from .storage import get_storage
+
+        # Fails early if the storage settings are not valid
+        get_storage(datasette)
+
+        async def migrate_shard(db):
+            # Only queue for the write connection if a migration is pending
+            if await db.execute_fn(pending_migrations):
+                await db.execute_write_fn(migrate)
+
+        await asyncio.gather(*(migrate_shard(db) for db in config.shards))
+        if backfills:
+            run_in_background(run_backfills(datasette))
+
+        if config.get("memory_index"):
+            await get_token_index(datasette).refresh()
+        if config.get("snapshot_path"):
+            from .snapshot import get_snapshot_writer
+
+            await get_snapshot_writer(datasette).export()
+        if config.get("archive_after_days"):
+            from .archive import run_archiver
 
-        await db.execute_write_fn(migrate)
+            run_in_background(run_archiver(datasette))
+        if config.get("usage_sketches"):
+            from .usage import run_usage_persister
+
+            run_in_background(run_usage_persister(datasette))
 
     return inner
 
@@ -69,15 +108,115 @@ def startup(datasette):
 @hookimpl
 def register_routes(datasette):
     config = Config(datasette)
+    routes = []
+    if config.get("slow_auth_ms") is not None:
+        # Also available for hard-coded and query tokens
+        from .views import slow_authentications
+
+        routes.append((r"^/-/api/tokens/slow$", slow_authentications))
     if not config.enabled:
-        return
-    return [
+        return routes
+    from .views import (
+        create_api_token,
+        tokens_index,
+        token_details,
+        token_events,
+        token_metrics,
+        token_backfills,
+        token_introspect,
+        create_child_token,
+    )
+
+    if config.get("usage_sketches"):
+        from .views import top_tokens
+
+        routes.append((r"^/-/api/tokens/top$", top_tokens))
+    return routes + [
         (r"^/-/api/tokens/create$", create_api_token),
-        (r"^/-/api/tokens$", tokens_index),
-        (r"^/-/api/tokens/(?P<id>\d+)$", token_details),
+        (r"^/-/api/tokens(\.(?P<format>json))?$", tokens_index),
+        (r"^/-/api/tokens/events$", token_events),
+        (r"^/-/api/tokens/metrics$", token_metrics),
+        (r"^/-/api/tokens/backfills$", token_backfills),
+        (r"^/-/api/tokens/introspect$", token_introspect),
+        (r"^/-/api/tokens/child$", create_child_token),
+        (r"^/-/api/tokens/(?P<id>\d+)(\.(?P<format>json))?$", token_details),
     ]
 
 
+@hookimpl
+def asgi_wrapper(datasette):
+    config = Config(datasette)
+    server_timing = config.get("server_timing")
+    if not config.enabled and not server_timing:
+        return None
+
+    def wrap(app):
+        if config.enabled:
+            app = _wrap_with_rate_limits(app)
+        if server_timing:
+            # Outermost, so 429 responses are timed too
+            app = _wrap_with_server_timing(app)
+        return app
+
+    return wrap
+
+
+def _wrap_with_rate_limits(app):
+    async def rate_limited_app(scope, receive, send):
+        try:
+            await app(scope, receive, send)
+        except TokenRateLimited as ex:
+            # Raised by actor_from_request, before any response has started
+            headers = {"Retry-After": str(math.ceil(ex.retry_after))}
+            message = "Too many requests for this API token"
+            if scope.get("path", "").endswith(".json"):
+                response = Response.json(
+                    {"ok": False, "error": message, "status": 429},
+                    status=429,
+                    headers=headers,
+                )
+            else:
+                response = Response.text(message, status=429, headers=headers)
+            await response.asgi_send(send)
+
+    return rate_limited_app
+
+
+def _wrap_with_server_timing(app):
+    from .timing import server_timing_header, start_timing, stop_timing
+
+    async def timed_app(scope, receive, send):
+        if scope["type"] != "http":
+            return await app(scope, receive, send)
+        timing, reset_token = start_timing()
+
+        async def timed_send(message):
+            # Only requests that presented a token were timed
+            if message["type"] == "http.response.start" and timing.backend:
+                message = dict(
+                    message,
+                    headers=[
+                        *message.get("headers", []),
+                        (b"server-timing", server_timing_header(timing).encode()),
+                    ],
+                )
+            await send(message)
+
+        try:
+            await app(scope, receive, timed_send)
+        finally:
+            stop_timing(reset_token)
+
+    return timed_app
+
+
+@hookimpl
+def register_commands(cli):
+    from .cli import auth_tokens
+
+    cli.add_command(auth_tokens)
+
+
 @hookimpl
 def register_actions(datasette):
     return [
@@ -96,14 +235,25 @@ def register_actions(datasette):
             abbr=None,
             description="Create API tokens",
         ),
+        Action(
+            name="auth-tokens-introspect",
+            abbr=None,
+            description="Check whether API tokens are valid",
+        ),
     ]
 
 
+@hookimpl
+def skip_csrf(datasette, scope):
+    # Introspection is called by other services using a JSON body
+    if Config(datasette).enabled and scope["path"] == "/-/api/tokens/introspect":
+        return True
+
+
 @hookimpl
 def actor_from_request(datasette, request):
     async def inner():
         config = Config(datasette)
-        allowed_tokens = config.get("tokens") or []
         query_param = config.get("param")
         authorization = request.headers.get("authorization")
         if authorization:
@@ -119,89 +269,368 @@ def actor_from_request(datasette, request):
         else:
             return None
 
-        if config.enabled:
-            return await _actor_from_managed(datasette, incoming_token)
+        if config.get("slow_auth_ms") is not None:
+            from .slowlog import get_slow_auth_log
+
+            actor = await get_slow_auth_log(datasette).observe(
+                _authenticate(datasette, config, incoming_token)
+            )
+        else:
+            timing = current_timing()
+            if timing is None:
+                actor = await _authenticate(datasette, config, incoming_token)
+            else:
+                # Started by the Server-Timing wrapper
+                start = time.perf_counter()
+                try:
+                    actor = await _authenticate(datasette, config, incoming_token)
+                finally:
+                    timing.total = time.perf_counter() - start
+        if actor and config.enabled and config.get("usage_sketches"):
+            # Child tokens count towards their parent
+            from .usage import get_usage_sketches
+
+            client = request.scope.get("client")
+            get_usage_sketches(datasette).observe(
+                actor["token_id"], client[0] if client else None
+            )
+        return actor
 
-        # First try hard-coded tokens in the list
-        for token in allowed_tokens:
+    return inner
+
+
+async def _authenticate(datasette, config, incoming_token):
+    if config.enabled:
+        annotate(backend="manage_tokens")
+        return await _actor_from_managed(datasette, incoming_token)
+
+    # First try hard-coded tokens in the list
+    annotate(backend="tokens")
+    with stage("compare"):
+        for token in config.get("tokens") or []:
             if secrets.compare_digest(token["token"], incoming_token):
                 return token["actor"]
-        # Now try the SQL query, if present
-        query = config.get("query")
-        if query:
-            if "-" not in incoming_token:
-                # Invalid token
-                return None
-            token_id, token_secret = incoming_token.split("-", 2)
-            sql = query["sql"]
-            database = query.get("database")
-            db = datasette.get_database(database)
+    # Now try the SQL query, if present
+    query = config.get("query")
+    if query:
+        annotate(backend="query")
+        if "-" not in incoming_token:
+            # Invalid token
+            return None
+        token_id, token_secret = incoming_token.split("-", 2)
+        annotate(token_id=token_id)
+        sql = query["sql"]
+        database = query.get("database")
+        db = datasette.get_database(database)
+        with stage("read", database=True):
             results = await db.execute(sql, {"token_id": token_id})
-            if not results:
-                return None
-            row = results.first()
-            assert (
-                "token_secret" in row.keys()
-            ), "Returned row must contain a token_secret"
-            if secrets.compare_digest(row["token_secret"], token_secret):
-                # Set actor based on actor_* columns
-                return {
-                    k.replace("actor_", ""): row[k]
-                    for k in row.keys()
-                    if k.startswith("actor_")
-                }
-
-    return inner
+        if not results:
+            return None
+        row = results.first()
+        assert "token_secret" in row.keys(), "Returned row must contain a token_secret"
+        if secrets.compare_digest(row["token_secret"], token_secret):
+            # Set actor based on actor_* columns
+            return {
+                k.replace("actor_", ""): row[k]
+                for k in row.keys()
+                if k.startswith("actor_")
+            }
 
 
 async def _actor_from_managed(datasette, incoming_token):
-    config = Config(datasette)
-    db = config.db
+    import itsdangerous
+
+    if incoming_token.startswith("dsatokc_"):
+        return await _actor_from_child(datasette, incoming_token)
     if not incoming_token.startswith("dsatok_"):
         return None
     incoming_token = incoming_token[len("dsatok_") :]
     try:
-        token_id = datasette.unsign(incoming_token, "dsatok")
+        with stage("unsign"):
+            token_id = datasette.unsign(incoming_token, "dsatok")
     except itsdangerous.BadSignature:
         return None
+    annotate(token_id=token_id)
+
+    lookup = await _shared_lookup(datasette, token_id)
+    if lookup.actor is None:
+        return None
+    if lookup.rate_limit:
+        with stage("rate_limit"):
+            get_rate_limiter(datasette).check(token_id, lookup.rate_limit)
+    return dict(lookup.actor)
 
-    # Potentially expire token first
-    await db.execute_write_fn(make_expire_function(token_id))
 
-    results = await db.execute(
-        "select * from _datasette_auth_tokens where id=:token_id",
-        {"token_id": token_id},
+async def _actor_from_child(datasette, incoming_token):
+    from .children import (
+        unsign_child_token,
+        get_parent_statuses,
+        DEFAULT_PARENT_CACHE_SECONDS,
     )
-    row = results.first()
-    if not row:
+
+    with stage("unsign"):
+        child = unsign_child_token(datasette, incoming_token)
+    if child is None or child["e"] < time.time():
         return None
+    parent_id = child["t"]
+    annotate(token_id=parent_id)
+    # Only the parent's status is checked, and only every few seconds
+    parent_statuses = get_parent_statuses(datasette)
+    cache_seconds = Config(datasette).get("child_parent_cache_seconds")
+    if cache_seconds is None:
+        cache_seconds = DEFAULT_PARENT_CACHE_SECONDS
+    cached = parent_statuses.get(parent_id)
+    if cached is not None and time.monotonic() - cached[1] <= cache_seconds:
+        annotate(cache="hit")
+        lookup = cached[0]
+    else:
+        lookup = await _shared_lookup(datasette, parent_id)
+        parent_statuses[parent_id] = (lookup, time.monotonic())
+    if lookup.actor is None or (
+        lookup.expires_at is not None and lookup.expires_at < time.time()
+    ):
+        return None
+    if lookup.rate_limit:
+        # Children share their parent's rate limit
+        with stage("rate_limit"):
+            get_rate_limiter(datasette).check(parent_id, lookup.rate_limit)
+    return _child_actor(parent_id, lookup.actor["id"], child)
+
+
+def _child_actor(parent_id, actor_id, child):
+    actor = _token_actor(parent_id, actor_id, child.get("_r"))
+    if "_r" in child:
+        # _token_actor drops empty restrictions, which here mean "nothing"
+        actor["_r"] = child["_r"]
+    actor["token"] = "dsatok_child"
+    return actor
+
+
+async def _shared_lookup(datasette, token_id):
+    config = Config(datasette)
+    # Concurrent requests for the same token share a single lookup
+    in_flight = instance_state(datasette, "in_flight", dict)
+    future = in_flight.get(token_id)
+    if future is None:
+        future = asyncio.ensure_future(_lookup_managed(datasette, token_id))
+        in_flight[token_id] = future
+        future.add_done_callback(lambda _: in_flight.pop(token_id, None))
+        if config.get("lookup_timeout_ms"):
+            future.add_done_callback(
+                lambda future: _remember_lookup(datasette, token_id, future)
+            )
+
+    # shield() so one cancelled request does not cancel it for everyone else
+    timeout_ms = config.get("lookup_timeout_ms")
+    if timeout_ms:
+        try:
+            lookup = await asyncio.wait_for(asyncio.shield(future), timeout_ms / 1000)
+        except asyncio.TimeoutError:
+            lookup = _stale_lookup(datasette, token_id)
+            if lookup is None:
+                # Nothing usable cached, so keep waiting for the lookup
+                lookup = await asyncio.shield(future)
+    else:
+        lookup = await asyncio.shield(future)
+    return lookup
+
+
+def _remember_lookup(datasette, token_id, future):
+    # Maintains the last-known-good cache used when lookups time out
+    if future.cancelled() or future.exception() is not None:
+        return
+    last_known_good = get_last_known_good(datasette)
+    lookup = future.result()
+    if lookup.actor is None:
+        # Revoked, expired or deleted - never serve this token stale
+        last_known_good.pop(token_id, None)
+    else:
+        last_known_good[token_id] = (lookup, time.monotonic())
+
+
+def _stale_lookup(datasette, token_id):
+    metrics = get_metrics(datasette)
+    metrics["lookup_timeouts"] += 1
+    cached = get_last_known_good(datasette).get(token_id)
+    if cached is not None:
+        lookup, validated_at = cached
+        stale_seconds = Config(datasette).get("stale_seconds") or DEFAULT_STALE_SECONDS
+        if time.monotonic() - validated_at <= stale_seconds and (
+            lookup.expires_at is None or lookup.expires_at >= time.time()
+        ):
+            # The lookup carries on in the background and refreshes the cache
+            metrics["stale_served"] += 1
+            annotate(cache="stale")
+            return lookup
+    metrics["stale_unavailable"] += 1
+    return None
+
+
+def get_last_known_good(datasette):
+    return instance_state(
+        datasette,
+        "last_known_good",
+        lambda: LRUDict(
+            Config(datasette).get("stale_cache_size") or DEFAULT_STALE_CACHE_SIZE
+        ),
+    )
 
-    actor = {
-        "id": row["actor_id"],
-        "token": "dsatok",
-        "token_id": row["id"],
-    }
-    permissions = json.loads(row["permissions"])
-    if permissions:
-        actor["_r"] = permissions
+
+def forget_token(datasette, token_id):
+    # Call when this process revokes a token
+    from .children import get_parent_statuses
+
+    get_last_known_good(datasette).pop(token_id, None)
+    get_parent_statuses(datasette).pop(token_id, None)
+
+
+async def _lookup_managed(datasette, token_id):
+    config = Config(datasette)
+    if config.get("snapshot_path"):
+        from .snapshot import get_snapshot_reader, get_snapshot_writer
+
+        with stage("snapshot"):
+            if token_id in get_snapshot_writer(datasette).ended:
+                # Ended here but possibly still in the mapped snapshot
+                return INACTIVE
+            snapshot = get_snapshot_reader(datasette).current()
+            # Tokens newer than the snapshot fall through to the database
+            if snapshot is not None and snapshot.covers(token_id):
+                annotate(cache="hit")
+                return _actor_from_snapshot(datasette, snapshot, token_id)
+        annotate(cache="miss")
+    elif config.get("memory_index"):
+        return await _actor_from_index(datasette, token_id)
+
+    from .storage import get_storage
+
+    storage = get_storage(datasette)
+    if config.replicas is None:
+        # Potentially expire token first
+        with stage("expire", database=True):
+            expired = await storage.expire(token_id)
+        if expired:
+            record_expired(datasette, [token_id])
+            return INACTIVE
+
+    with stage("read", database=True):
+        row = await storage.lookup(token_id)
+    if not row:
+        return INACTIVE
+
+    actor = _token_actor(row["id"], row["actor_id"], json.loads(row["permissions"]))
 
     # Is token revoked?
     if row["token_status"] == "R":
-        return None
+        return INACTIVE
 
     # Expired?
     if row["token_status"] == "E":
-        return None
+        return INACTIVE
+
+    expires_at = None
+    if row["expires_after_seconds"]:
+        expires_at = row["created_timestamp"] + row["expires_after_seconds"]
+        if expires_at < time.time():
+            # Normally only reachable when reading from a replica, which is
+            # never written to - record the expiry on the primary instead
+            run_in_background(_expire_token(datasette, token_id))
+            return INACTIVE
+
+    if row["last_used_timestamp"] is None:
+        get_event_log(datasette).record("first_use", row["id"])
 
     # Update last_used_timestamp if more than 60 seconds old
     if row["last_used_timestamp"] is None or (
         row["last_used_timestamp"] < (time.time() - 60)
     ):
-        await db.execute_write(
+        with stage("touch", database=True):
+            await storage.touch(token_id, int(time.time()))
+
+    return Lookup(actor, expires_at, row["rate_limit_per_minute"])
+
+
+async def _expire_token(datasette, token_id):
+    from .storage import get_storage
+
+    expired = await get_storage(datasette).expire(token_id)
+    record_expired(datasette, [record["id"] for record in expired])
+
+
+async def _actor_from_index(datasette, token_id):
+    # Resolves the token entirely from memory - the only database work is
+    # the occasional incremental refresh of the index
+    record = await get_token_index(datasette).get(token_id)
+    if record is None or record.is_expired():
+        return INACTIVE
+    now = int(time.time())
+    if record.last_used_timestamp is None:
+        get_event_log(datasette).record("first_use", record.id)
+    if record.last_used_timestamp is None or record.last_used_timestamp < now - 60:
+        record.last_used_timestamp = now
+        # Don't make the request wait for the bookkeeping write
+        run_in_background(
+            Config(datasette)
+            .shard_for_token(record.id)
+            .execute_write(
+                "update _datasette_auth_tokens set last_used_timestamp=:now where id=:token_id",
+                {"now": now, "token_id": record.id},
+            )
+        )
+    return Lookup(
+        _token_actor(record.id, record.actor_id, record.permissions),
+        record.expires_at,
+        record.rate_limit,
+    )
+
+
+def _actor_from_snapshot(datasette, snapshot, token_id):
+    found = snapshot.lookup(token_id)
+    if found is None:
+        return INACTIVE
+    actor_id, permissions, deadline, rate_limit = found
+    if deadline is not None and deadline < time.time():
+        return INACTIVE
+    touched = get_touched(datasette)
+    now = int(time.time())
+    if touched.get(token_id, 0) < now - 60:
+        touched[token_id] = now
+        run_in_background(_touch(datasette, token_id, now))
+    return Lookup(_token_actor(token_id, actor_id, permissions), deadline, rate_limit)
+
+
+def get_touched(datasette):
+    # Tracks when this process last updated last_used_timestamp per token
+    return instance_state(datasette, "touched", lambda: LRUDict(TOUCHED_MAX_SIZE))
+
+
+async def _touch(datasette, token_id, now):
+    def touch(conn):
+        row = conn.execute(
+            "select last_used_timestamp from _datasette_auth_tokens where id = :token_id",
+            {"token_id": token_id},
+        ).fetchone()
+        if row is None or (row[0] is not None and row[0] >= now - 60):
+            # Another process got there first
+            return False
+        conn.execute(
             "update _datasette_auth_tokens set last_used_timestamp=:now where id=:token_id",
-            {"now": int(time.time()), "token_id": token_id},
+            {"now": now, "token_id": token_id},
         )
+        return row[0] is None
+
+    if await Config(datasette).shard_for_token(token_id).execute_write_fn(touch):
+        get_event_log(datasette).record("first_use", token_id)
 
+
+def _token_actor(token_id, actor_id, permissions):
+    actor = {
+        "id": actor_id,
+        "token": "dsatok",
+        "token_id": token_id,
+    }
+    if permissions:
+        actor["_r"] = permissions
     return actor
 
 
@@ -216,19 +645,119 @@ def make_expire_function(token_id=None):
 
     def expire_tokens(conn):
         # Expire all tokens that are due to expire - or just specified token
-        with conn:
-            conn.execute(
-                """
-                update _datasette_auth_tokens
-                set token_status = 'E', ended_timestamp = :now
-                where {where}
-            """.format(where=" and ".join(where_bits)),
-                {"now": int(time.time()), "token_id": token_id},
+        # Returns the updated rows of the tokens that were expired
+        params = {"now": int(time.time()), "token_id": token_id}
+        return [
+            dict(row)
+            for row in update_tokens(
+                conn,
+                "token_status = 'E', ended_timestamp = :now",
+                " and ".join(where_bits),
+                params,
+                returning="*",
             )
+        ]
 
     return expire_tokens
 
 
+def update_tokens(conn, set_clause, where, params, returning="id"):
+    """
+    Runs an update against the tokens table, returning the requested columns
+    of the updated rows. This is a single UPDATE ... RETURNING statement on
+    SQLite 3.35 and higher.
+    """
+    with conn:
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            return conn.execute(
+                "update _datasette_auth_tokens set {} where {} returning {}".format(
+                    set_clause, where, returning
+                ),
+                params,
+            ).fetchall()
+        rows = conn.execute(
+            "select id from _datasette_auth_tokens where {}".format(where), params
+        ).fetchall()
+        if not rows:
+            return []
+        conn.execute(
+            "update _datasette_auth_tokens set {} where {}".format(set_clause, where),
+            params,
+        )
+        return conn.execute(
+            "select {} from _datasette_auth_tokens where id in ({})".format(
+                returning, ", ".join(str(row[0]) for row in rows)
+            )
+        ).fetchall()
+
+
+async def expire_tokens(datasette):
+    "Expire every token that is due, across all shards"
+    from .storage import get_storage
+
+    expired = await get_storage(datasette).expire()
+    record_expired(datasette, [record["id"] for record in expired])
+
+
+def make_revoke_function(actor_id=None, token_ids=None):
+    where_bits = ["token_status = 'A'"]
+    params = {}
+    if actor_id is not None:
+        where_bits.append("actor_id = :actor_id")
+        params["actor_id"] = actor_id
+    if token_ids is not None:
+        params.update({"id{}".format(i): id for i, id in enumerate(token_ids)})
+        where_bits.append(
+            "id in ({})".format(
+                ", ".join(":id{}".format(i) for i in range(len(token_ids)))
+            )
+        )
+    where = " and ".join(where_bits)
+
+    def revoke(conn):
+        return [
+            dict(row)
+            for row in update_tokens(
+                conn,
+                "token_status = 'R', ended_timestamp = :now",
+                where,
+                dict(params, now=int(time.time())),
+                returning="*",
+            )
+        ]
+
+    return revoke
+
+
+async def revoke_tokens(datasette, actor_id=None, token_ids=None, revoked_by=None):
+    "Revoke the active tokens matching every filter given, returning their IDs"
+    from .storage import get_storage
+
+    revoked = await get_storage(datasette).revoke(actor_id, token_ids)
+    revoked_ids = [record["id"] for record in revoked]
+    record_revoked(datasette, revoked_ids, revoked_by)
+    return revoked_ids
+
+
+def record_revoked(datasette, revoked_ids, revoked_by=None):
+    if not revoked_ids:
+        return
+    event_log = get_event_log(datasette)
+    for token_id in revoked_ids:
+        event_log.record("revoke", token_id, actor_id=revoked_by)
+        forget_token(datasette, token_id)
+    tokens_changed(datasette, revoked_ids)
+
+
+def record_expired(datasette, expired_ids):
+    if not expired_ids:
+        return
+    event_log = get_event_log(datasette)
+    for expired_id in expired_ids:
+        event_log.record("expire", expired_id)
+    tokens_changed(datasette, expired_ids)
+
+
 @hookimpl
 def render_cell(value, column, table, row):
     if table != "_datasette_auth_tokens":
@@ -237,6 +766,8 @@ def render_cell(value, column, table, row):
         return value and time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(value))
     if column != "token_status":
         return None
+    from markupsafe import Markup
+
     return Markup(
         ('<strong>{status}</strong><br><a href="/-/api/tokens/{id}">{link}</a>').format(
             status=TOKEN_STATUSES.get(value, value),
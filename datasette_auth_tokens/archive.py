@@ -0,0 +1,108 @@
+import asyncio
+import time
+from .config import Config
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_INTERVAL_SECONDS = 10 * 60
+# Pages to reclaim per incremental vacuum step
+VACUUM_PAGES = 1000
+
+ARCHIVE_COLUMNS = (
+    "id, token_status, description, actor_id, permissions, created_timestamp, "
+    "last_used_timestamp, expires_after_seconds, ended_timestamp, secret_version, "
+    "changed_at, rate_limit_per_minute"
+)
+
+
+async def run_archiver(datasette):
+    # Background task started by the startup hook
+    config = Config(datasette)
+    interval = config.get("archive_interval_seconds") or DEFAULT_INTERVAL_SECONDS
+    while True:
+        await archive_ended_tokens(
+            datasette,
+            config.get("archive_after_days"),
+            batch_size=config.get("archive_batch_size") or DEFAULT_BATCH_SIZE,
+        )
+        await asyncio.sleep(interval)
+
+
+async def archive_ended_tokens(datasette, days, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Move tokens that ended more than days ago to the archive table, one
+    bounded batch per transaction, then reclaim the freed pages.
+    """
+    cutoff = int(time.time() - days * 24 * 60 * 60)
+    shards = Config(datasette).shards
+    return sum(
+        await asyncio.gather(*(archive_shard(db, cutoff, batch_size) for db in shards))
+    )
+
+
+async def archive_shard(db, cutoff, batch_size):
+    total = 0
+    while True:
+        archived = await db.execute_write_fn(make_archive_function(cutoff, batch_size))
+        total += archived
+        if archived < batch_size:
+            break
+        # Give other writers a turn between batches
+        await asyncio.sleep(0)
+    # Reclaim free pages a step at a time, so the lock is only held briefly
+    while total and await db.execute_write_fn(incremental_vacuum, transaction=False):
+        await asyncio.sleep(0)
+    return total
+
+
+def make_archive_function(cutoff, batch_size):
+    def archive(conn):
+        ids = [
+            row[0]
+            for row in conn.execute(
+                """
+                select id from _datasette_auth_tokens
+                where token_status != 'A'
+                and ended_timestamp < :cutoff
+                -- Never archive the newest token: SQLite would then hand
+                -- its ID out again, and old signed tokens would match it
+                and id < (select max(id) from _datasette_auth_tokens)
+                -- Nor the latest change: the next changed_at is max() + 1,
+                -- and readers have already seen the current maximum
+                and (
+                    changed_at is null
+                    or changed_at < (select max(changed_at) from _datasette_auth_tokens)
+                )
+                order by ended_timestamp limit :limit
+                """,
+                {"cutoff": cutoff, "limit": batch_size},
+            )
+        ]
+        if not ids:
+            return 0
+        in_clause = ", ".join("?" for _ in ids)
+        conn.execute(
+            """
+            insert or replace into _datasette_auth_tokens_archive
+            ({columns}, archived_timestamp)
+            select {columns}, ? from _datasette_auth_tokens where id in ({ids})
+            """.format(
+                columns=ARCHIVE_COLUMNS, ids=in_clause
+            ),
+            [int(time.time())] + ids,
+        )
+        conn.execute(
+            "delete from _datasette_auth_tokens where id in ({})".format(in_clause),
+            ids,
+        )
+        return len(ids)
+
+    return archive
+
+
+def incremental_vacuum(conn):
+    # Only does anything if the file was created with auto_vacuum=INCREMENTAL,
+    # as the dedicated token store is. Returns the number of free pages left.
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    conn.execute("PRAGMA incremental_vacuum({})".format(VACUUM_PAGES)).fetchall()
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
@@ -0,0 +1,200 @@
+"""
+Chunked backfills for changes that would be too slow as a single migration.
+
+A migration should only make the cheap schema change, e.g. adding a column.
+Filling in existing rows is then registered here as a backfill, which runs
+in the background after startup one batch per write transaction. Progress is
+stored alongside each batch, so an interrupted backfill resumes where it left
+off. Rows created after a backfill starts are not visited, so code that
+writes new rows must already handle the change itself.
+"""
+
+import asyncio
+import time
+from .config import Config
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+class Backfills:
+    def __init__(self):
+        self._backfills = []
+
+    def __call__(self, *, name=None, table="_datasette_auth_tokens"):
+        """
+        Register fn(conn, ids) to be called with batches of primary keys
+        from table, in ascending order
+        """
+
+        def inner(fn):
+            self._backfills.append(Backfill(name or fn.__name__, table, fn))
+            return fn
+
+        return inner
+
+    def __iter__(self):
+        return iter(self._backfills)
+
+    def __len__(self):
+        return len(self._backfills)
+
+
+class Backfill:
+    def __init__(self, name, table, fn):
+        self.name = name
+        self.table = table
+        self.fn = fn
+
+    def __repr__(self):
+        return "<Backfill {}>".format(self.name)
+
+
+backfills = Backfills()
+
+
+@backfills()
+def b001_index_token_search(conn, ids):
+    # Rows can already be indexed if the trigger saw them first
+    placeholders = ", ".join("?" for _ in ids)
+    conn.execute(
+        "delete from _datasette_auth_tokens_fts where rowid in ({})".format(
+            placeholders
+        ),
+        ids,
+    )
+    conn.execute(
+        """
+        insert into _datasette_auth_tokens_fts (rowid, description, actor_id)
+        select id, description, actor_id from _datasette_auth_tokens
+        where id in ({})
+        """.format(placeholders),
+        ids,
+    )
+
+
+@backfills()
+def b002_count_tokens(conn, ids):
+    # Rows created since m011 are counted by its triggers instead
+    conn.execute(
+        """
+        insert into _datasette_auth_tokens_counts (actor_id, token_status, count)
+        select actor_id, token_status, count(*) from _datasette_auth_tokens
+        where id in ({}) and actor_id is not null
+        group by actor_id, token_status
+        on conflict (actor_id, token_status) do update
+        set count = count + excluded.count
+        """.format(", ".join("?" for _ in ids)),
+        ids,
+    )
+
+
+def pending_backfills(conn, registered=None):
+    "Backfills that have not yet completed on this connection"
+    registered = list(backfills if registered is None else registered)
+    if not registered:
+        return []
+    completed = {
+        row[0]
+        for row in conn.execute(
+            """
+            select name from _datasette_auth_tokens_backfills
+            where completed_timestamp is not null
+            """
+        )
+    }
+    return [backfill for backfill in registered if backfill.name not in completed]
+
+
+async def run_backfills(datasette, registered=None):
+    # Started in the background by the startup hook
+    config = Config(datasette)
+    batch_size = config.get("backfill_batch_size") or DEFAULT_BATCH_SIZE
+
+    async def run_shard(db):
+        pending = await db.execute_fn(lambda conn: pending_backfills(conn, registered))
+        for backfill in pending:
+            while not await db.execute_write_fn(
+                make_backfill_step_function(backfill, batch_size)
+            ):
+                # Give other writers a turn between batches
+                await asyncio.sleep(0)
+
+    await asyncio.gather(*(run_shard(db) for db in config.shards))
+
+
+def make_backfill_step_function(backfill, batch_size):
+    # Processes one batch, returns True once the backfill has completed
+    def step(conn):
+        now = int(time.time())
+        # Writing first takes the write lock, so another process starting
+        # the same backfill cannot read the progress row at the same time.
+        # Only rows that exist now need visiting.
+        conn.execute(
+            """
+            insert or ignore into _datasette_auth_tokens_backfills
+            (name, last_id, target_id, rows_done, started_timestamp)
+            select ?, 0, coalesce(max(rowid), 0), 0, ? from [{}]
+            """.format(backfill.table),
+            (backfill.name, now),
+        )
+        last_id, target_id, completed = conn.execute(
+            """
+            select last_id, target_id, completed_timestamp
+            from _datasette_auth_tokens_backfills where name = ?
+            """,
+            (backfill.name,),
+        ).fetchone()
+        if completed:
+            return True
+        ids = [
+            row[0]
+            for row in conn.execute(
+                """
+                select rowid from [{}] where rowid > ? and rowid <= ?
+                order by rowid limit ?
+                """.format(backfill.table),
+                (last_id, target_id, batch_size),
+            )
+        ]
+        if ids:
+            backfill.fn(conn, ids)
+        done = len(ids) < batch_size
+        conn.execute(
+            """
+            update _datasette_auth_tokens_backfills
+            set last_id = :last_id, rows_done = rows_done + :count,
+            completed_timestamp = :completed
+            where name = :name
+            """,
+            {
+                "last_id": ids[-1] if ids else last_id,
+                "count": len(ids),
+                "completed": now if done else None,
+                "name": backfill.name,
+            },
+        )
+        return done
+
+    return step
+
+
+async def backfill_progress(db):
+    "List of dictionaries describing every backfill that has started"
+    progress = []
+    for row in (
+        await db.execute(
+            """
+            select name, last_id, target_id, rows_done,
+            started_timestamp, completed_timestamp
+            from _datasette_auth_tokens_backfills order by started_timestamp
+            """
+        )
+    ).rows:
+        info = dict(row)
+        info["percent"] = (
+            100.0
+            if info["completed_timestamp"] or not info["target_id"]
+            else round(100.0 * info["last_id"] / info["target_id"], 1)
+        )
+        progress.append(info)
+    return progress
@@ -0,0 +1,110 @@
+"""
+Short-lived child tokens derived from a managed token.
+
+A child token is a signed payload holding the parent token ID, a deadline
+and the child's restrictions. Nothing is stored for it: verifying one means
+checking the signature and deadline, then the status of its parent.
+"""
+
+import itsdangerous
+from .utils import instance_state, LRUDict
+
+CHILD_PREFIX = "dsatokc_"
+CHILD_NAMESPACE = "dsatok-child"
+DEFAULT_CHILD_MAX_SECONDS = 60 * 60
+# How long a parent's status is trusted for when verifying its children
+DEFAULT_PARENT_CACHE_SECONDS = 5
+PARENT_CACHE_SIZE = 10_000
+
+
+def sign_child_token(datasette, parent_id, deadline, restrictions=None):
+    payload = {"t": parent_id, "e": deadline}
+    # Even an empty object is signed: it restricts the child to nothing
+    if restrictions is not None:
+        payload["_r"] = restrictions
+    return CHILD_PREFIX + datasette.sign(payload, CHILD_NAMESPACE)
+
+
+def unsign_child_token(datasette, token):
+    "Returns the payload, or None if the token is not a valid child token"
+    if not token.startswith(CHILD_PREFIX):
+        return None
+    try:
+        payload = datasette.unsign(token[len(CHILD_PREFIX) :], CHILD_NAMESPACE)
+    except itsdangerous.BadSignature:
+        return None
+    if not isinstance(payload, dict) or not {"t", "e"} <= set(payload):
+        return None
+    return payload
+
+
+def get_parent_statuses(datasette):
+    # token_id => (Lookup, monotonic time it was checked)
+    return instance_state(
+        datasette, "parent_statuses", lambda: LRUDict(PARENT_CACHE_SIZE)
+    )
+
+
+def restrictions_empty(restrictions):
+    "True if restrictions in the _r format allow no actions at all"
+    return not (
+        restrictions.get("a")
+        or any((restrictions.get("d") or {}).values())
+        or any(
+            actions
+            for resources in (restrictions.get("r") or {}).values()
+            for actions in resources.values()
+        )
+    )
+
+
+def restrictions_within(datasette, child, parent):
+    """
+    True if every action allowed by child restrictions is also allowed by
+    parent restrictions. None means unrestricted. Raises ValueError if child
+    is not in the "_r" format used by Datasette tokens.
+    """
+    if not isinstance(child, dict) or not set(child) <= {"a", "d", "r"}:
+        raise ValueError("Restrictions must be an object with keys a, d and r")
+    if parent is None:
+        return True
+    names = {
+        action.abbr: name for name, action in datasette.actions.items() if action.abbr
+    }
+
+    def actions(values):
+        if not isinstance(values, list):
+            raise ValueError("Restricted actions must be a list")
+        return {names.get(value, value) for value in values}
+
+    def mapping(value):
+        if not isinstance(value, dict):
+            raise ValueError("Database and resource restrictions must be objects")
+        return value
+
+    parent_all = actions(parent.get("a") or [])
+    parent_databases = {
+        database: actions(values)
+        for database, values in (parent.get("d") or {}).items()
+    }
+    parent_resources = {
+        (database, resource): actions(values)
+        for database, resources in (parent.get("r") or {}).items()
+        for resource, values in resources.items()
+    }
+    if not actions(child.get("a") or []) <= parent_all:
+        return False
+    for database, values in mapping(child.get("d") or {}).items():
+        allowed = parent_all | parent_databases.get(database, set())
+        if not actions(values) <= allowed:
+            return False
+    for database, resources in mapping(child.get("r") or {}).items():
+        for resource, values in mapping(resources).items():
+            allowed = (
+                parent_all
+                | parent_databases.get(database, set())
+                | parent_resources.get((database, resource), set())
+            )
+            if not actions(values) <= allowed:
+                return False
+    return True
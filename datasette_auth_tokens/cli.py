@@ -0,0 +1,421 @@
+"""
+datasette auth-tokens commands, which work directly on token database files.
+
+Commands that take several PATHS treat them as shards, which must be listed
+in the same order as the manage_tokens_shards setting.
+"""
+
+import click
+from contextlib import contextmanager
+import csv
+import heapq
+import json
+import sqlite3
+import time
+
+DEFAULT_IMPORT_BATCH_SIZE = 50_000
+# Columns an import can set, with the type CSV values are converted to
+IMPORT_COLUMNS = {
+    "actor_id": str,
+    "description": str,
+    "restrictions": str,
+    "created_timestamp": int,
+    "expires_after_seconds": int,
+    "rate_limit_per_minute": int,
+}
+
+
+@click.group(name="auth-tokens")
+def auth_tokens():
+    "Manage datasette-auth-tokens managed tokens"
+
+
+def open_token_database(path):
+    # Brings the tables up to date first, as Datasette startup would
+    from .schema import migrate, pending_migrations
+
+    conn = sqlite3.connect(str(path))
+    if pending_migrations(conn):
+        migrate(conn)
+    return conn
+
+
+def token_database_paths(function):
+    return click.argument(
+        "paths",
+        type=click.Path(exists=True, file_okay=True, dir_okay=False),
+        nargs=-1,
+        required=True,
+    )(function)
+
+
+@auth_tokens.command(name="rebuild-counts")
+@token_database_paths
+def rebuild_counts_command(paths):
+    """
+    Recalculate the token counts table
+
+    Pass every shard file if tokens are sharded.
+    """
+    from .counts import rebuild_counts
+
+    for path in paths:
+        conn = open_token_database(path)
+        with conn:
+            rebuild_counts(conn)
+        total = conn.execute(
+            "select coalesce(sum(count), 0) from _datasette_auth_tokens_counts"
+        ).fetchone()[0]
+        conn.close()
+        click.echo("{}: counted {:,} tokens".format(path, total))
+
+
+@auth_tokens.command(name="import")
+@token_database_paths
+@click.option(
+    "-i",
+    "--input",
+    "input_file",
+    type=click.File("r"),
+    default="-",
+    help="CSV or newline-delimited JSON file to import, defaults to stdin",
+)
+@click.option(
+    "--format",
+    "format_",
+    type=click.Choice(["csv", "nl"]),
+    help="Input format, detected from the file extension if not given",
+)
+@click.option(
+    "--secret",
+    envvar="DATASETTE_SECRET",
+    required=True,
+    help="Secret used by the Datasette instance, to sign the new tokens",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=DEFAULT_IMPORT_BATCH_SIZE,
+    show_default=True,
+    help="Tokens to insert per transaction",
+)
+def import_command(paths, input_file, format_, secret, batch_size):
+    """
+    Create tokens from CSV or newline-delimited JSON
+
+    Each row needs an actor_id and can have description, restrictions (as
+    JSON), created_timestamp, expires_after_seconds and
+    rate_limit_per_minute. The signed dsatok_ token for each row is written
+    to standard output, one per line in the same order.
+    """
+    from itsdangerous import URLSafeSerializer
+
+    # The same as datasette.sign(token_id, "dsatok"), reusing one signer
+    serializer = URLSafeSerializer(secret, "dsatok")
+    signer = serializer.make_signer()
+    if format_ is None:
+        format_ = "nl" if input_file.name.endswith((".jsonl", ".ndjson")) else "csv"
+    conns = [open_token_database(path) for path in paths]
+    try:
+        for token_ids in import_tokens(
+            conns, read_rows(input_file, format_), batch_size
+        ):
+            click.echo(
+                "".join(
+                    "dsatok_{}\n".format(
+                        signer.sign(serializer.dump_payload(token_id)).decode()
+                    )
+                    for token_id in token_ids
+                ),
+                nl=False,
+            )
+    except ValueError as ex:
+        raise click.ClickException(str(ex))
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def read_rows(fp, format_):
+    "Yields one dictionary per row, without reading the whole file"
+    if format_ == "nl":
+        for line in fp:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    else:
+        for row in csv.DictReader(fp):
+            yield {
+                key: IMPORT_COLUMNS.get(key, str)(value) if value != "" else None
+                for key, value in row.items()
+            }
+
+
+def import_tokens(conns, rows, batch_size=DEFAULT_IMPORT_BATCH_SIZE):
+    """
+    Inserts the rows in batches, one transaction per shard per batch, and
+    yields the new token IDs for each batch in the order of the rows
+    """
+    from .config import shard_index_for_actor
+
+    batch = []
+    for row in rows:
+        batch.append(_token_values(row))
+        if len(batch) >= batch_size:
+            yield _import_batch(conns, batch, shard_index_for_actor)
+            batch = []
+    if batch:
+        yield _import_batch(conns, batch, shard_index_for_actor)
+
+
+def _token_values(row):
+    unknown = set(row) - set(IMPORT_COLUMNS) - {"permissions"}
+    if unknown:
+        raise ValueError("Unknown columns: {}".format(", ".join(sorted(unknown))))
+    if not row.get("actor_id"):
+        raise ValueError("Every token needs an actor_id")
+    restrictions = row.get("restrictions", row.get("permissions"))
+    if isinstance(restrictions, str):
+        restrictions = json.loads(restrictions)
+    return {
+        "actor_id": str(row["actor_id"]),
+        "description": row.get("description"),
+        "permissions": json.dumps(restrictions or None),
+        "created_timestamp": row.get("created_timestamp") or int(time.time()),
+        "expires_after_seconds": row.get("expires_after_seconds"),
+        "rate_limit_per_minute": row.get("rate_limit_per_minute"),
+    }
+
+
+def _import_batch(conns, batch, shard_index_for_actor):
+    by_shard = {}
+    for position, values in enumerate(batch):
+        shard = shard_index_for_actor(values["actor_id"], len(conns))
+        by_shard.setdefault(shard, []).append((position, values))
+    token_ids = [None] * len(batch)
+    for shard, items in by_shard.items():
+        conn = conns[shard]
+        conn.execute("begin immediate")
+        try:
+            # Same interleaved IDs as tokens created through the web UI
+            next_id, changed_at = conn.execute(
+                "select coalesce(max(id), :shard + 1 - :count) + :count, "
+                "coalesce(max(changed_at), 0) from _datasette_auth_tokens",
+                {"shard": shard, "count": len(conns)},
+            ).fetchone()
+            first_id = next_id
+            for position, values in items:
+                changed_at += 1
+                values["id"] = token_ids[position] = next_id
+                values["changed_at"] = changed_at
+                next_id += len(conns)
+            with _bulk_insert_triggers_suspended(conn):
+                conn.executemany(
+                    """
+                    insert into _datasette_auth_tokens
+                    (id, secret_version, description, permissions, actor_id,
+                    created_timestamp, expires_after_seconds, rate_limit_per_minute,
+                    changed_at)
+                    values
+                    (:id, 0, :description, :permissions, :actor_id,
+                    :created_timestamp, :expires_after_seconds,
+                    :rate_limit_per_minute, :changed_at)
+                    """,
+                    (values for _, values in items),
+                )
+                for sql in BULK_INSERT_SQL:
+                    conn.execute(sql, {"first_id": first_id})
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    _record_events(conns[0], "create", token_ids)
+    return token_ids
+
+
+# Row-at-a-time insert triggers, replaced during an import by BULK_INSERT_SQL
+# run once per batch - five times faster. changed_at is assigned directly.
+BULK_SUSPENDED_TRIGGERS = (
+    "_datasette_auth_tokens_changed_insert",
+    "_datasette_auth_tokens_version_insert",
+    "_datasette_auth_tokens_fts_insert",
+    "_datasette_auth_tokens_counts_insert",
+)
+BULK_INSERT_SQL = (
+    "update _datasette_auth_tokens_version set version = version + 1",
+    """
+    insert into _datasette_auth_tokens_fts (rowid, description, actor_id)
+    select id, description, actor_id from _datasette_auth_tokens
+    where id >= :first_id
+    """,
+    """
+    insert into _datasette_auth_tokens_counts (actor_id, token_status, count)
+    select actor_id, token_status, count(*) from _datasette_auth_tokens
+    where id >= :first_id group by actor_id, token_status
+    on conflict (actor_id, token_status) do update
+    set count = count + excluded.count
+    """,
+)
+
+
+@contextmanager
+def _bulk_insert_triggers_suspended(conn):
+    # Must be called inside a transaction: the triggers are dropped and
+    # recreated within it, so other connections never see them missing
+    triggers = conn.execute(
+        "select name, sql from sqlite_master where type = 'trigger' "
+        "and name in (select value from json_each(?))",
+        [json.dumps(BULK_SUSPENDED_TRIGGERS)],
+    ).fetchall()
+    if len(triggers) != len(BULK_SUSPENDED_TRIGGERS):
+        raise ValueError("Token database is missing expected triggers")
+    for name, _ in triggers:
+        conn.execute("drop trigger {}".format(name))
+    yield
+    for _, sql in triggers:
+        conn.execute(sql)
+
+
+def _record_events(conn, event, token_ids):
+    # The audit log is kept in the first shard
+    now = int(time.time())
+    details = json.dumps({"source": "cli"})
+    with conn:
+        conn.executemany(
+            """
+            insert into _datasette_auth_tokens_events
+            (token_id, event, actor_id, timestamp, details)
+            values (?, ?, null, ?, ?)
+            """,
+            ((token_id, event, now, details) for token_id in token_ids),
+        )
+
+
+@auth_tokens.command(name="export")
+@token_database_paths
+@click.option(
+    "-o",
+    "--output",
+    type=click.File("w"),
+    default="-",
+    help="File to write to, defaults to stdout",
+)
+@click.option(
+    "--format",
+    "format_",
+    type=click.Choice(["csv", "nl"]),
+    default="csv",
+    show_default=True,
+)
+@click.option(
+    "--status",
+    type=click.Choice(["A", "R", "E"]),
+    help="Only export tokens with this status",
+)
+@click.option("actor_ids", "--actor", multiple=True, help="Only tokens for this actor")
+def export_command(paths, output, format_, status, actor_ids):
+    """
+    Export tokens as CSV or newline-delimited JSON, ordered by ID
+
+    Rows are streamed from each file, so the table is never held in memory.
+    """
+    where_bits = []
+    params = {}
+    if status:
+        where_bits.append("token_status = :status")
+        params["status"] = status
+    if actor_ids:
+        where_bits.append("actor_id in (select value from json_each(:actor_ids))")
+        params["actor_ids"] = json.dumps(actor_ids)
+    sql = "select * from _datasette_auth_tokens {} order by id".format(
+        "where {}".format(" and ".join(where_bits)) if where_bits else ""
+    )
+    conns = [open_token_database(path) for path in paths]
+    try:
+        cursors = [conn.execute(sql, params) for conn in conns]
+        columns = [column[0] for column in cursors[0].description]
+        rows = heapq.merge(*cursors, key=lambda row: row[0])
+        if format_ == "csv":
+            writer = csv.writer(output)
+            writer.writerow(columns)
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                output.write(json.dumps(dict(zip(columns, row))) + "\n")
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+@auth_tokens.command(name="revoke")
+@token_database_paths
+@click.option("actor_ids", "--actor", multiple=True, help="Tokens for this actor")
+@click.option("token_ids", "--id", type=int, multiple=True, help="Token with this ID")
+@click.option(
+    "--created-before", type=int, help="Tokens created before this Unix timestamp"
+)
+@click.option(
+    "--last-used-before",
+    type=int,
+    help="Tokens not used since this Unix timestamp, including never used",
+)
+@click.option("all_", "--all", is_flag=True, help="Revoke every active token")
+@click.option(
+    "--snapshot",
+    type=click.Path(dir_okay=False),
+    help="Rewrite this snapshot_path file once the tokens are revoked",
+)
+def revoke_command(
+    paths, actor_ids, token_ids, created_before, last_used_before, all_, snapshot
+):
+    """
+    Revoke every active token matching all of the filters
+    """
+    from . import update_tokens
+
+    where_bits = ["token_status = 'A'"]
+    params = {"now": int(time.time())}
+    if actor_ids:
+        where_bits.append("actor_id in (select value from json_each(:actor_ids))")
+        params["actor_ids"] = json.dumps(actor_ids)
+    if token_ids:
+        where_bits.append("id in (select value from json_each(:token_ids))")
+        params["token_ids"] = json.dumps(token_ids)
+    if created_before is not None:
+        where_bits.append("created_timestamp < :created_before")
+        params["created_before"] = created_before
+    if last_used_before is not None:
+        where_bits.append("coalesce(last_used_timestamp, 0) < :last_used_before")
+        params["last_used_before"] = last_used_before
+    if len(where_bits) == 1 and not all_:
+        raise click.ClickException("Use at least one filter, or --all")
+
+    conns = [open_token_database(path) for path in paths]
+    try:
+        revoked_ids = []
+        for conn in conns:
+            revoked_ids.extend(
+                row[0]
+                for row in update_tokens(
+                    conn,
+                    "token_status = 'R', ended_timestamp = :now",
+                    " and ".join(where_bits),
+                    params,
+                )
+            )
+        if revoked_ids:
+            _record_events(conns[0], "revoke", sorted(revoked_ids))
+        if snapshot:
+            from .snapshot import read_snapshot_rows, write_shards_snapshot
+
+            write_shards_snapshot(
+                snapshot, [read_snapshot_rows(conn) for conn in conns]
+            )
+    finally:
+        for conn in conns:
+            conn.close()
+    click.echo(
+        "Revoked {:,} token{}".format(
+            len(revoked_ids), "" if len(revoked_ids) == 1 else "s"
+        )
+    )
@@ -0,0 +1,108 @@
+from .utils import instance_state
+import zlib
+
+
+class Config:
+    def __init__(self, datasette):
+        self._plugin_config = datasette.plugin_config("datasette-auth-tokens") or {}
+        self._datasette = datasette
+        self.enabled = self._plugin_config.get("manage_tokens")
+
+    def get(self, key):
+        return self._plugin_config.get(key)
+
+    @property
+    def db(self):
+        # With shards this is the first shard, which also holds the audit log
+        if self._plugin_config.get("manage_tokens_shards"):
+            return self.shards[0]
+        path = self._plugin_config.get("manage_tokens_path")
+        if path:
+            return instance_state(self._datasette, "token_store", self._token_store)
+        db_name = self._plugin_config.get("manage_tokens_database") or None
+        if db_name is None:
+            return self._datasette.get_internal_database()
+        else:
+            return self._datasette.get_database(db_name)
+
+    @property
+    def shards(self):
+        "Every database holding tokens - just db unless manage_tokens_shards is set"
+        if not self._plugin_config.get("manage_tokens_shards"):
+            return [self.db]
+        return instance_state(self._datasette, "token_shards", self._token_shards)
+
+    def shard_for_token(self, token_id):
+        return self.shards[self.shard_index_for_token(token_id)]
+
+    def shard_index_for_token(self, token_id):
+        return shard_index_for_token(token_id, len(self.shards))
+
+    @property
+    def replicas(self):
+        "Read-only replica of each shard, or None without manage_tokens_replica_path"
+        if not self._plugin_config.get("manage_tokens_replica_path"):
+            return None
+        return instance_state(self._datasette, "token_replicas", self._token_replicas)
+
+    def read_db(self, shard):
+        "Database authentication reads for a shard should use"
+        if self.replicas is None:
+            return self.shards[shard]
+        from .replica import get_replica_guard
+
+        if get_replica_guard(self._datasette).use_replica(shard):
+            return self.replicas[shard]
+        return self.shards[shard]
+
+    def read_db_for_token(self, token_id):
+        return self.read_db(self.shard_index_for_token(token_id))
+
+    def shard_index_for_actor(self, actor_id):
+        return shard_index_for_actor(actor_id, len(self.shards))
+
+    def _token_store(self):
+        return self._store(self.get("manage_tokens_path"))
+
+    def _token_shards(self):
+        return [
+            self._store(path, name="_datasette_auth_tokens_{}".format(i))
+            for i, path in enumerate(self.get("manage_tokens_shards"))
+        ]
+
+    def _token_replicas(self):
+        # One path, or a list with one replica for each shard
+        paths = self.get("manage_tokens_replica_path")
+        if isinstance(paths, str):
+            paths = [paths]
+        return [
+            self._store(
+                path, name="_datasette_auth_tokens_replica_{}".format(i), read_only=True
+            )
+            for i, path in enumerate(paths)
+        ]
+
+    def _store(self, path, **kwargs):
+        from .store import TokenStoreDatabase, DEFAULT_READ_CONNECTIONS
+
+        kwargs["read_connections"] = (
+            self.get("manage_tokens_read_connections") or DEFAULT_READ_CONNECTIONS
+        )
+        if self.get("manage_tokens_cache_size_kb"):
+            kwargs["cache_size_kb"] = self.get("manage_tokens_cache_size_kb")
+        if self.get("manage_tokens_mmap_size") is not None:
+            kwargs["mmap_size"] = self.get("manage_tokens_mmap_size")
+        return TokenStoreDatabase(self._datasette, path, **kwargs)
+
+
+def shard_index_for_token(token_id, shard_count):
+    # Token IDs are interleaved, so shard i holds IDs where
+    # (id - 1) % shard_count == i
+    return (token_id - 1) % shard_count
+
+
+def shard_index_for_actor(actor_id, shard_count):
+    # All of an actor's tokens are created in the same shard
+    if shard_count == 1:
+        return 0
+    return zlib.crc32(str(actor_id).encode("utf-8")) % shard_count
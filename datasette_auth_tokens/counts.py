@@ -0,0 +1,77 @@
+"""
+Token counts per actor and status, read from the trigger-maintained
+_datasette_auth_tokens_counts table rather than counting the tokens.
+"""
+
+import asyncio
+import time
+from .config import Config
+from .utils import instance_state
+
+# How long totals across all actors are cached for
+DEFAULT_COUNTS_REFRESH_SECONDS = 5
+STATUS_KEYS = {"A": "active", "R": "revoked", "E": "expired"}
+
+
+def rebuild_counts(conn):
+    """
+    Recalculates the counts table from scratch, in case it has drifted from
+    the tokens table - for example after the triggers were disabled. Run it
+    inside a transaction.
+    """
+    conn.execute("delete from _datasette_auth_tokens_counts")
+    conn.execute("""
+        insert into _datasette_auth_tokens_counts (actor_id, token_status, count)
+        select actor_id, token_status, count(*) from _datasette_auth_tokens
+        where actor_id is not null
+        group by actor_id, token_status
+        """)
+    # Everything is counted now, so a pending initial count must not add to it
+    conn.execute(
+        """
+        update _datasette_auth_tokens_backfills
+        set last_id = target_id, completed_timestamp = ?
+        where name = 'b002_count_tokens' and completed_timestamp is null
+        """,
+        (int(time.time()),),
+    )
+
+
+async def get_token_counts(datasette, actor_id=None):
+    """
+    Returns {"active": n, "revoked": n, "expired": n} for one actor, or for
+    every token if actor_id is None. Totals are cached for a few seconds.
+    """
+    config = Config(datasette)
+    if actor_id is not None:
+        # A primary key lookup in the one shard holding the actor's tokens
+        db = config.read_db(config.shard_index_for_actor(actor_id))
+        result = await db.execute(
+            """
+            select token_status, count from _datasette_auth_tokens_counts
+            where actor_id = ?
+            """,
+            (actor_id,),
+        )
+        return _summarize(result.rows)
+
+    cache = instance_state(datasette, "token_counts", dict)
+    refresh_seconds = config.get("counts_refresh_seconds")
+    if refresh_seconds is None:
+        refresh_seconds = DEFAULT_COUNTS_REFRESH_SECONDS
+    if time.monotonic() - cache.get("fetched_at", float("-inf")) > refresh_seconds:
+        results = await asyncio.gather(*(config.read_db(shard).execute("""
+                    select token_status, sum(count) from _datasette_auth_tokens_counts
+                    group by token_status
+                    """) for shard in range(len(config.shards))))
+        cache["counts"] = _summarize(row for result in results for row in result.rows)
+        cache["fetched_at"] = time.monotonic()
+    return dict(cache["counts"])
+
+
+def _summarize(rows):
+    counts = {key: 0 for key in STATUS_KEYS.values()}
+    for status, count in rows:
+        key = STATUS_KEYS.get(status, status)
+        counts[key] = counts.get(key, 0) + count
+    return counts
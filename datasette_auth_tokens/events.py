@@ -0,0 +1,106 @@
+import asyncio
+import json
+import time
+from .config import Config
+from .utils import instance_state, run_in_background
+
+# Only prune old events at most this often, in seconds
+PRUNE_INTERVAL = 60 * 60
+PRUNE_CHUNK_SIZE = 1000
+
+
+def get_event_log(datasette):
+    return instance_state(datasette, "event_log", lambda: EventLog(datasette))
+
+
+class EventLog:
+    """
+    Append-only audit log of token events.
+
+    record() only appends to an in-memory queue, so it adds no latency to
+    the request. A background task then writes everything that has queued
+    up so far in a single transaction. A batch that fails to write is put
+    back on the queue to be retried by the next flush.
+    """
+
+    def __init__(self, datasette):
+        self._datasette = datasette
+        self._queue = []
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+        self._last_pruned = 0
+
+    def record(self, event, token_id, actor_id=None, details=None):
+        self._queue.append(
+            {
+                "token_id": token_id,
+                "event": event,
+                "actor_id": actor_id,
+                "timestamp": int(time.time()),
+                "details": json.dumps(details) if details else None,
+            }
+        )
+        if self._flush_task is None:
+            self._flush_task = run_in_background(self._background_flush())
+
+    async def _background_flush(self):
+        # Events recorded from here on schedule another flush
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        config = Config(self._datasette)
+        async with self._lock:
+            batch, self._queue = self._queue, []
+            if batch:
+
+                def write(conn):
+                    conn.executemany(
+                        """
+                        insert into _datasette_auth_tokens_events
+                        (token_id, event, actor_id, timestamp, details)
+                        values
+                        (:token_id, :event, :actor_id, :timestamp, :details)
+                        """,
+                        batch,
+                    )
+
+                try:
+                    await config.db.execute_write_fn(write)
+                except Exception:
+                    # Ahead of anything recorded since, to keep the order
+                    self._queue[:0] = batch
+                    raise
+            retention_days = config.get("events_retention_days")
+            if retention_days and time.time() - self._last_pruned > PRUNE_INTERVAL:
+                self._last_pruned = time.time()
+                await self.prune(time.time() - retention_days * 24 * 60 * 60)
+
+    async def prune(self, cutoff, chunk_size=PRUNE_CHUNK_SIZE):
+        # Delete in bounded chunks, one transaction each, so the write
+        # connection is never held for long
+        db = Config(self._datasette).db
+        total = 0
+        while True:
+            deleted = await db.execute_write_fn(
+                make_prune_function(int(cutoff), chunk_size)
+            )
+            total += deleted
+            if deleted < chunk_size:
+                return total
+
+
+def make_prune_function(cutoff, chunk_size):
+    def prune_events(conn):
+        return conn.execute(
+            """
+            delete from _datasette_auth_tokens_events where id in (
+                select id from _datasette_auth_tokens_events
+                where timestamp < :cutoff
+                order by id limit :limit
+            )
+            """,
+            {"cutoff": cutoff, "limit": chunk_size},
+        ).rowcount
+
+    return prune_events
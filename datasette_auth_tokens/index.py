@@ -0,0 +1,197 @@
+import asyncio
+import json
+import sys
+import time
+from .config import Config, shard_index_for_token
+from .timing import annotate, stage
+from .utils import instance_state
+
+DEFAULT_REFRESH_SECONDS = 5
+
+
+def get_token_index(datasette):
+    return instance_state(datasette, "token_index", lambda: TokenIndex(datasette))
+
+
+class TokenRecord:
+    __slots__ = (
+        "id",
+        "actor_id",
+        "permissions",
+        "expires_at",
+        "last_used_timestamp",
+        "rate_limit",
+    )
+
+    def __init__(
+        self,
+        id,
+        actor_id,
+        permissions,
+        expires_at,
+        last_used_timestamp,
+        rate_limit=None,
+    ):
+        self.id = id
+        self.actor_id = actor_id
+        self.permissions = permissions
+        self.expires_at = expires_at
+        self.last_used_timestamp = last_used_timestamp
+        self.rate_limit = rate_limit
+
+    @classmethod
+    def from_row(cls, row, parsed_permissions=None):
+        # parsed_permissions maps JSON strings to already-parsed values, so
+        # tokens with identical restrictions share a single object
+        if parsed_permissions is None:
+            parsed_permissions = {}
+        permissions = parsed_permissions.get(row["permissions"])
+        if permissions is None:
+            permissions = parsed_permissions[row["permissions"]] = (
+                json.loads(row["permissions"]) or None
+            )
+        actor_id = row["actor_id"]
+        if isinstance(actor_id, str):
+            actor_id = sys.intern(actor_id)
+        expires_at = None
+        if row["expires_after_seconds"]:
+            expires_at = row["created_timestamp"] + row["expires_after_seconds"]
+        return cls(
+            row["id"],
+            actor_id,
+            permissions,
+            expires_at,
+            row["last_used_timestamp"],
+            row["rate_limit_per_minute"],
+        )
+
+    def is_expired(self, now=None):
+        return self.expires_at is not None and self.expires_at < (now or time.time())
+
+
+class TokenIndex:
+    """
+    In-memory index of active tokens, keyed by token ID.
+
+    It is loaded in full once, then kept up to date by reading only the rows
+    whose changed_at sequence number is higher than the last one seen.
+    """
+
+    def __init__(self, datasette):
+        self._datasette = datasette
+        self.refresh_seconds = (
+            Config(datasette).get("memory_index_refresh_seconds")
+            or DEFAULT_REFRESH_SECONDS
+        )
+        self.tokens = {}
+        # changed_at sequence number and highest ID last seen, for each shard
+        self.versions = None
+        self.max_ids = None
+        self.refreshed_at = 0
+        self._generation = 0
+        self._lock = asyncio.Lock()
+
+    @property
+    def version(self):
+        if self.versions is None:
+            return None
+        return sum(self.versions)
+
+    def mark_stale(self):
+        # Called after this process writes to the tokens table
+        self._generation += 1
+        self.refreshed_at = 0
+
+    async def get(self, token_id):
+        if time.monotonic() - self.refreshed_at > self.refresh_seconds or (
+            token_id not in self.tokens and self._created_since_refresh(token_id)
+        ):
+            annotate(cache="miss")
+            with stage("refresh", database=True):
+                await self.refresh()
+        else:
+            annotate(cache="hit")
+        return self.tokens.get(token_id)
+
+    def _created_since_refresh(self, token_id):
+        # Tokens are only ever created with higher IDs within their shard, so
+        # a miss above that shard's max ID may be a token created since
+        if self.max_ids is None:
+            return True
+        shard = shard_index_for_token(token_id, len(self.max_ids))
+        return token_id > self.max_ids[shard]
+
+    async def refresh(self):
+        shards = Config(self._datasette).shards
+        requested_at = time.monotonic()
+        async with self._lock:
+            if self.refreshed_at > requested_at:
+                # Another caller refreshed while we were waiting
+                return
+            generation = self._generation
+            if self.versions is None:
+                self.tokens = {}
+                self.versions = [None] * len(shards)
+                self.max_ids = [0] * len(shards)
+            results = await asyncio.gather(
+                *(
+                    db.execute_fn(make_load_function(version))
+                    for db, version in zip(shards, self.versions)
+                )
+            )
+            parsed_permissions = {}
+            for shard, (version, max_id, rows) in enumerate(results):
+                self.max_ids[shard] = max(self.max_ids[shard], max_id or 0)
+                for row in rows:
+                    if row["token_status"] == "A":
+                        self.tokens[row["id"]] = TokenRecord.from_row(
+                            row, parsed_permissions
+                        )
+                    else:
+                        self.tokens.pop(row["id"], None)
+                self.versions[shard] = version or 0
+            if generation == self._generation:
+                # Otherwise a write happened mid-refresh, so stay stale
+                self.refreshed_at = time.monotonic()
+
+
+def make_load_function(since_version=None):
+    # Uses execute_fn rather than execute() so a large initial load is not
+    # cut short by Datasette's SQL time limit
+    def load(conn):
+        # Read the version first: anything that changes after this point
+        # will be picked up again by the next refresh
+        version, max_id = conn.execute(
+            "select max(changed_at), max(id) from _datasette_auth_tokens"
+        ).fetchone()
+        if since_version is None:
+            rows = conn.execute(
+                "select * from _datasette_auth_tokens where token_status = 'A'"
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                """
+                select * from _datasette_auth_tokens
+                where changed_at > :version order by changed_at
+                """,
+                {"version": since_version},
+            ).fetchall()
+        return version, max_id, rows
+
+    return load
+
+
+def tokens_changed(datasette, ended_ids=()):
+    # Call this after writing to the tokens table from this process, with
+    # the IDs of any tokens that were revoked or expired
+    from .snapshot import get_snapshot_writer
+
+    config = Config(datasette)
+    if config.get("memory_index"):
+        get_token_index(datasette).mark_stale()
+    if config.get("snapshot_path"):
+        get_snapshot_writer(datasette).schedule(ended_ids)
+    if config.get("manage_tokens_replica_path"):
+        from .replica import get_replica_guard
+
+        get_replica_guard(datasette).writes_happened()
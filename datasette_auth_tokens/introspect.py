@@ -0,0 +1,119 @@
+import itsdangerous
+import json
+import time
+from .config import Config
+from .index import get_token_index
+
+DEFAULT_INTROSPECT_MAX_TOKENS = 100
+
+
+async def introspect_tokens(datasette, tokens):
+    """
+    Returns a dictionary describing each of the signed tokens, in order.
+
+    Nothing is written: introspecting a token does not count as using it.
+    Child tokens are reported with the ID of their parent, which must
+    still be active.
+    """
+    from . import _child_actor, _token_actor
+
+    now = time.time()
+    unsigned = [_unsign(datasette, token, now) for token in tokens]
+    found = await lookup_tokens(
+        datasette, {token_id for token_id, _ in unsigned if token_id is not None}
+    )
+    results = []
+    for token_id, child in unsigned:
+        record = found.get(token_id)
+        if record is None or (record[2] is not None and record[2] < now):
+            results.append({"active": False})
+            continue
+        actor_id, permissions, expires_at = record
+        if child is None:
+            actor = _token_actor(token_id, actor_id, permissions)
+            restrictions = permissions or None
+        else:
+            actor = _child_actor(token_id, actor_id, child)
+            # Even empty restrictions mean something for a child
+            restrictions = child.get("_r")
+            expires_at = min(child["e"], expires_at or child["e"])
+        results.append(
+            {
+                "active": True,
+                "token_id": token_id,
+                "actor": actor,
+                "restrictions": restrictions,
+                "expires_at": expires_at,
+            }
+        )
+    return results
+
+
+def _unsign(datasette, token, now):
+    "Returns (token_id, child payload or None), or (None, None) if invalid"
+    from .children import CHILD_PREFIX, unsign_child_token
+
+    if not isinstance(token, str):
+        return None, None
+    if token.startswith(CHILD_PREFIX):
+        child = unsign_child_token(datasette, token)
+        if child is None or child["e"] < now:
+            return None, None
+        return child["t"], child
+    if not token.startswith("dsatok_"):
+        return None, None
+    try:
+        return datasette.unsign(token[len("dsatok_") :], "dsatok"), None
+    except itsdangerous.BadSignature:
+        return None, None
+
+
+async def lookup_tokens(datasette, token_ids):
+    """
+    Returns {token_id: (actor_id, permissions, expires_at)} for the active
+    tokens out of token_ids, using the same sources as single lookups
+    """
+    config = Config(datasette)
+    found = {}
+    remaining = set(token_ids)
+    if config.get("snapshot_path"):
+        from .snapshot import get_snapshot_reader, get_snapshot_writer
+
+        remaining -= get_snapshot_writer(datasette).ended
+        snapshot = get_snapshot_reader(datasette).current()
+        if snapshot is not None:
+            for token_id in [i for i in remaining if snapshot.covers(i)]:
+                remaining.discard(token_id)
+                record = snapshot.lookup(token_id)
+                if record is not None:
+                    found[token_id] = record[:3]
+    elif config.get("memory_index"):
+        index = get_token_index(datasette)
+        for token_id in remaining:
+            record = await index.get(token_id)
+            if record is not None:
+                found[token_id] = (
+                    record.actor_id,
+                    record.permissions,
+                    record.expires_at,
+                )
+        remaining = set()
+
+    if remaining:
+        from .storage import get_storage
+
+        records = await get_storage(datasette).lookup_many(remaining)
+        for record in records.values():
+            if record["token_status"] != "A":
+                continue
+            expires_at = None
+            if record["expires_after_seconds"]:
+                expires_at = (
+                    record["created_timestamp"] + record["expires_after_seconds"]
+                )
+            found[record["id"]] = (
+                record["actor_id"],
+                json.loads(record["permissions"]) or None,
+                expires_at,
+            )
+    return found
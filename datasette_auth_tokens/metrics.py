@@ -0,0 +1,7 @@
+from collections import Counter
+from .utils import instance_state
+
+
+def get_metrics(datasette):
+    # Simple in-process counters, exposed at /-/api/tokens/metrics
+    return instance_state(datasette, "metrics", Counter)
@@ -64,3 +64,255 @@ def m003_add_ended_timestamp(db):
         set ended_timestamp = created_timestamp + expires_after_seconds
         where token_status = 'E'
         """)
+
+
+@migration()
+def m004_create_events_table(db):
+    db.executescript("""
+    CREATE TABLE IF NOT EXISTS _datasette_auth_tokens_events (
+        id INTEGER PRIMARY KEY,
+        token_id INTEGER,
+        event TEXT, -- create, revoke, expire, first_use
+        actor_id TEXT, -- actor responsible for the event, if any
+        timestamp INTEGER,
+        details TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_datasette_auth_tokens_events_token_id
+        ON _datasette_auth_tokens_events (token_id);
+    CREATE INDEX IF NOT EXISTS idx_datasette_auth_tokens_events_timestamp
+        ON _datasette_auth_tokens_events (timestamp);
+    """)
+
+
+@migration()
+def m005_add_changed_at(db):
+    # changed_at is a sequence number, bumped by triggers whenever a row is
+    # inserted or changes status, so readers can fetch just the rows that
+    # changed since the last value they saw
+    db["_datasette_auth_tokens"].add_column("changed_at", int)
+    db.executescript("""
+    CREATE INDEX IF NOT EXISTS idx_datasette_auth_tokens_changed_at
+        ON _datasette_auth_tokens (changed_at);
+    CREATE TRIGGER IF NOT EXISTS _datasette_auth_tokens_changed_insert
+    AFTER INSERT ON _datasette_auth_tokens
+    BEGIN
+        UPDATE _datasette_auth_tokens
+        SET changed_at = (
+            SELECT coalesce(max(changed_at), 0) + 1 FROM _datasette_auth_tokens
+        )
+        WHERE id = new.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS _datasette_auth_tokens_changed_update
+    AFTER UPDATE OF
+        token_status, actor_id, permissions, created_timestamp, expires_after_seconds
+    ON _datasette_auth_tokens
+    BEGIN
+        UPDATE _datasette_auth_tokens
+        SET changed_at = (
+            SELECT coalesce(max(changed_at), 0) + 1 FROM _datasette_auth_tokens
+        )
+        WHERE id = new.id;
+    END;
+    """)
+
+
+@migration()
+def m006_add_rate_limit(db):
+    db["_datasette_auth_tokens"].add_column("rate_limit_per_minute", int)
+    # Changing a rate limit should bump changed_at too
+    db.executescript("""
+    DROP TRIGGER IF EXISTS _datasette_auth_tokens_changed_update;
+    CREATE TRIGGER _datasette_auth_tokens_changed_update
+    AFTER UPDATE OF
+        token_status, actor_id, permissions, created_timestamp,
+        expires_after_seconds, rate_limit_per_minute
+    ON _datasette_auth_tokens
+    BEGIN
+        UPDATE _datasette_auth_tokens
+        SET changed_at = (
+            SELECT coalesce(max(changed_at), 0) + 1 FROM _datasette_auth_tokens
+        )
+        WHERE id = new.id;
+    END;
+    """)
+
+
+@migration()
+def m007_create_archive_table(db):
+    db.executescript("""
+    CREATE TABLE IF NOT EXISTS _datasette_auth_tokens_archive (
+        id INTEGER PRIMARY KEY,
+        token_status TEXT,
+        description TEXT,
+        actor_id TEXT,
+        permissions TEXT,
+        created_timestamp INTEGER,
+        last_used_timestamp INTEGER,
+        expires_after_seconds INTEGER,
+        ended_timestamp INTEGER,
+        secret_version INTEGER,
+        changed_at INTEGER,
+        rate_limit_per_minute INTEGER,
+        archived_timestamp INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_datasette_auth_tokens_ended_timestamp
+        ON _datasette_auth_tokens (ended_timestamp)
+        WHERE ended_timestamp IS NOT NULL;
+    """)
+
+
+@migration()
+def m008_create_backfills_table(db):
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS _datasette_auth_tokens_backfills (
+        name TEXT PRIMARY KEY,
+        last_id INTEGER,
+        target_id INTEGER,
+        rows_done INTEGER DEFAULT 0,
+        started_timestamp INTEGER,
+        completed_timestamp INTEGER
+    );
+    """)
+
+
+@migration()
+def m009_create_version_table(db):
+    # A single counter bumped by any change to the tokens table - including
+    # last_used_timestamp, which changed_at deliberately ignores - so the
+    # token listing can cheaply tell whether anything it shows has changed
+    db.executescript("""
+    CREATE TABLE IF NOT EXISTS _datasette_auth_tokens_version (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO _datasette_auth_tokens_version (id, version) VALUES (1, 0);
+    CREATE TRIGGER IF NOT EXISTS _datasette_auth_tokens_version_insert
+    AFTER INSERT ON _datasette_auth_tokens
+    BEGIN
+        UPDATE _datasette_auth_tokens_version SET version = version + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS _datasette_auth_tokens_version_update
+    AFTER UPDATE ON _datasette_auth_tokens
+    BEGIN
+        UPDATE _datasette_auth_tokens_version SET version = version + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS _datasette_auth_tokens_version_delete
+    AFTER DELETE ON _datasette_auth_tokens
+    BEGIN
+        UPDATE _datasette_auth_tokens_version SET version = version + 1;
+    END;
+    -- Finds the next active token due to expire without a scan
+    CREATE INDEX IF NOT EXISTS idx_datasette_auth_tokens_expires_at
+        ON _datasette_auth_tokens (created_timestamp + expires_after_seconds)
+        WHERE token_status = 'A' AND expires_after_seconds IS NOT NULL;
+    """)
+
+
+@migration()
+def m010_create_search_index(db):
+    # Full-text search over description and actor_id. Existing rows are
+    # indexed by the b001_index_token_search backfill, new ones by triggers.
+    # The index keeps its own copy of the text, so deleting a row that was
+    # never indexed is harmless.
+    db.executescript("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS _datasette_auth_tokens_fts
+        USING fts5(description, actor_id);
+    CREATE TRIGGER IF NOT EXISTS _datasette_auth_tokens_fts_insert
+    AFTER INSERT ON _datasette_auth_tokens
+    BEGIN
+        INSERT INTO _datasette_auth_tokens_fts (rowid, description, actor_id)
+        VALUES (new.id, new.description, new.actor_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS _datasette_auth_tokens_fts_update
+    AFTER UPDATE OF description, actor_id ON _datasette_auth_tokens
+    BEGIN
+        DELETE FROM _datasette_auth_tokens_fts WHERE rowid = old.id;
+        INSERT INTO _datasette_auth_tokens_fts (rowid, description, actor_id)
+        VALUES (new.id, new.description, new.actor_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS _datasette_auth_tokens_fts_delete
+    AFTER DELETE ON _datasette_auth_tokens
+    BEGIN
+        DELETE FROM _datasette_auth_tokens_fts WHERE rowid = old.id;
+    END;
+    """)
+
+
+@migration()
+def m011_create_counts_table(db):
+    # Number of tokens per actor and status, kept up to date by triggers so
+    # summaries never need a group by over the tokens table. Existing rows
+    # are counted by the b002_count_tokens backfill, which is registered
+    # here with the current maximum ID as its target. Until it reaches a
+    # row the update and delete triggers leave that row alone, as the
+    # backfill will count it as it is by then.
+    db.executescript("""
+    CREATE TABLE IF NOT EXISTS _datasette_auth_tokens_counts (
+        actor_id TEXT NOT NULL,
+        token_status TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (actor_id, token_status)
+    );
+    CREATE TRIGGER IF NOT EXISTS _datasette_auth_tokens_counts_insert
+    AFTER INSERT ON _datasette_auth_tokens
+    BEGIN
+        INSERT INTO _datasette_auth_tokens_counts (actor_id, token_status, count)
+        VALUES (new.actor_id, new.token_status, 1)
+        ON CONFLICT (actor_id, token_status) DO UPDATE SET count = count + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS _datasette_auth_tokens_counts_update
+    AFTER UPDATE OF token_status, actor_id ON _datasette_auth_tokens
+    WHEN (old.token_status IS NOT new.token_status
+        OR old.actor_id IS NOT new.actor_id)
+        AND NOT EXISTS (
+            SELECT 1 FROM _datasette_auth_tokens_backfills
+            WHERE name = 'b002_count_tokens' AND completed_timestamp IS NULL
+            AND old.id > last_id AND old.id <= target_id
+        )
+    BEGIN
+        UPDATE _datasette_auth_tokens_counts SET count = count - 1
+        WHERE actor_id = old.actor_id AND token_status = old.token_status;
+        DELETE FROM _datasette_auth_tokens_counts
+        WHERE actor_id = old.actor_id AND token_status = old.token_status
+        AND count <= 0;
+        INSERT INTO _datasette_auth_tokens_counts (actor_id, token_status, count)
+        VALUES (new.actor_id, new.token_status, 1)
+        ON CONFLICT (actor_id, token_status) DO UPDATE SET count = count + 1;
+    END;
+    -- Archiving deletes rows, so archived tokens are no longer counted
+    CREATE TRIGGER IF NOT EXISTS _datasette_auth_tokens_counts_delete
+    AFTER DELETE ON _datasette_auth_tokens
+    WHEN NOT EXISTS (
+        SELECT 1 FROM _datasette_auth_tokens_backfills
+        WHERE name = 'b002_count_tokens' AND completed_timestamp IS NULL
+        AND old.id > last_id AND old.id <= target_id
+    )
+    BEGIN
+        UPDATE _datasette_auth_tokens_counts SET count = count - 1
+        WHERE actor_id = old.actor_id AND token_status = old.token_status;
+        DELETE FROM _datasette_auth_tokens_counts
+        WHERE actor_id = old.actor_id AND token_status = old.token_status
+        AND count <= 0;
+    END;
+    INSERT OR IGNORE INTO _datasette_auth_tokens_backfills
+        (name, last_id, target_id, rows_done, started_timestamp)
+    SELECT 'b002_count_tokens', 0, coalesce(max(id), 0), 0, strftime('%s', 'now')
+    FROM _datasette_auth_tokens;
+    """)
+
+
+@migration()
+def m012_create_usage_table(db):
+    # Approximate usage per token, merged in from the in-memory sketches
+    # in usage.py - distinct_ips holds HyperLogLog registers
+    db.executescript("""
+    CREATE TABLE IF NOT EXISTS _datasette_auth_tokens_usage (
+        token_id INTEGER PRIMARY KEY,
+        distinct_ips BLOB,
+        requests INTEGER NOT NULL DEFAULT 0,
+        requests_error INTEGER NOT NULL DEFAULT 0,
+        updated_timestamp INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_datasette_auth_tokens_usage_requests
+        ON _datasette_auth_tokens_usage (requests);
+    """)
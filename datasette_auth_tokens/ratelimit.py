@@ -0,0 +1,51 @@
+import time
+from .config import Config
+from .metrics import get_metrics
+from .utils import instance_state, LRUDict
+
+# Tokens that have not been seen recently lose their bucket - they start
+# again with a full one, which is the same as having been idle
+DEFAULT_MAX_BUCKETS = 10_000
+
+
+class TokenRateLimited(Exception):
+    def __init__(self, token_id, retry_after):
+        super().__init__("Too many requests for token {}".format(token_id))
+        self.token_id = token_id
+        self.retry_after = retry_after
+
+
+def get_rate_limiter(datasette):
+    return instance_state(
+        datasette,
+        "rate_limiter",
+        lambda: RateLimiter(
+            get_metrics(datasette),
+            Config(datasette).get("rate_limit_max_tokens") or DEFAULT_MAX_BUCKETS,
+        ),
+    )
+
+
+class RateLimiter:
+    "Token bucket per token ID, refilled continuously at per_minute / 60 a second"
+
+    def __init__(self, metrics, max_buckets=DEFAULT_MAX_BUCKETS):
+        self._metrics = metrics
+        self._buckets = LRUDict(max_buckets)
+
+    def check(self, token_id, per_minute):
+        now = time.monotonic()
+        bucket = self._buckets.get(token_id)
+        if bucket is None:
+            bucket = self._buckets[token_id] = [float(per_minute), now]
+        else:
+            bucket[0] = min(
+                float(per_minute), bucket[0] + (now - bucket[1]) * per_minute / 60
+            )
+            bucket[1] = now
+        if bucket[0] < 1:
+            self._metrics["rate_limited"] += 1
+            raise TokenRateLimited(
+                token_id, retry_after=(1 - bucket[0]) * 60 / per_minute
+            )
+        bucket[0] -= 1
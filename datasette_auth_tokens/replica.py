@@ -0,0 +1,109 @@
+import asyncio
+import time
+from collections import deque
+from .config import Config
+from .utils import instance_state, run_in_background
+
+DEFAULT_MAX_LAG_SECONDS = 5
+DEFAULT_CHECK_SECONDS = 1
+# Versions to remember per shard while the replica is behind
+MAX_PENDING = 100
+
+
+def get_replica_guard(datasette):
+    return instance_state(datasette, "replica_guard", lambda: ReplicaGuard(datasette))
+
+
+class ReplicaGuard:
+    """
+    Decides whether authentication reads can go to the read replica.
+
+    Every check_seconds the highest changed_at sequence number on the primary
+    is compared with the replica's. Each version seen on the primary has to
+    reach the replica within max_lag_seconds, otherwise reads go to the
+    primary until it does - so a token revoked on the primary stops working
+    within roughly max_lag_seconds + check_seconds. Writes made by this
+    process send reads to the primary until the replica has caught up.
+    """
+
+    def __init__(self, datasette):
+        config = Config(datasette)
+        self._datasette = datasette
+        self.max_lag_seconds = config.get("replica_max_lag_seconds")
+        if self.max_lag_seconds is None:
+            self.max_lag_seconds = DEFAULT_MAX_LAG_SECONDS
+        self.check_seconds = (
+            config.get("replica_check_seconds") or DEFAULT_CHECK_SECONDS
+        )
+        count = len(config.shards)
+        # (primary version, when it was seen) not yet on the replica
+        self._pending = [deque() for _ in range(count)]
+        self._checked_at = [0] * count
+        self._checks = [None] * count
+        # Local writes bump the generation; a check confirms it once the
+        # replica has everything the primary had. Until the first check
+        # nothing is confirmed, so reads start on the primary.
+        self._generation = [0] * count
+        self._confirmed = [-1] * count
+        # (generation, primary version the replica must reach to confirm it)
+        self._targets = [None] * count
+
+    def use_replica(self, shard):
+        now = time.monotonic()
+        if self._checks[shard] is None and (
+            now - self._checked_at[shard] > self.check_seconds
+            or self._generation[shard] != self._confirmed[shard]
+        ):
+            self._checks[shard] = run_in_background(self._run_check(shard))
+        if self._generation[shard] != self._confirmed[shard]:
+            return False
+        pending = self._pending[shard]
+        return not pending or now - pending[0][1] <= self.max_lag_seconds
+
+    def writes_happened(self):
+        # Call after this process writes to the primary
+        for shard in range(len(self._generation)):
+            self._generation[shard] += 1
+
+    async def _run_check(self, shard):
+        try:
+            await self.check(shard)
+        finally:
+            self._checks[shard] = None
+
+    async def check(self, shard):
+        config = Config(self._datasette)
+        generation = self._generation[shard]
+        sql = "select max(changed_at) from _datasette_auth_tokens"
+        try:
+            replica_result, primary_result = await asyncio.gather(
+                config.replicas[shard].execute(sql),
+                config.shards[shard].execute(sql),
+            )
+        except Exception:
+            # Replica missing or unreadable: use the primary until a check
+            # finds it has caught up
+            self._checked_at[shard] = time.monotonic()
+            self._confirmed[shard] = -1
+            return
+        replica_version = replica_result.first()[0] or 0
+        primary_version = primary_result.first()[0] or 0
+        now = time.monotonic()
+        self._checked_at[shard] = now
+        pending = self._pending[shard]
+        while pending and pending[0][0] <= replica_version:
+            pending.popleft()
+        if primary_version > replica_version:
+            if len(pending) >= MAX_PENDING:
+                # Fold into the newest entry, keeping its earlier timestamp
+                pending[-1] = (primary_version, pending[-1][1])
+            elif not pending or pending[-1][0] < primary_version:
+                pending.append((primary_version, now))
+        if self._confirmed[shard] != generation:
+            # The primary was read after those writes were committed, so
+            # once the replica reaches this version it has them too
+            target = self._targets[shard]
+            if target is None or target[0] != generation:
+                target = self._targets[shard] = (generation, primary_version)
+            if replica_version >= target[1]:
+                self._confirmed[shard] = generation
@@ -0,0 +1,49 @@
+"""
+Cheap check for whether the token tables are up to date.
+
+This reads the sqlite-migrate bookkeeping table directly so that startup
+does not need to import sqlite-utils or sqlite-migrate when there is
+nothing to do. MIGRATIONS must list every migration in migrations.py.
+"""
+
+import sqlite3
+
+MIGRATION_SET = "datasette_auth_tokens"
+MIGRATIONS = (
+    "m001_create_table",
+    "m002_rename_live_to_active",
+    "m003_add_ended_timestamp",
+    "m004_create_events_table",
+    "m005_add_changed_at",
+    "m006_add_rate_limit",
+    "m007_create_archive_table",
+    "m008_create_backfills_table",
+    "m009_create_version_table",
+    "m010_create_search_index",
+    "m011_create_counts_table",
+    "m012_create_usage_table",
+)
+
+
+def pending_migrations(conn):
+    "Names of migrations that have not yet been applied to this connection"
+    try:
+        applied = {
+            row[0]
+            for row in conn.execute(
+                "select name from _sqlite_migrations where migration_set = ?",
+                (MIGRATION_SET,),
+            )
+        }
+    except sqlite3.OperationalError:
+        # No migrations table yet
+        return list(MIGRATIONS)
+    return [name for name in MIGRATIONS if name not in applied]
+
+
+def migrate(conn):
+    # Runs on the write connection, only once pending_migrations() says so
+    import sqlite_utils
+    from .migrations import migration
+
+    migration.apply(sqlite_utils.Database(conn))
@@ -0,0 +1,106 @@
+import io
+import random
+import time
+from collections import deque
+from .config import Config
+from .metrics import get_metrics
+from .timing import current_timing, start_timing, stop_timing
+from .utils import instance_state
+
+DEFAULT_LOG_SIZE = 100
+# Functions to include in each profile summary
+PROFILE_LINES = 20
+
+# cProfile can only run one profiler per thread at a time
+_profiling = False
+
+
+def get_slow_auth_log(datasette):
+    return instance_state(datasette, "slow_auth_log", lambda: SlowAuthLog(datasette))
+
+
+class SlowAuthLog:
+    """
+    Remembers the most recent actor_from_request calls that took longer
+    than slow_auth_ms, with their stage breakdown, in a fixed-size buffer.
+
+    With slow_auth_profile_rate set, that fraction of calls is run under
+    cProfile, and the summary is kept if the call turns out to be slow.
+    The profiler sees everything the event loop runs while the call is
+    waiting, so other requests can show up in the summary too.
+    """
+
+    def __init__(self, datasette):
+        config = Config(datasette)
+        self._datasette = datasette
+        self.threshold_ms = config.get("slow_auth_ms")
+        self.profile_rate = config.get("slow_auth_profile_rate") or 0
+        self.entries = deque(
+            maxlen=config.get("slow_auth_log_size") or DEFAULT_LOG_SIZE
+        )
+
+    async def observe(self, coroutine):
+        "Awaits an authentication coroutine, logging it if it is slow"
+        timing = current_timing()
+        reset_token = None
+        if timing is None:
+            timing, reset_token = start_timing()
+        profiler = self._start_profiler()
+        start = time.perf_counter()
+        try:
+            return await coroutine
+        finally:
+            duration = timing.total = time.perf_counter() - start
+            if profiler is not None:
+                self._stop_profiler(profiler)
+            if reset_token is not None:
+                stop_timing(reset_token)
+            if duration * 1000 >= self.threshold_ms:
+                self.record(timing, duration, profiler)
+
+    def record(self, timing, duration, profiler=None):
+        entry = {
+            "timestamp": time.time(),
+            "duration_ms": round(duration * 1000, 3),
+            "backend": timing.backend,
+            "token_id": timing.token_id,
+            "cache": timing.cache,
+            "database_ms": round(timing.database * 1000, 3),
+            "stages": {
+                name: round(seconds * 1000, 3)
+                for name, seconds in timing.stages.items()
+            },
+        }
+        if profiler is not None:
+            entry["profile"] = _profile_summary(profiler)
+        self.entries.append(entry)
+        get_metrics(self._datasette)["slow_authentications"] += 1
+
+    def _start_profiler(self):
+        global _profiling
+        if _profiling or not self.profile_rate or random.random() >= self.profile_rate:
+            return None
+        import cProfile
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Some other profiler is already running
+            return None
+        _profiling = True
+        return profiler
+
+    def _stop_profiler(self, profiler):
+        global _profiling
+        profiler.disable()
+        _profiling = False
+
+
+def _profile_summary(profiler):
+    import pstats
+
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats("cumulative").print_stats(PROFILE_LINES)
+    return stream.getvalue()
@@ -0,0 +1,267 @@
+"""
+Binary snapshot of active tokens, shared between worker processes.
+
+One worker writes the file and atomically swaps it into place; every worker
+memory-maps it and binary searches the sorted token IDs, so the pages are
+shared through the OS page cache rather than copied into each process.
+
+File layout, all integers little-endian:
+
+    header      magic, format version, count, shard count, changed_at version
+    max ids     shard count x int64, the highest token ID in each shard
+    ids         count x int64, sorted
+    deadlines   count x int64, expiry timestamp or 0 for never
+    rate limits count x int64, requests per minute or 0 for unlimited
+    strings     count x (actor offset, actor length,
+                         permissions offset, permissions length) as uint32
+    blob        UTF-8 JSON for actors and permissions, referenced by offset
+"""
+
+import asyncio
+import bisect
+import json
+import mmap
+import os
+import struct
+import tempfile
+from .config import Config, shard_index_for_token
+from .utils import instance_state, run_in_background
+
+MAGIC = b"DSATOKS\x00"
+FORMAT_VERSION = 3
+HEADER = struct.Struct("<8sIIIq")
+STRINGS = struct.Struct("<IIII")
+
+
+class SnapshotFormatError(Exception):
+    pass
+
+
+def get_snapshot_reader(datasette):
+    return instance_state(
+        datasette,
+        "snapshot_reader",
+        lambda: SnapshotReader(Config(datasette).get("snapshot_path")),
+    )
+
+
+def get_snapshot_writer(datasette):
+    return instance_state(
+        datasette, "snapshot_writer", lambda: SnapshotWriter(datasette)
+    )
+
+
+def write_snapshot(path, rows, max_ids, version):
+    """
+    rows is an iterable of
+    (id, actor_id, permissions_json, deadline, rate_limit_per_minute) tuples,
+    max_ids the highest token ID in each shard
+    """
+    rows = sorted(rows)
+    blob = bytearray()
+    offsets = {}
+
+    def add_string(value):
+        # Identical strings, e.g. shared restrictions, are only stored once
+        if value not in offsets:
+            encoded = value.encode("utf-8")
+            offsets[value] = (len(blob), len(encoded))
+            blob.extend(encoded)
+        return offsets[value]
+
+    ids = bytearray()
+    deadlines = bytearray()
+    rate_limits = bytearray()
+    strings = bytearray()
+    for token_id, actor_id, permissions, deadline, rate_limit in rows:
+        ids += struct.pack("<q", token_id)
+        deadlines += struct.pack("<q", deadline or 0)
+        rate_limits += struct.pack("<q", rate_limit or 0)
+        strings += STRINGS.pack(
+            *add_string(json.dumps(actor_id)), *add_string(permissions or "null")
+        )
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".dsatok-snapshot-")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(
+                HEADER.pack(MAGIC, FORMAT_VERSION, len(rows), len(max_ids), version)
+            )
+            fp.write(struct.pack("<{}q".format(len(max_ids)), *max_ids))
+            fp.write(ids)
+            fp.write(deadlines)
+            fp.write(rate_limits)
+            fp.write(strings)
+            fp.write(blob)
+            fp.flush()
+            os.fsync(fp.fileno())
+        # Readers either see the old file or the new one, never a mix
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class Snapshot:
+    def __init__(self, path):
+        with open(path, "rb") as fp:
+            self.stat = os.fstat(fp.fileno())
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, format_version, count, shard_count, self.version = HEADER.unpack_from(
+            self._mmap
+        )
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            self._mmap.close()
+            raise SnapshotFormatError(
+                "{} is not a version {} token snapshot".format(path, FORMAT_VERSION)
+            )
+        self.count = count
+        self.max_ids = struct.unpack_from(
+            "<{}q".format(shard_count), self._mmap, HEADER.size
+        )
+        view = memoryview(self._mmap)
+        start = HEADER.size + shard_count * 8
+        self._ids = view[start : start + count * 8].cast("q")
+        start += count * 8
+        self._deadlines = view[start : start + count * 8].cast("q")
+        start += count * 8
+        self._rate_limits = view[start : start + count * 8].cast("q")
+        start += count * 8
+        self._strings_start = start
+        self._blob_start = start + count * STRINGS.size
+        self._view = view
+
+    def covers(self, token_id):
+        "False for tokens created in their shard since the snapshot was written"
+        shard = shard_index_for_token(token_id, len(self.max_ids))
+        return token_id <= self.max_ids[shard]
+
+    def lookup(self, token_id):
+        "Returns (actor_id, permissions, deadline, rate_limit) or None if not active"
+        i = bisect.bisect_left(self._ids, token_id)
+        if i == self.count or self._ids[i] != token_id:
+            return None
+        actor_offset, actor_length, permissions_offset, permissions_length = (
+            STRINGS.unpack_from(self._mmap, self._strings_start + i * STRINGS.size)
+        )
+        return (
+            json.loads(self._string(actor_offset, actor_length)),
+            json.loads(self._string(permissions_offset, permissions_length)),
+            self._deadlines[i] or None,
+            self._rate_limits[i] or None,
+        )
+
+    def _string(self, offset, length):
+        start = self._blob_start + offset
+        return bytes(self._mmap[start : start + length])
+
+    def close(self):
+        for view in (self._ids, self._deadlines, self._rate_limits, self._view):
+            view.release()
+        self._mmap.close()
+
+
+class SnapshotReader:
+    "Keeps the most recent snapshot mapped, remapping when the file is replaced"
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshot = None
+
+    def current(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        if self.snapshot is None or (stat.st_ino, stat.st_mtime_ns) != (
+            self.snapshot.stat.st_ino,
+            self.snapshot.stat.st_mtime_ns,
+        ):
+            previous = self.snapshot
+            try:
+                self.snapshot = Snapshot(self.path)
+            except SnapshotFormatError:
+                # Written by an older version - the database will be used
+                # until it is replaced
+                return None
+            if previous is not None:
+                previous.close()
+        return self.snapshot
+
+
+class SnapshotWriter:
+    """
+    Exports active tokens after this process changes them. Changes that
+    arrive while an export is running are coalesced into one more export.
+
+    Tokens this process revoked or expired are held in ended until an
+    export started after the change has replaced the file, so lookups never
+    serve them from the older snapshot in the meantime.
+    """
+
+    def __init__(self, datasette):
+        self._datasette = datasette
+        self._dirty = False
+        self._task = None
+        self.ended = set()
+
+    def schedule(self, ended_ids=()):
+        self.ended.update(ended_ids)
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = run_in_background(self._run())
+
+    async def wait(self):
+        while self._task is not None and not self._task.done():
+            await asyncio.shield(self._task)
+
+    async def _run(self):
+        while self._dirty:
+            self._dirty = False
+            await self.export()
+
+    async def export(self):
+        config = Config(self._datasette)
+        path = config.get("snapshot_path")
+        # Anything ended before the rows are read is reflected in this export
+        ended = set(self.ended)
+        results = await asyncio.gather(
+            *(db.execute_fn(read_snapshot_rows) for db in config.shards)
+        )
+        await asyncio.get_running_loop().run_in_executor(
+            None, write_shards_snapshot, path, results
+        )
+        self.ended -= ended
+
+
+def read_snapshot_rows(conn):
+    "Returns (rows, max_id, version) for write_shards_snapshot()"
+    version, max_id = conn.execute(
+        "select max(changed_at), max(id) from _datasette_auth_tokens"
+    ).fetchone()
+    rows = [
+        (
+            row[0],
+            row[1],
+            row[2],
+            row[3] + row[4] if row[4] else None,
+            row[5],
+        )
+        for row in conn.execute("""
+            select id, actor_id, permissions,
+            created_timestamp, expires_after_seconds, rate_limit_per_minute
+            from _datasette_auth_tokens where token_status = 'A'
+        """)
+    ]
+    return rows, max_id or 0, version or 0
+
+
+def write_shards_snapshot(path, results):
+    "Writes a snapshot from read_snapshot_rows() for each shard"
+    rows = [row for shard_rows, _, _ in results for row in shard_rows]
+    # IDs only increase within a shard, so each shard's maximum says which
+    # of its IDs the snapshot covers
+    max_ids = [max_id for _, max_id, _ in results]
+    version = sum(version for _, _, version in results)
+    write_snapshot(path, rows, max_ids, version)
@@ -0,0 +1,617 @@
+"""
+Where managed tokens are kept, selected with the storage setting.
+
+Everything that reads or writes token records goes through a TokenStorage.
+The default keeps them in SQLite, in the _datasette_auth_tokens table.
+"memory" keeps them in a dictionary for tests and benchmarks, and "kv"
+keeps them in a local dbm file, standing in for a networked key-value
+store. Other backends can be used by giving "package.module:ClassName".
+
+Token records are dictionaries with the columns of _datasette_auth_tokens,
+with permissions as a JSON string.
+"""
+
+from collections import Counter
+from datasette.utils import StartupError, escape_fts
+import asyncio
+import heapq
+import importlib
+import json
+import time
+from .config import Config
+from .utils import instance_state
+
+STORAGE_BACKENDS = {
+    "sqlite": "datasette_auth_tokens.storage:SQLiteStorage",
+    "memory": "datasette_auth_tokens.storage:MemoryStorage",
+    "kv": "datasette_auth_tokens.storage:KeyValueStorage",
+}
+# Features that read the SQLite tables directly
+SQLITE_ONLY_SETTINGS = (
+    "manage_tokens_database",
+    "manage_tokens_path",
+    "manage_tokens_shards",
+    "manage_tokens_replica_path",
+    "memory_index",
+    "snapshot_path",
+    "archive_after_days",
+)
+
+
+def get_storage(datasette):
+    return instance_state(datasette, "storage", lambda: _make_storage(datasette))
+
+
+def _make_storage(datasette):
+    config = Config(datasette)
+    name = config.get("storage") or "sqlite"
+    module_name, _, class_name = STORAGE_BACKENDS.get(name, name).partition(":")
+    try:
+        storage_class = getattr(importlib.import_module(module_name), class_name)
+    except (ImportError, AttributeError, ValueError):
+        raise StartupError("Unknown token storage: {}".format(name))
+    if not storage_class.sqlite:
+        in_use = [setting for setting in SQLITE_ONLY_SETTINGS if config.get(setting)]
+        if in_use:
+            raise StartupError(
+                "{} can only be used with sqlite token storage".format(
+                    ", ".join(in_use)
+                )
+            )
+    return storage_class(datasette)
+
+
+def new_record(
+    actor_id, permissions, description, expires_after_seconds, rate_limit_per_minute
+):
+    "Record for a token about to be created, without its id"
+    return {
+        "secret_version": 0,
+        "description": description,
+        "permissions": json.dumps(permissions),
+        "actor_id": actor_id,
+        "created_timestamp": int(time.time()),
+        "last_used_timestamp": None,
+        "expires_after_seconds": expires_after_seconds,
+        "token_status": "A",
+        "ended_timestamp": None,
+        "rate_limit_per_minute": rate_limit_per_minute,
+    }
+
+
+class TokenStorage:
+    "The operations every token storage backend provides"
+
+    # True if the SQLite-only features can read the tokens table directly
+    sqlite = False
+
+    def __init__(self, datasette):
+        self._datasette = datasette
+
+    async def lookup(self, token_id, include_archived=False):
+        "The token's record, or None"
+        return (await self.lookup_many([token_id], include_archived)).get(token_id)
+
+    async def lookup_many(self, token_ids, include_archived=False):
+        "Records for whichever of token_ids exist, as {id: record}"
+        raise NotImplementedError
+
+    async def create(
+        self,
+        actor_id,
+        permissions=None,
+        description=None,
+        expires_after_seconds=None,
+        rate_limit_per_minute=None,
+    ):
+        "Stores a new active token, returning its record"
+        raise NotImplementedError
+
+    async def revoke(self, actor_id=None, token_ids=None):
+        "Revokes the active tokens matching every filter, returning their updated records"
+        raise NotImplementedError
+
+    async def expire(self, token_id=None):
+        """
+        Expires the active tokens that are due - or just this one - returning
+        their updated records
+        """
+        raise NotImplementedError
+
+    async def list(self, actor_id=None, q=None, next=None, limit=None):
+        """
+        A page of tokens, newest first or best match first when searching
+        with q, as (records, next) - pass next back to get the next page
+        """
+        raise NotImplementedError
+
+    async def touch(self, token_id, now):
+        "Records that the token was used at timestamp now"
+        raise NotImplementedError
+
+    async def counts(self, actor_id=None):
+        'Returns {"active": n, "revoked": n, "expired": n}'
+        raise NotImplementedError
+
+    async def listing_version(self, actor_id=None):
+        """
+        (version, next expiry deadline) for the tokens list() would return,
+        where version changes whenever they do. None if this is not cheap
+        to find out, in which case listings are never cached.
+        """
+        return None
+
+
+class SQLiteStorage(TokenStorage):
+    """
+    Tokens in the _datasette_auth_tokens table, sharded and replicated
+    according to the manage_tokens_* settings. Archived tokens are only
+    looked up on the primary.
+    """
+
+    sqlite = True
+
+    async def lookup(self, token_id, include_archived=False):
+        config = Config(self._datasette)
+        if include_archived:
+            # The archive is only checked if the token is not in the main table
+            db = config.shard_for_token(token_id)
+            for table in ("_datasette_auth_tokens", "_datasette_auth_tokens_archive"):
+                row = (
+                    await db.execute(
+                        "select * from {} where id = ?".format(table), (token_id,)
+                    )
+                ).first()
+                if row is not None:
+                    return dict(row)
+            return None
+        row = (
+            await config.read_db_for_token(token_id).execute(
+                "select * from _datasette_auth_tokens where id=:token_id",
+                {"token_id": token_id},
+            )
+        ).first()
+        return dict(row) if row else None
+
+    async def lookup_many(self, token_ids, include_archived=False):
+        # A single query per shard and table
+        config = Config(self._datasette)
+        tables = ["_datasette_auth_tokens"]
+        if include_archived:
+            tables.append("_datasette_auth_tokens_archive")
+        by_shard = {}
+        for token_id in sorted(set(token_ids)):
+            db = (
+                config.shard_for_token(token_id)
+                if include_archived
+                else config.read_db_for_token(token_id)
+            )
+            by_shard.setdefault(db, []).append(token_id)
+        results = await asyncio.gather(
+            *(
+                db.execute(
+                    "select * from {} where id in ({})".format(
+                        table, ", ".join("?" for _ in ids)
+                    ),
+                    ids,
+                )
+                for db, ids in by_shard.items()
+                for table in tables
+            )
+        )
+        found = {}
+        for row in (row for result in results for row in result.rows):
+            found.setdefault(row["id"], dict(row))
+        return found
+
+    async def create(
+        self,
+        actor_id,
+        permissions=None,
+        description=None,
+        expires_after_seconds=None,
+        rate_limit_per_minute=None,
+    ):
+        config = Config(self._datasette)
+        shard = config.shard_index_for_actor(actor_id)
+        record = new_record(
+            actor_id,
+            permissions,
+            description,
+            expires_after_seconds,
+            rate_limit_per_minute,
+        )
+        cursor = await config.shards[shard].execute_write(
+            """
+            insert into _datasette_auth_tokens
+            (id, secret_version, description, permissions, actor_id, created_timestamp, expires_after_seconds, rate_limit_per_minute)
+            values
+            (
+                -- IDs are interleaved across shards: the next one for this shard
+                (select coalesce(max(id), :shard + 1 - :shard_count) + :shard_count from _datasette_auth_tokens),
+                :secret_version, :description, :permissions, :actor_id, :created_timestamp, :expires_after_seconds, :rate_limit_per_minute
+            )
+        """,
+            dict(record, shard=shard, shard_count=len(config.shards)),
+        )
+        return dict(record, id=cursor.lastrowid)
+
+    async def revoke(self, actor_id=None, token_ids=None):
+        from . import make_revoke_function
+
+        # Each shard that could hold a match is updated in parallel
+        config = Config(self._datasette)
+        if token_ids is not None:
+            by_shard = {}
+            for token_id in token_ids:
+                by_shard.setdefault(config.shard_for_token(token_id), []).append(
+                    token_id
+                )
+            jobs = [
+                db.execute_write_fn(make_revoke_function(actor_id, ids))
+                for db, ids in by_shard.items()
+            ]
+        else:
+            shards = config.shards
+            if actor_id is not None:
+                shards = [shards[config.shard_index_for_actor(actor_id)]]
+            jobs = [
+                db.execute_write_fn(make_revoke_function(actor_id)) for db in shards
+            ]
+        # Each shard returns its updated rows using UPDATE ... RETURNING
+        return sorted(
+            (record for records in await asyncio.gather(*jobs) for record in records),
+            key=lambda record: record["id"],
+        )
+
+    async def expire(self, token_id=None):
+        from . import make_expire_function
+
+        config = Config(self._datasette)
+        if token_id is not None:
+            # On every authentication, so skip gathering a single shard
+            return await config.shard_for_token(token_id).execute_write_fn(
+                make_expire_function(token_id)
+            )
+        expired = await asyncio.gather(
+            *(db.execute_write_fn(make_expire_function()) for db in config.shards)
+        )
+        return [record for records in expired for record in records]
+
+    async def list(self, actor_id=None, q=None, next=None, limit=None):
+        config = Config(self._datasette)
+        where_bits = []
+        params = {}
+        # A query of nothing but quotes escapes to '', which fts5 rejects,
+        # so it lists every token instead
+        q = escape_fts(q) if q else None
+        if q:
+            # Ranked search, paginated on (rank, id)
+            where_bits.append("_datasette_auth_tokens_fts match :q")
+            params["q"] = q
+            if next:
+                try:
+                    rank, id = next.rsplit(":", 1)
+                    params["rank"], params["next"] = float(rank), int(id)
+                except ValueError:
+                    raise ValueError("Invalid next parameter")
+                where_bits.append(
+                    "(fts.rank > :rank or (fts.rank = :rank and t.id >= :next))"
+                )
+        elif next:
+            where_bits.append("t.id <= :next")
+            params["next"] = next
+        shards = self._shards_for_actor(actor_id)
+        if actor_id is not None:
+            where_bits.append("t.actor_id = :actor_id")
+            params["actor_id"] = actor_id
+        where = " and ".join(where_bits)
+        # One extra row shows whether there is another page
+        sql_limit = -1 if limit is None else limit + 1
+        if q:
+            sql = """
+                select t.*, fts.rank as search_rank
+                from _datasette_auth_tokens_fts fts
+                join _datasette_auth_tokens t on t.id = fts.rowid
+                where {where} order by fts.rank, t.id limit {limit}
+            """
+        else:
+            sql = """
+                select * from _datasette_auth_tokens t
+                {where} order by t.id desc limit {limit}
+            """
+            where = "where {}".format(where) if where else ""
+        sql = sql.format(where=where, limit=sql_limit)
+        # Query shards in parallel, then merge their pages
+        results = await asyncio.gather(
+            *(config.read_db(shard).execute(sql, params) for shard in shards)
+        )
+        rows = [dict(row) for result in results for row in result.rows]
+        if q:
+            rows.sort(key=lambda token: (token["search_rank"], token["id"]))
+        else:
+            rows.sort(key=lambda token: token["id"], reverse=True)
+        next = None
+        if limit is not None and len(rows) > limit:
+            if q:
+                next = "{}:{}".format(rows[limit]["search_rank"], rows[limit]["id"])
+            else:
+                next = rows[limit]["id"]
+            rows = rows[:limit]
+        for row in rows:
+            row.pop("search_rank", None)
+        return rows, next
+
+    async def touch(self, token_id, now):
+        await (
+            Config(self._datasette)
+            .shard_for_token(token_id)
+            .execute_write(
+                "update _datasette_auth_tokens set last_used_timestamp=:now where id=:token_id",
+                {"now": now, "token_id": token_id},
+            )
+        )
+
+    async def counts(self, actor_id=None):
+        from .counts import get_token_counts
+
+        return await get_token_counts(self._datasette, actor_id)
+
+    async def listing_version(self, actor_id=None):
+        config = Config(self._datasette)
+        versions = await asyncio.gather(
+            *(
+                config.read_db(shard).execute_fn(_listing_version)
+                for shard in self._shards_for_actor(actor_id)
+            )
+        )
+        deadlines = [deadline for _, deadline in versions if deadline is not None]
+        return (
+            [version for version, _ in versions],
+            min(deadlines) if deadlines else None,
+        )
+
+    def _shards_for_actor(self, actor_id):
+        config = Config(self._datasette)
+        if actor_id is None:
+            return range(len(config.shards))
+        # An actor's tokens all live in the same shard
+        return [config.shard_index_for_actor(actor_id)]
+
+
+def _listing_version(conn):
+    # Both of these are single index lookups, however many tokens there are
+    version = conn.execute(
+        "select version from _datasette_auth_tokens_version"
+    ).fetchone()[0]
+    next_deadline = conn.execute("""
+        select min(created_timestamp + expires_after_seconds)
+        from _datasette_auth_tokens
+        where token_status = 'A' and expires_after_seconds is not null
+        """).fetchone()[0]
+    return version, next_deadline
+
+
+class MemoryStorage(TokenStorage):
+    """
+    Tokens in a dictionary, lost when the process exits.
+
+    Each operation runs to completion without awaiting anything, so the
+    event loop never interleaves two of them and no locks are needed.
+    Subclasses that do block run each operation through _run().
+    """
+
+    def __init__(self, datasette):
+        super().__init__(datasette)
+        self._tokens = {}
+        self._next_id = 1
+
+    async def _run(self, fn, *args):
+        return fn(*args)
+
+    # Primitives subclasses can override to keep the records elsewhere
+
+    def _get(self, token_id):
+        return self._tokens.get(token_id)
+
+    def _put(self, record):
+        self._tokens[record["id"]] = record
+
+    def _records(self):
+        return list(self._tokens.values())
+
+    def _allocate_id(self):
+        token_id = self._next_id
+        self._next_id += 1
+        return token_id
+
+    # Operations, each run as a single unit by _run()
+
+    async def lookup_many(self, token_ids, include_archived=False):
+        return await self._run(self._lookup_many, token_ids)
+
+    def _lookup_many(self, token_ids):
+        found = {}
+        for token_id in token_ids:
+            record = self._get(token_id)
+            if record is not None:
+                found[token_id] = dict(record)
+        return found
+
+    async def create(
+        self,
+        actor_id,
+        permissions=None,
+        description=None,
+        expires_after_seconds=None,
+        rate_limit_per_minute=None,
+    ):
+        record = new_record(
+            actor_id,
+            permissions,
+            description,
+            expires_after_seconds,
+            rate_limit_per_minute,
+        )
+        return await self._run(self._create, record)
+
+    def _create(self, record):
+        record = dict(record, id=self._allocate_id())
+        self._put(record)
+        return dict(record)
+
+    async def revoke(self, actor_id=None, token_ids=None):
+        return await self._run(self._revoke, actor_id, token_ids, int(time.time()))
+
+    def _revoke(self, actor_id, token_ids, now):
+        if token_ids is not None:
+            records = [self._get(token_id) for token_id in token_ids]
+        else:
+            records = self._records()
+        return self._end(
+            (
+                record
+                for record in records
+                if record is not None
+                and (actor_id is None or record["actor_id"] == actor_id)
+            ),
+            "R",
+            now,
+        )
+
+    async def expire(self, token_id=None):
+        return await self._run(self._expire, token_id, int(time.time()))
+
+    def _expire(self, token_id, now):
+        records = self._records() if token_id is None else [self._get(token_id)]
+        return self._end(
+            (
+                record
+                for record in records
+                if record is not None
+                and record["expires_after_seconds"]
+                and record["created_timestamp"] + record["expires_after_seconds"] < now
+            ),
+            "E",
+            now,
+        )
+
+    def _end(self, records, token_status, now):
+        ended = []
+        for record in records:
+            if record["token_status"] == "A":
+                record = dict(record, token_status=token_status, ended_timestamp=now)
+                self._put(record)
+                ended.append(dict(record))
+        return sorted(ended, key=lambda record: record["id"])
+
+    async def list(self, actor_id=None, q=None, next=None, limit=None):
+        if next is not None:
+            try:
+                next = int(next)
+            except ValueError:
+                raise ValueError("Invalid next parameter")
+        return await self._run(self._list, actor_id, q, next, limit)
+
+    def _list(self, actor_id, q, next, limit):
+        words = (q or "").lower().split()
+        matches = (
+            record
+            for record in self._records()
+            if (actor_id is None or record["actor_id"] == actor_id)
+            and (next is None or record["id"] <= next)
+            and all(
+                word
+                in "{} {}".format(
+                    record["description"] or "", record["actor_id"]
+                ).lower()
+                for word in words
+            )
+        )
+        if limit is None:
+            records = sorted(matches, key=lambda record: record["id"], reverse=True)
+        else:
+            records = heapq.nlargest(
+                limit + 1, matches, key=lambda record: record["id"]
+            )
+        next = None
+        if limit is not None and len(records) > limit:
+            next = records[limit]["id"]
+            records = records[:limit]
+        return [dict(record) for record in records], next
+
+    async def touch(self, token_id, now):
+        await self._run(self._touch, token_id, now)
+
+    def _touch(self, token_id, now):
+        record = self._get(token_id)
+        if record is not None:
+            self._put(dict(record, last_used_timestamp=now))
+
+    async def counts(self, actor_id=None):
+        return await self._run(self._counts, actor_id)
+
+    def _counts(self, actor_id):
+        from .counts import _summarize
+
+        return _summarize(
+            Counter(
+                record["token_status"]
+                for record in self._records()
+                if actor_id is None or record["actor_id"] == actor_id
+            ).items()
+        )
+
+
+class KeyValueStorage(MemoryStorage):
+    """
+    Tokens in a dbm file at storage_path, one JSON value per token.
+
+    This stands in for a networked key-value store: operations are run one
+    at a time on a single worker thread, so each one is atomic without
+    holding up the event loop, and anything beyond a get or put by key
+    has to scan every token.
+    """
+
+    def __init__(self, datasette):
+        from concurrent.futures import ThreadPoolExecutor
+        import dbm
+
+        super().__init__(datasette)
+        path = Config(datasette).get("storage_path")
+        if not path:
+            raise StartupError("kv token storage needs storage_path")
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="datasette-auth-tokens-kv"
+        )
+        # Opened on the worker thread: dbm.sqlite3, the default from Python
+        # 3.13, can only be used from the thread that opened it
+        self._db = self._executor.submit(dbm.open, path, "c").result()
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, fn, *args
+        )
+
+    def _get(self, token_id):
+        value = self._db.get("token:{}".format(token_id))
+        return None if value is None else json.loads(value)
+
+    def _put(self, record):
+        self._db["token:{}".format(record["id"])] = json.dumps(record)
+        # dbm.sqlite3 and dbm.ndbm write through, and have no sync()
+        sync = getattr(self._db, "sync", None)
+        if sync is not None:
+            sync()
+
+    def _records(self):
+        return [
+            json.loads(self._db[key])
+            for key in self._db.keys()
+            if key.startswith(b"token:")
+        ]
+
+    def _allocate_id(self):
+        token_id = int(self._db.get("next_id", b"1"))
+        self._db["next_id"] = str(token_id + 1)
+        return token_id
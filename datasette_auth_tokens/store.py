@@ -0,0 +1,86 @@
+from concurrent import futures
+from datasette.database import Database
+import asyncio
+import sqlite3
+import threading
+
+DEFAULT_CACHE_SIZE_KB = 8000
+DEFAULT_MMAP_SIZE = 64 * 1024 * 1024
+DEFAULT_READ_CONNECTIONS = 3
+
+
+class TokenStoreDatabase(Database):
+    """
+    Dedicated SQLite file for token bookkeeping, so token lookups and writes
+    do not compete with everything else that uses the internal database.
+
+    The file is kept in WAL mode so reads never wait for the writer. Reads
+    run on a small pool of threads owned by this database, each with its own
+    read-only connection, while writes go through Datasette's usual single
+    write thread.
+
+    With read_only=True the file is a replica written by something else, so
+    it is never modified and only the read pool is used.
+    """
+
+    def __init__(
+        self,
+        ds,
+        path,
+        cache_size_kb=DEFAULT_CACHE_SIZE_KB,
+        mmap_size=DEFAULT_MMAP_SIZE,
+        read_connections=DEFAULT_READ_CONNECTIONS,
+        name="_datasette_auth_tokens",
+        read_only=False,
+    ):
+        super().__init__(ds, path=path, is_mutable=True)
+        self.name = name
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self._read_executor = futures.ThreadPoolExecutor(
+            max_workers=read_connections,
+            thread_name_prefix="datasette-auth-tokens-read",
+        )
+        self._read_connections = threading.local()
+        if not read_only:
+            self._initialize()
+
+    def _initialize(self):
+        # WAL mode is persistent, so it only needs setting once per file. It
+        # has to happen before any read-only connections are opened.
+        conn = sqlite3.connect(self.path)
+        try:
+            if not conn.execute("select count(*) from sqlite_master").fetchone()[0]:
+                # Brand new file: allow space to be reclaimed incrementally
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+        finally:
+            conn.close()
+
+    def connect(self, write=False):
+        conn = super().connect(write=write)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-{}".format(int(self.cache_size_kb)))
+        conn.execute("PRAGMA mmap_size={}".format(int(self.mmap_size)))
+        return conn
+
+    async def execute_fn(self, fn):
+        if self.ds.executor is None:
+            # non-threaded mode
+            return await super().execute_fn(fn)
+
+        def in_thread():
+            conn = getattr(self._read_connections, "conn", None)
+            if not conn:
+                conn = self.connect()
+                self.ds._prepare_connection(conn, self.name)
+                self._read_connections.conn = conn
+            return fn(conn)
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self._read_executor, in_thread
+        )
+
+    def close(self):
+        self._read_executor.shutdown(wait=False)
+        super().close()
@@ -0,0 +1,109 @@
+"""
+Stage timings for a single actor_from_request call.
+
+Code on the authentication path marks its stages with stage(), which costs
+one context variable lookup unless something - the slow authentication log
+or the Server-Timing header - has started timing the current request.
+"""
+
+import contextvars
+import time
+
+_current = contextvars.ContextVar("datasette_auth_tokens_timing", default=None)
+
+
+class AuthTiming:
+    "Where the time went while authenticating one request, in seconds"
+
+    __slots__ = ("backend", "token_id", "cache", "stages", "database", "total")
+
+    def __init__(self):
+        # "tokens", "query" or "manage_tokens"
+        self.backend = None
+        self.token_id = None
+        # "hit", "miss" or "stale" when a cache was consulted
+        self.cache = None
+        self.stages = {}
+        # Total of the stages spent waiting on the database
+        self.database = 0.0
+        # The whole of actor_from_request, once it has finished
+        self.total = None
+
+    def add(self, name, seconds, database=False):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        if database:
+            self.database += seconds
+
+
+def current_timing():
+    return _current.get()
+
+
+def start_timing():
+    "Times the rest of this request, returns (timing, token for stop_timing)"
+    timing = AuthTiming()
+    return timing, _current.set(timing)
+
+
+def stop_timing(token):
+    _current.reset(token)
+
+
+def annotate(**values):
+    "Sets backend, token_id or cache on the current timing, if there is one"
+    timing = _current.get()
+    if timing is not None:
+        for key, value in values.items():
+            setattr(timing, key, value)
+
+
+def server_timing_header(timing):
+    "Server-Timing header value, with durations in milliseconds"
+    metrics = [
+        'auth;dur={:.3f};desc="{}"'.format((timing.total or 0) * 1000, timing.backend)
+    ]
+    metrics.extend(
+        "auth-{};dur={:.3f}".format(name.replace("_", "-"), seconds * 1000)
+        for name, seconds in timing.stages.items()
+    )
+    if timing.database:
+        metrics.append("auth-db;dur={:.3f}".format(timing.database * 1000))
+    if timing.cache:
+        metrics.append("auth-cache;desc={}".format(timing.cache))
+    return ", ".join(metrics)
+
+
+def stage(name, database=False):
+    "Context manager adding the time spent inside it to the named stage"
+    timing = _current.get()
+    if timing is None:
+        return _NO_STAGE
+    return _Stage(timing, name, database)
+
+
+class _Stage:
+    __slots__ = ("timing", "name", "database", "start")
+
+    def __init__(self, timing, name, database):
+        self.timing = timing
+        self.name = name
+        self.database = database
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timing.add(self.name, time.perf_counter() - self.start, self.database)
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_STAGE = _NoStage()
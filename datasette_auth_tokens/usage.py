@@ -0,0 +1,256 @@
+"""
+Approximate per-token usage: how many distinct client IPs each token has
+been used from, and which tokens make the most requests.
+
+Both are probabilistic sketches held in fixed memory - a HyperLogLog per
+token for distinct IPs, and a single Space-Saving summary of the heaviest
+tokens. They are merged into the _datasette_auth_tokens_usage table every
+usage_persist_seconds and then started afresh, so the memory used depends
+on the settings rather than on traffic.
+"""
+
+import asyncio
+import hashlib
+import math
+import time
+from .config import Config
+from .metrics import get_metrics
+from .utils import instance_state, run_in_background
+
+# 2 ** 10 one-byte registers per token, a standard error of about 3.25%
+HLL_PRECISION = 10
+DEFAULT_TOP_K = 100
+DEFAULT_MAX_TOKENS = 1_000
+DEFAULT_PERSIST_SECONDS = 60
+
+
+def get_usage_sketches(datasette):
+    return instance_state(datasette, "usage_sketches", lambda: UsageSketches(datasette))
+
+
+async def run_usage_persister(datasette):
+    # Background task started by the startup hook
+    sketches = get_usage_sketches(datasette)
+    while True:
+        await asyncio.sleep(sketches.persist_seconds)
+        await sketches.persist()
+
+
+class HyperLogLog:
+    "Estimates the number of distinct values added, in 2 ** precision bytes"
+
+    __slots__ = ("precision", "registers")
+
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.registers = bytearray(registers or (1 << precision))
+
+    def add(self, value):
+        hashed = int.from_bytes(
+            hashlib.blake2b(value.encode(), digest_size=8).digest(), "big"
+        )
+        index = hashed >> (64 - self.precision)
+        # Position of the first set bit in what is left of the hash
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, registers):
+        "Combines the registers of another sketch into this one"
+        self.registers = bytearray(map(max, self.registers, registers))
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0**-register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small numbers of values
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+
+class SpaceSaving:
+    """
+    The k most frequent keys, using k counters. Each count may overstate
+    the true number by up to its error, and any key with more than
+    1/k of the total is guaranteed to be present.
+    """
+
+    def __init__(self, k=DEFAULT_TOP_K):
+        self.k = k
+        # key -> [count, error]
+        self.counters = {}
+
+    def add(self, key):
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += 1
+        elif len(self.counters) < self.k:
+            self.counters[key] = [1, 0]
+        else:
+            # Replace the smallest counter, inheriting its count as error
+            smallest = min(self.counters, key=lambda key: self.counters[key][0])
+            count = self.counters.pop(smallest)[0]
+            self.counters[key] = [count + 1, count]
+
+    def top(self):
+        return sorted(
+            ((key, count, error) for key, (count, error) in self.counters.items()),
+            key=lambda item: item[1],
+            reverse=True,
+        )
+
+
+class UsageSketches:
+    def __init__(self, datasette):
+        config = Config(datasette)
+        self._datasette = datasette
+        self.top_k = config.get("usage_top_k") or DEFAULT_TOP_K
+        self.max_tokens = config.get("usage_max_tokens") or DEFAULT_MAX_TOKENS
+        self.persist_seconds = (
+            config.get("usage_persist_seconds") or DEFAULT_PERSIST_SECONDS
+        )
+        self._lock = asyncio.Lock()
+        self._persist_task = None
+        self._reset()
+
+    def _reset(self):
+        self._distinct_ips = {}
+        self._requests = SpaceSaving(self.top_k)
+
+    def observe(self, token_id, client_ip):
+        "Counts one authenticated request - called on the request path"
+        self._requests.add(token_id)
+        if client_ip is None:
+            return
+        sketch = self._distinct_ips.get(token_id)
+        if sketch is None:
+            if len(self._distinct_ips) >= self.max_tokens:
+                # Full until the next persist, which is brought forward
+                get_metrics(self._datasette)["usage_tokens_dropped"] += 1
+                if self._persist_task is None:
+                    self._persist_task = run_in_background(self._early_persist())
+                return
+            sketch = self._distinct_ips[token_id] = HyperLogLog()
+        sketch.add(client_ip)
+
+    async def _early_persist(self):
+        try:
+            await self.persist()
+        finally:
+            self._persist_task = None
+
+    async def persist(self):
+        "Merges everything observed so far into the usage table"
+        async with self._lock:
+            distinct_ips, requests = self._distinct_ips, self._requests
+            self._reset()
+            if not distinct_ips and not requests.counters:
+                return
+            await Config(self._datasette).db.execute_write_fn(
+                make_persist_function(distinct_ips, requests.top())
+            )
+
+    async def usage(self, token_id):
+        """
+        distinct_ips, requests and requests_error for a token as of the last
+        persist, or None - reading never forces a write
+        """
+        rows = await read_usage(self._datasette, [token_id])
+        return rows.get(token_id)
+
+    async def top(self, limit):
+        "Usage for the tokens with the most requests as of the last persist"
+        db = Config(self._datasette).db
+        token_ids = [
+            row[0]
+            for row in await db.execute(
+                """
+                select token_id from _datasette_auth_tokens_usage
+                where requests > 0 order by requests desc limit :limit
+                """,
+                {"limit": limit},
+            )
+        ]
+        usage = await read_usage(self._datasette, token_ids)
+        return [dict(usage[token_id], token_id=token_id) for token_id in token_ids]
+
+
+async def read_usage(datasette, token_ids):
+    if not token_ids:
+        return {}
+    db = Config(datasette).db
+    results = await db.execute(
+        """
+        select token_id, distinct_ips, requests, requests_error
+        from _datasette_auth_tokens_usage where token_id in ({})
+        """.format(", ".join("?" for _ in token_ids)),
+        token_ids,
+    )
+    return {
+        row["token_id"]: {
+            "distinct_ips": (
+                HyperLogLog(registers=row["distinct_ips"]).count()
+                if row["distinct_ips"]
+                else None
+            ),
+            "requests": row["requests"],
+            "requests_error": row["requests_error"],
+        }
+        for row in results
+    }
+
+
+def make_persist_function(distinct_ips, top):
+    def persist_usage(conn):
+        now = int(time.time())
+        with conn:
+            # Take the write lock before reading the registers, otherwise
+            # another process could merge into them between read and write
+            conn.execute("begin immediate")
+            if distinct_ips:
+                # HyperLogLogs merge losslessly, register by register
+                existing = dict(
+                    conn.execute(
+                        """
+                        select token_id, distinct_ips
+                        from _datasette_auth_tokens_usage
+                        where token_id in ({}) and distinct_ips is not null
+                        """.format(", ".join("?" for _ in distinct_ips)),
+                        list(distinct_ips),
+                    ).fetchall()
+                )
+                for token_id, sketch in distinct_ips.items():
+                    if token_id in existing:
+                        sketch.merge(existing[token_id])
+                conn.executemany(
+                    """
+                    insert into _datasette_auth_tokens_usage
+                    (token_id, distinct_ips, updated_timestamp)
+                    values (?, ?, ?)
+                    on conflict (token_id) do update set
+                    distinct_ips = excluded.distinct_ips,
+                    updated_timestamp = excluded.updated_timestamp
+                    """,
+                    [
+                        (token_id, bytes(sketch.registers), now)
+                        for token_id, sketch in distinct_ips.items()
+                    ],
+                )
+            # Counts from each period add up, and so do their errors
+            conn.executemany(
+                """
+                insert into _datasette_auth_tokens_usage
+                (token_id, requests, requests_error, updated_timestamp)
+                values (?, ?, ?, ?)
+                on conflict (token_id) do update set
+                requests = requests + excluded.requests,
+                requests_error = requests_error + excluded.requests_error,
+                updated_timestamp = excluded.updated_timestamp
+                """,
+                [(token_id, count, error, now) for token_id, count, error in top],
+            )
+
+    return persist_usage
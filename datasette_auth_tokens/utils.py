@@ -1,5 +1,8 @@
+from collections import OrderedDict
 from typing import Optional
+import asyncio
 import time
+import weakref
 
 
 def pluralize(n, unit):
@@ -76,3 +79,45 @@ def format_permissions(datasette, permissions_dict):
                     output.append(f"- {abbreviations.get(code, code)}")
 
     return "\n".join(output)
+
+
+_instance_state = weakref.WeakKeyDictionary()
+
+
+def instance_state(datasette, key, factory):
+    # In-memory plugin state that lives as long as the Datasette instance
+    state = _instance_state.setdefault(datasette, {})
+    if key not in state:
+        state[key] = factory()
+    return state[key]
+
+
+_background_tasks = set()
+
+
+def run_in_background(coroutine):
+    # Hold a reference so the task is not garbage collected before it finishes
+    task = asyncio.ensure_future(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+class LRUDict(OrderedDict):
+    "Dictionary that discards the least recently used keys beyond max_size"
+
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.max_size:
+            self.popitem(last=False)
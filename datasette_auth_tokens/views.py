@@ -1,4 +1,5 @@
 from datasette import Forbidden, Response, NotFound
+from datasette.utils.asgi import BadRequest
 from datasette.resources import DatabaseResource, TableResource
 from datasette.tokens import TokenRestrictions
 from datasette.utils import (
@@ -6,12 +7,37 @@ from datasette.utils import (
     tilde_decode,
     display_actor,
 )
+from .backfill import backfill_progress
+from .children import (
+    restrictions_empty,
+    restrictions_within,
+    sign_child_token,
+    DEFAULT_CHILD_MAX_SECONDS,
+)
+from .config import Config
+from .events import get_event_log
+from .index import tokens_changed
+from .introspect import (
+    introspect_tokens,
+    lookup_tokens,
+    DEFAULT_INTROSPECT_MAX_TOKENS,
+)
+from .metrics import get_metrics
+from .slowlog import get_slow_auth_log
+from .storage import get_storage
+from .usage import get_usage_sketches
 from .utils import ago_difference, format_permissions
+import asyncio
 import datetime
+import hashlib
 import json
 import time
 
 TOKEN_PAGE_SIZE = 30
+TOP_TOKENS_PAGE_SIZE = 20
+TOP_TOKENS_MAX_PAGE_SIZE = 1000
+EVENTS_PAGE_SIZE = 100
+EVENTS_MAX_PAGE_SIZE = 1000
 
 
 async def create_api_token(request, datasette):
@@ -47,6 +73,24 @@ async def create_api_token(request, datasette):
                 else:
                     errors.append("Invalid expire duration unit")
 
+        rate_limit = None
+        rate_limit_string = (post.get("rate_limit_per_minute") or "").strip()
+        if rate_limit_string:
+            if not rate_limit_string.isdigit() or not int(rate_limit_string) > 0:
+                errors.append("Invalid rate limit")
+            else:
+                rate_limit = int(rate_limit_string)
+
+        if errors:
+            context = await _shared(datasette, request)
+            context["errors"] = errors
+            return Response.html(
+                await datasette.render_template(
+                    "create_api_token.html", context, request=request
+                ),
+                status=400,
+            )
+
         # Are there any restrictions?
         restrictions = TokenRestrictions()
 
@@ -76,28 +120,21 @@ async def create_api_token(request, datasette):
         )
         permissions = token_bits.get("_r") or None
 
-        config = Config(datasette)
-        db = config.db
-        cursor = await db.execute_write(
-            """
-            insert into _datasette_auth_tokens
-            (secret_version, description, permissions, actor_id, created_timestamp, expires_after_seconds)
-            values
-            (:secret_version, :description, :permissions, :actor_id, :created_timestamp, :expires_after_seconds)
-        """,
-            {
-                "secret_version": 0,
-                "permissions": json.dumps(permissions),
-                "description": post.get("description") or None,
-                "actor_id": request.actor["id"],
-                "created_timestamp": int(time.time()),
-                "expires_after_seconds": expires_after,
-            },
+        record = await get_storage(datasette).create(
+            request.actor["id"],
+            permissions=permissions,
+            description=post.get("description") or None,
+            expires_after_seconds=expires_after,
+            rate_limit_per_minute=rate_limit,
+        )
+        token = "dsatok_{}".format(datasette.sign(record["id"], "dsatok"))
+        get_event_log(datasette).record(
+            "create", record["id"], actor_id=request.actor["id"]
         )
-        token = "dsatok_{}".format(datasette.sign(cursor.lastrowid, "dsatok"))
+        tokens_changed(datasette)
 
         context = await _shared(datasette, request)
-        context.update({"errors": errors, "token": token, "token_bits": token_bits})
+        context.update({"token": token, "token_bits": token_bits})
         return Response.html(
             await datasette.render_template(
                 "create_api_token.html", context, request=request
@@ -118,11 +155,8 @@ async def check_permission(datasette, actor):
 
 async def _shared(datasette, request):
     await check_permission(datasette, request.actor)
-    db = Config(datasette).db
-
-    tokens_exist = bool(
-        (await db.execute("select 1 from _datasette_auth_tokens limit 1")).first()
-    )
+    tokens, _ = await get_storage(datasette).list(limit=1)
+    tokens_exist = bool(tokens)
     # Build list of databases and tables the user has permission to view
     database_with_tables = []
     databases_with_at_least_one_table = []
@@ -188,53 +222,71 @@ async def _shared(datasette, request):
 
 
 async def tokens_index(datasette, request):
-    from . import TOKEN_STATUSES, make_expire_function
-
-    db = Config(datasette).db
+    from . import TOKEN_STATUSES, expire_tokens
 
-    # Expire any tokens that are due for expiring
-    await db.execute_write_fn(make_expire_function())
+    storage = get_storage(datasette)
+    is_json = request.url_vars.get("format") == "json"
 
     next = request.args.get("next")
-
-    where_bits = []
-    params = {}
-    if next:
-        where_bits.append("id <= :next")
-        params["next"] = next
-    where = " and ".join(where_bits)
+    q = (request.args.get("q") or "").strip()
 
     # Users can only see their own tokens, unless they have the
     # auth-tokens-view-all permission
-    if not await datasette.allowed(action="auth-tokens-view-all", actor=request.actor):
-        where_bits.append("actor_id = :actor_id")
-        params["actor_id"] = request.actor["id"] if request.actor else None
+    actor_id = request.actor["id"] if request.actor else None
+    can_view_all = await datasette.allowed(
+        action="auth-tokens-view-all", actor=request.actor
+    )
+    if not can_view_all and actor_id is None:
+        # Storage treats a None actor_id as every token
+        raise Forbidden("You must be logged in to view tokens")
+    list_actor_id = None if can_view_all else actor_id
+
+    async def listing_etag():
+        version = await storage.listing_version(list_actor_id)
+        if version is None:
+            return None
+        versions, deadline = version
+        if deadline is not None and deadline < time.time():
+            # Tokens are due to expire, so what is stored is out of date
+            return None
+        return '"{}"'.format(
+            hashlib.sha256(
+                json.dumps([versions, actor_id, can_view_all]).encode("utf-8")
+            ).hexdigest()[:32]
+        )
 
-    tokens = [
-        dict(row)
-        for row in (
-            await db.execute(
-                """
-                select * from _datasette_auth_tokens
-                {where} order by id desc limit {limit}
-            """.format(
-                    where="where {}".format(where) if where else "",
-                    limit=TOKEN_PAGE_SIZE + 1,
-                ),
-                params,
-            )
-        ).rows
-    ]
-    next = None
-    if len(tokens) == TOKEN_PAGE_SIZE + 1:
-        next = tokens[-1]["id"]
-        tokens = tokens[:-1]
+    # Answer unchanged listings before doing any other work
+    etag = await listing_etag()
+    if etag is not None and request.headers.get("if-none-match") == etag:
+        return Response("", status=304, headers=_listing_headers(etag))
+
+    if etag is None:
+        # Expire any tokens that are due for expiring
+        await expire_tokens(datasette)
+        etag = await listing_etag()
+
+    try:
+        tokens, next = await storage.list(
+            list_actor_id, q=q or None, next=next, limit=TOKEN_PAGE_SIZE
+        )
+    except ValueError:
+        raise BadRequest("Invalid next parameter")
 
     for token in tokens:
         token["status"] = TOKEN_STATUSES.get(
             token["token_status"], token["token_status"]
         )
 
+    counts = await storage.counts(list_actor_id)
+
+    if is_json:
+        for token in tokens:
+            token["restrictions"] = json.loads(token.pop("permissions")) or None
+        return Response.json(
+            {"tokens": tokens, "next": next, "counts": counts},
+            headers=_listing_headers(etag),
+        )
+
     # Resolve actors
     actor_ids = set([token["actor_id"] for token in tokens])
     actors = await datasette.actors_from_ids(list(actor_ids))
@@ -252,6 +304,8 @@ async def tokens_index(datasette, request):
             {
                 "tokens": tokens,
                 "next": next,
+                "q": q,
+                "counts": counts,
                 "is_first_page": not bool(request.args.get("next")),
                 "timestamp": _timestamp,
                 "ago_difference": ago_difference,
@@ -262,26 +316,30 @@ async def tokens_index(datasette, request):
                 ),
             },
             request=request,
-        )
+        ),
+        headers=_listing_headers(etag),
     )
 
 
-async def token_details(request, datasette):
-    from . import TOKEN_STATUSES
+def _listing_headers(etag):
+    headers = {"Cache-Control": "private, no-cache"}
+    if etag is not None:
+        headers["ETag"] = etag
+    return headers
 
-    config = Config(datasette)
-    db = config.db
 
-    id = request.url_vars["id"]
+async def token_details(request, datasette):
+    from . import TOKEN_STATUSES, record_expired, record_revoked
 
-    async def fetch_row():
-        return (
-            await db.execute("select * from _datasette_auth_tokens where id = ?", (id,))
-        ).first()
+    id = int(request.url_vars["id"])
+    is_json = request.url_vars.get("format") == "json"
+    storage = get_storage(datasette)
 
-    row = await fetch_row()
+    row = await storage.lookup(id, include_archived=True)
     if row is None:
         raise NotFound("Token not found")
+    # Only rows from the archive table have this column
+    archived = row.get("archived_timestamp") is not None
 
     # User can manage if they own the token or they have auth-tokens-revoke-all
     if not await actor_can_view(datasette, request.actor, row["actor_id"]):
@@ -289,36 +347,80 @@ async def token_details(request, datasette):
 
     can_revoke = await actor_can_revoke(datasette, request.actor, row["actor_id"])
 
-    if (
-        row["expires_after_seconds"]
-        and (row["created_timestamp"] + row["expires_after_seconds"]) < time.time()
-    ):
-        await db.execute_write(
-            "update _datasette_auth_tokens set token_status='E' where id=:token_id",
-            {"token_id": id},
-        )
-        row = await fetch_row()
-
     if request.method == "POST":
-        post_vars = await request.post_vars()
-        if post_vars.get("revoke"):
+        if is_json:
+            try:
+                data = json.loads(await request.post_body())
+            except ValueError:
+                return _json_error("Invalid JSON")
+            revoke = isinstance(data, dict) and data.get("revoke")
+        else:
+            revoke = (await request.post_vars()).get("revoke")
+        if revoke:
             if not can_revoke:
                 raise Forbidden("You do not have permission to revoke this token")
-            else:
-                await db.execute_write(
-                    """
-                    update _datasette_auth_tokens
-                    set
-                        token_status = 'R',
-                        ended_timestamp = :now
-                    where id = :id
-                    """,
-                    {"id": id, "now": int(time.time())},
-                )
-        return Response.redirect(request.path)
+            if not archived:
+                # Revokes and returns the updated row in a single statement
+                revoked = await storage.revoke(token_ids=[id])
+                if revoked:
+                    row = revoked[0]
+                    record_revoked(datasette, [id], request.actor["id"])
+        if not is_json:
+            return Response.redirect(request.path)
+    elif (
+        not archived
+        and row["token_status"] == "A"
+        and row["expires_after_seconds"]
+        and (row["created_timestamp"] + row["expires_after_seconds"]) < time.time()
+    ):
+        expired = await storage.expire(id)
+        if expired:
+            row = expired[0]
+            record_expired(datasette, [id])
 
-    restrictions = "None"
+    status = TOKEN_STATUSES.get(row["token_status"], row["token_status"])
     permissions = json.loads(row["permissions"])
+
+    if is_json:
+        # Usage estimates change with every request, so they are left out
+        # to let pollers get a 304 while the token itself is unchanged
+        etag_bits = [
+            row["token_status"],
+            row["last_used_timestamp"],
+            row["ended_timestamp"],
+            "archived" if archived else "",
+        ]
+        etag = '"{}"'.format("-".join(str(bit) for bit in etag_bits))
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if request.method == "GET" and request.headers.get("if-none-match") == etag:
+            return Response("", status=304, headers=headers)
+        expires_at = None
+        if row["expires_after_seconds"]:
+            expires_at = row["created_timestamp"] + row["expires_after_seconds"]
+        details = {
+            "id": row["id"],
+            "description": row["description"],
+            "actor_id": row["actor_id"],
+            "token_status": row["token_status"],
+            "status": status,
+            "archived": archived,
+            "created_timestamp": row["created_timestamp"],
+            "last_used_timestamp": row["last_used_timestamp"],
+            "expires_at": expires_at,
+            "ended_timestamp": row["ended_timestamp"],
+            "rate_limit_per_minute": row["rate_limit_per_minute"],
+            "restrictions": permissions or None,
+            "can_revoke": can_revoke and row["token_status"] == "A",
+        }
+        if Config(datasette).get("usage_sketches"):
+            details["usage"] = await get_usage_sketches(datasette).usage(id)
+        return Response.json(details, headers=headers)
+
+    usage = None
+    if Config(datasette).get("usage_sketches"):
+        usage = await get_usage_sketches(datasette).usage(id)
+
+    restrictions = "None"
     if permissions:
         restrictions = format_permissions(datasette, permissions)
 
@@ -333,19 +435,243 @@ async def token_details(request, datasette):
             {
                 "token": row,
                 "actor_display": actor_display,
-                "token_status": TOKEN_STATUSES.get(
-                    row["token_status"], row["token_status"]
-                ),
+                "token_status": status,
                 "timestamp": _timestamp,
                 "ago_difference": ago_difference,
                 "restrictions": restrictions,
                 "can_revoke": can_revoke,
+                "archived": archived,
+                "usage": usage,
             },
             request=request,
         )
     )
 
 
+async def token_events(request, datasette):
+    if not request.actor or not request.actor.get("id"):
+        raise Forbidden("You must be logged in to view token events")
+
+    event_log = get_event_log(datasette)
+    # Make sure anything still queued is visible
+    await event_log.flush()
+
+    db = Config(datasette).db
+
+    size = _page_size(request, EVENTS_PAGE_SIZE, EVENTS_MAX_PAGE_SIZE)
+
+    where_bits = []
+    params = {"limit": size + 1}
+    # Keyset pagination, newest events first
+    before = request.args.get("before")
+    if before:
+        where_bits.append("id < :before")
+        params["before"] = before
+    token_id = request.args.get("token_id")
+    if token_id:
+        where_bits.append("token_id = :token_id")
+        params["token_id"] = token_id
+    # Users can only see events for their own tokens, unless they have the
+    # auth-tokens-view-all permission
+    if not await datasette.allowed(action="auth-tokens-view-all", actor=request.actor):
+        storage = get_storage(datasette)
+        if storage.sqlite and len(Config(datasette).shards) == 1:
+            where_bits.append(
+                "token_id in (select id from _datasette_auth_tokens where actor_id = :actor_id)"
+            )
+            params["actor_id"] = request.actor["id"]
+        else:
+            # Events are all logged to the first shard, but the actor's
+            # tokens may be in another shard or another kind of storage
+            tokens, _ = await storage.list(request.actor["id"])
+            where_bits.append("token_id in (select value from json_each(:token_ids))")
+            params["token_ids"] = json.dumps([token["id"] for token in tokens])
+
+    events = [
+        dict(row)
+        for row in (
+            await db.execute(
+                """
+                select id, token_id, event, actor_id, timestamp, details
+                from _datasette_auth_tokens_events
+                {where} order by id desc limit :limit
+            """.format(
+                    where=(
+                        "where {}".format(" and ".join(where_bits))
+                        if where_bits
+                        else ""
+                    )
+                ),
+                params,
+            )
+        ).rows
+    ]
+    next = None
+    if len(events) == size + 1:
+        events = events[:-1]
+        next = events[-1]["id"]
+    for event in events:
+        event["details"] = json.loads(event["details"]) if event["details"] else None
+    return Response.json({"events": events, "next": next})
+
+
+async def token_metrics(request, datasette):
+    if not await datasette.allowed(action="auth-tokens-view-all", actor=request.actor):
+        raise Forbidden("You do not have permission to view token metrics")
+    metrics = dict(get_metrics(datasette))
+    metrics["token_counts"] = await get_storage(datasette).counts()
+    return Response.json(metrics)
+
+
+def _page_size(request, default, maximum):
+    "?_size=, between 1 and maximum"
+    try:
+        size = int(request.args.get("_size") or default)
+    except ValueError:
+        raise BadRequest("_size must be an integer")
+    return max(1, min(size, maximum))
+
+
+async def top_tokens(request, datasette):
+    if not await datasette.allowed(action="auth-tokens-view-all", actor=request.actor):
+        raise Forbidden("You do not have permission to view token usage")
+    size = _page_size(request, TOP_TOKENS_PAGE_SIZE, TOP_TOKENS_MAX_PAGE_SIZE)
+    top = await get_usage_sketches(datasette).top(size)
+    tokens = await get_storage(datasette).lookup_many(
+        [usage["token_id"] for usage in top], include_archived=True
+    )
+    return Response.json(
+        {
+            "tokens": [
+                dict(
+                    _top_token_fields(tokens.get(usage["token_id"]), usage),
+                    requests=usage["requests"],
+                    requests_error=usage["requests_error"],
+                    distinct_ips=usage["distinct_ips"],
+                )
+                for usage in top
+            ]
+        }
+    )
+
+
+def _top_token_fields(token, usage):
+    if token is None:
+        return {"id": usage["token_id"]}
+    return {
+        key: token[key] for key in ("id", "actor_id", "description", "token_status")
+    }
+
+
+async def slow_authentications(request, datasette):
+    if not await datasette.allowed(action="auth-tokens-view-all", actor=request.actor):
+        raise Forbidden("You do not have permission to view slow authentications")
+    log = get_slow_auth_log(datasette)
+    return Response.json(
+        {"threshold_ms": log.threshold_ms, "entries": list(reversed(log.entries))}
+    )
+
+
+async def token_introspect(request, datasette):
+    if request.method != "POST":
+        return _json_error("Send tokens to introspect using POST", 405)
+    if not await datasette.allowed(
+        action="auth-tokens-introspect", actor=request.actor
+    ):
+        raise Forbidden("You do not have permission to introspect tokens")
+    try:
+        data = json.loads(await request.post_body())
+    except ValueError:
+        return _json_error("Invalid JSON")
+    tokens = data.get("tokens") if isinstance(data, dict) else None
+    if not isinstance(tokens, list):
+        return _json_error('"tokens" must be a list')
+    max_tokens = (
+        Config(datasette).get("introspect_max_tokens") or DEFAULT_INTROSPECT_MAX_TOKENS
+    )
+    if len(tokens) > max_tokens:
+        return _json_error("Too many tokens, the maximum is {}".format(max_tokens))
+    return Response.json(
+        {"ok": True, "tokens": await introspect_tokens(datasette, tokens)}
+    )
+
+
+async def create_child_token(request, datasette):
+    if request.method != "POST":
+        return _json_error("Create child tokens using POST", 405)
+    actor = request.actor
+    if not actor or actor.get("token") != "dsatok":
+        raise Forbidden("Child tokens can only be created using a managed API token")
+    try:
+        data = json.loads(await request.post_body())
+    except ValueError:
+        return _json_error("Invalid JSON")
+    if not isinstance(data, dict):
+        return _json_error("Body must be a JSON object")
+    max_seconds = (
+        Config(datasette).get("child_token_max_seconds") or DEFAULT_CHILD_MAX_SECONDS
+    )
+    expires_after = data.get("expires_after")
+    if (
+        not isinstance(expires_after, int)
+        or isinstance(expires_after, bool)
+        or not 0 < expires_after <= max_seconds
+    ):
+        return _json_error(
+            '"expires_after" must be a number of seconds up to {}'.format(max_seconds)
+        )
+    parent_id = actor["token_id"]
+    parent = (await lookup_tokens(datasette, {parent_id})).get(parent_id)
+    if parent is None:
+        raise Forbidden("The parent token is no longer active")
+    _, parent_restrictions, parent_expires_at = parent
+    restrictions = data.get("restrictions")
+    if restrictions is None:
+        restrictions = parent_restrictions
+    else:
+        try:
+            within = restrictions_within(datasette, restrictions, parent_restrictions)
+        except ValueError as ex:
+            return _json_error(str(ex))
+        if not within:
+            return _json_error(
+                "Child token restrictions must be within those of the parent token"
+            )
+        if restrictions_empty(restrictions):
+            return _json_error(
+                "Child token restrictions must allow at least one action"
+            )
+    deadline = int(time.time()) + expires_after
+    if parent_expires_at is not None:
+        deadline = min(deadline, parent_expires_at)
+    return Response.json(
+        {
+            "ok": True,
+            "token": sign_child_token(datasette, parent_id, deadline, restrictions),
+            "parent_token_id": parent_id,
+            "expires_at": deadline,
+        }
+    )
+
+
+def _json_error(message, status=400):
+    return Response.json({"ok": False, "errors": [message]}, status=status)
+
+
+async def token_backfills(request, datasette):
+    if not await datasette.allowed(action="auth-tokens-view-all", actor=request.actor):
+        raise Forbidden("You do not have permission to view backfill progress")
+    shards = Config(datasette).shards
+    progress = await asyncio.gather(*(backfill_progress(db) for db in shards))
+    backfills = []
+    for shard, shard_progress in enumerate(progress):
+        for info in shard_progress:
+            if len(shards) > 1:
+                info["shard"] = shard
+            backfills.append(info)
+    return Response.json({"backfills": backfills})
+
+
 def _timestamp(ts):
     if ts:
         return datetime.datetime.fromtimestamp(ts).isoformat()
@@ -371,21 +697,3 @@ async def actor_can_revoke(datasette, actor, token_actor_id):
         return True
     # User with auth-tokens-revoke-all can revoke any token
     return await datasette.allowed(action="auth-tokens-revoke-all", actor=actor)
-
-
-class Config:
-    def __init__(self, datasette):
-        self._plugin_config = datasette.plugin_config("datasette-auth-tokens") or {}
-        self._datasette = datasette
-        self.enabled = self._plugin_config.get("manage_tokens")
-
-    def get(self, key):
-        return self._plugin_config.get(key)
-
-    @property
-    def db(self):
-        db_name = self._plugin_config.get("manage_tokens_database") or None
-        if db_name is None:
-            return self._datasette.get_internal_database()
-        else:
-            return self._datasette.get_database(db_name)
@@ -149,3 +149,65 @@ async def test_actor(ds, token, expected_actor):
 async def test_tokens_table_not_visible(ds, path):
     response = await ds.client.get(path)
     assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_slow_authentication_log(tmp_path):
+    db_path = tmp_path / "tokens.db"
+    sqlite_utils.Database(db_path)["tokens"].insert(
+        {"id": 2, "actor_id": "two", "token_secret": "twotwo"}, pk="id"
+    )
+    ds = Datasette(
+        [db_path],
+        plugin_config={
+            "datasette-auth-tokens": {
+                "query": {
+                    "sql": "select * from tokens where id = :token_id",
+                    "database": "tokens",
+                },
+                "tokens": [{"token": "one", "actor": {"id": "one"}}],
+                "param": "_auth_token",
+                # Log every authentication
+                "slow_auth_ms": 0,
+            }
+        },
+        config={"permissions": {"auth-tokens-view-all": {"id": "one"}}},
+    )
+    for token in ("2-twotwo", "one"):
+        await ds.client.get(
+            "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+        )
+    response = await ds.client.get("/-/api/tokens/slow?_auth_token=one")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["threshold_ms"] == 0
+    # Newest first, including the request for the log itself
+    assert [entry["backend"] for entry in data["entries"]] == [
+        "tokens",
+        "tokens",
+        "query",
+    ]
+    query_entry = data["entries"][-1]
+    assert query_entry["token_id"] == "2"
+    assert set(query_entry["stages"]) == {"compare", "read"}
+    assert query_entry["database_ms"] == query_entry["stages"]["read"]
+    response = await ds.client.get("/-/api/tokens/slow?_auth_token=2-twotwo")
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_server_timing_header():
+    ds = Datasette(
+        plugin_config={
+            "datasette-auth-tokens": {
+                "tokens": [{"token": "one", "actor": {"id": "one"}}],
+                "server_timing": True,
+            }
+        },
+    )
+    response = await ds.client.get(
+        "/-/actor.json", headers={"Authorization": "Bearer one"}
+    )
+    assert response.json() == {"actor": {"id": "one"}}
+    assert response.headers["server-timing"].startswith("auth;dur=")
+    assert 'desc="tokens", auth-compare;dur=' in response.headers["server-timing"]
@@ -0,0 +1,218 @@
+from click.testing import CliRunner
+from datasette.cli import cli
+from datasette_auth_tokens.config import shard_index_for_actor
+from datasette_auth_tokens.migrations import migration
+from datasette_test import Datasette
+import csv
+import io
+import json
+import pytest
+import sqlite_utils
+
+
+def test_rebuild_counts(tmp_path):
+    path = str(tmp_path / "tokens.db")
+    db = sqlite_utils.Database(path)
+    migration.apply(db)
+    db["_datasette_auth_tokens"].insert_all(
+        [
+            {"actor_id": "alice", "token_status": "A", "permissions": "null"},
+            {"actor_id": "alice", "token_status": "R", "permissions": "null"},
+            {"actor_id": "bob", "token_status": "A", "permissions": "null"},
+        ]
+    )
+    db.execute("update _datasette_auth_tokens_counts set count = 0")
+    db.conn.commit()
+    result = CliRunner().invoke(cli, ["auth-tokens", "rebuild-counts", path])
+    assert result.exit_code == 0, result.output
+    assert result.output == "{}: counted 3 tokens\n".format(path)
+    assert sorted(
+        tuple(row) for row in db.execute("select * from _datasette_auth_tokens_counts")
+    ) == [("alice", "A", 1), ("alice", "R", 1), ("bob", "A", 1)]
+
+
+def _shard_paths(tmp_path, count):
+    paths = [str(tmp_path / "shard-{}.db".format(i)) for i in range(count)]
+    for path in paths:
+        sqlite_utils.Database(path).vacuum()
+    return paths
+
+
+@pytest.mark.asyncio
+async def test_import_tokens(tmp_path):
+    paths = _shard_paths(tmp_path, 2)
+    actors = ["alice", "bob", "carol", "dave"]
+    rows = [
+        {"actor_id": actor_id, "description": "Imported for {}".format(actor_id)}
+        for actor_id in actors
+    ]
+    rows.append(
+        {
+            "actor_id": "alice",
+            "restrictions": {"a": ["view-instance"]},
+            "rate_limit_per_minute": 10,
+        }
+    )
+    result = CliRunner().invoke(
+        cli,
+        ["auth-tokens", "import", *paths, "--format", "nl", "--batch-size", "2"],
+        input="".join(json.dumps(row) + "\n" for row in rows),
+        env={"DATASETTE_SECRET": "sekrit"},
+    )
+    assert result.exit_code == 0, result.output
+    tokens = result.output.splitlines()
+    assert len(tokens) == len(rows)
+
+    ds = Datasette(
+        secret="sekrit",
+        plugin_config={
+            "datasette-auth-tokens": {
+                "manage_tokens": True,
+                "manage_tokens_shards": paths,
+            }
+        },
+    )
+    await ds.invoke_startup()
+    token_ids = []
+    for row, token in zip(rows, tokens):
+        response = await ds.client.get(
+            "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+        )
+        actor = response.json()["actor"]
+        assert actor["id"] == row["actor_id"]
+        token_ids.append(actor["token_id"])
+    assert actor["_r"] == {"a": ["view-instance"]}
+    # Each token went to its actor's shard, with the usual interleaved IDs
+    for row, token_id in zip(rows, token_ids):
+        shard = shard_index_for_actor(row["actor_id"], 2)
+        assert (token_id - 1) % 2 == shard
+    assert len(set(token_ids)) == len(rows)
+
+    for path in paths:
+        db = sqlite_utils.Database(path)
+        # Search index, counts and change sequence were all maintained
+        assert [
+            row["rowid"]
+            for row in db.query(
+                "select rowid from _datasette_auth_tokens_fts order by rowid"
+            )
+        ] == [row["id"] for row in db.query("select id from _datasette_auth_tokens")]
+        assert (
+            db.execute(
+                "select coalesce(sum(count), 0) from _datasette_auth_tokens_counts"
+            ).fetchone()[0]
+            == db["_datasette_auth_tokens"].count
+        )
+        changed_at = [
+            row["changed_at"]
+            for row in db.query(
+                "select changed_at from _datasette_auth_tokens order by id"
+            )
+        ]
+        assert changed_at == list(range(1, len(changed_at) + 1))
+        assert len(db.triggers) == 11
+    events = sqlite_utils.Database(paths[0]).query(
+        "select token_id from _datasette_auth_tokens_events where event = 'create'"
+    )
+    assert sorted(row["token_id"] for row in events) == sorted(token_ids)
+
+
+def test_import_tokens_errors(tmp_path):
+    path = _shard_paths(tmp_path, 1)[0]
+    result = CliRunner().invoke(
+        cli,
+        ["auth-tokens", "import", path, "--secret", "s"],
+        input="actor_id,colour\nalice,red\n",
+    )
+    assert result.exit_code == 1
+    assert "Unknown columns: colour" in result.output
+    assert sqlite_utils.Database(path)["_datasette_auth_tokens"].count == 0
+
+
+def _import(paths, *actor_ids):
+    result = CliRunner().invoke(
+        cli,
+        ["auth-tokens", "import", *paths, "--secret", "s"],
+        input="actor_id\n" + "".join(actor_id + "\n" for actor_id in actor_ids),
+    )
+    assert result.exit_code == 0, result.output
+
+
+@pytest.mark.parametrize("format_", ("csv", "nl"))
+def test_export_tokens(tmp_path, format_):
+    paths = _shard_paths(tmp_path, 3)
+    _import(paths, "alice", "bob", "carol", "dave", "alice")
+    result = CliRunner().invoke(
+        cli, ["auth-tokens", "export", *paths, "--format", format_]
+    )
+    assert result.exit_code == 0, result.output
+    if format_ == "csv":
+        rows = list(csv.DictReader(io.StringIO(result.output)))
+    else:
+        rows = [json.loads(line) for line in result.output.splitlines()]
+    # Merged across the shards in ID order
+    assert [int(row["id"]) for row in rows] == sorted(int(row["id"]) for row in rows)
+    assert sorted(row["actor_id"] for row in rows) == [
+        "alice",
+        "alice",
+        "bob",
+        "carol",
+        "dave",
+    ]
+    result = CliRunner().invoke(
+        cli, ["auth-tokens", "export", *paths, "--format", "nl", "--actor", "alice"]
+    )
+    assert [json.loads(line)["actor_id"] for line in result.output.splitlines()] == [
+        "alice",
+        "alice",
+    ]
+
+
+def test_revoke_tokens(tmp_path):
+    from datasette_auth_tokens.snapshot import Snapshot
+
+    paths = _shard_paths(tmp_path, 2)
+    _import(paths, "alice", "bob", "carol", "alice")
+    snapshot = str(tmp_path / "tokens.snapshot")
+
+    result = CliRunner().invoke(cli, ["auth-tokens", "revoke", *paths])
+    assert result.exit_code == 1
+    assert "Use at least one filter, or --all" in result.output
+
+    result = CliRunner().invoke(
+        cli,
+        ["auth-tokens", "revoke", *paths, "--actor", "alice", "--snapshot", snapshot],
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output == "Revoked 2 tokens\n"
+
+    def statuses():
+        return {
+            (row["actor_id"], row["token_status"])
+            for path in paths
+            for row in sqlite_utils.Database(path).query(
+                "select actor_id, token_status from _datasette_auth_tokens"
+            )
+        }
+
+    assert statuses() == {("alice", "R"), ("bob", "A"), ("carol", "A")}
+    # Only the tokens still active are in the rewritten snapshot
+    snap = Snapshot(snapshot)
+    assert snap.count == 2
+    for path in paths:
+        for row in sqlite_utils.Database(path).query(
+            "select id, actor_id from _datasette_auth_tokens"
+        ):
+            found = snap.lookup(row["id"])
+            assert (found and found[0]) == (
+                None if row["actor_id"] == "alice" else row["actor_id"]
+            )
+    snap.close()
+    revoke_events = sqlite_utils.Database(paths[0]).query(
+        "select count(*) as n from _datasette_auth_tokens_events where event = 'revoke'"
+    )
+    assert next(revoke_events)["n"] == 2
+
+    result = CliRunner().invoke(cli, ["auth-tokens", "revoke", *paths, "--all"])
+    assert result.output == "Revoked 2 tokens\n"
+    assert statuses() == {("alice", "R"), ("bob", "R"), ("carol", "R")}
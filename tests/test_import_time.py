@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+
+# Generous, to allow for slow CI machines - a regression that pulls heavy
+# dependencies back in is caught by the module check below
+IMPORT_BUDGET_US = 100_000
+
+# Only needed once managed tokens are used. sqlite-utils is not listed as
+# Datasette itself imports it.
+DEFERRED_MODULES = (
+    "sqlite_migrate",
+    "datasette_auth_tokens.views",
+    "datasette_auth_tokens.migrations",
+    "datasette_auth_tokens.snapshot",
+    "datasette_auth_tokens.store",
+)
+
+
+def _import_plugin(*args):
+    # Import Datasette first so only the plugin's own cost is measured, and
+    # stop Datasette from loading installed plugins - including this one
+    return subprocess.run(
+        [sys.executable, *args, "-c", "import datasette.app, datasette_auth_tokens"],
+        env=dict(os.environ, DATASETTE_LOAD_PLUGINS=""),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def test_import_time_budget():
+    stderr = _import_plugin("-X", "importtime").stderr
+    cumulative = None
+    imported = set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        name = name.strip()
+        if name == "datasette.app":
+            # Everything before this was imported by Datasette
+            imported = set()
+            continue
+        imported.add(name)
+        if name == "datasette_auth_tokens":
+            cumulative = int(cumulative_us)
+    assert cumulative is not None
+    assert not imported.intersection(DEFERRED_MODULES)
+    assert cumulative < IMPORT_BUDGET_US
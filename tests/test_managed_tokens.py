@@ -445,3 +445,1869 @@ async def test_no_table_heading_if_no_tables(tmpdir, has_a_table):
         assert fragment in response.text
     else:
         assert fragment not in response.text
+
+
+@pytest.mark.asyncio
+async def test_token_events(ds_managed):
+    token_id, token = await _create_token(ds_managed, "owner")
+    # Use it twice - should only record a single first_use
+    for _ in range(2):
+        response = await ds_managed.client.get(
+            "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+        )
+        assert response.json()["actor"]["token_id"] == token_id
+    # Revoke it
+    cookies = {"ds_actor": ds_managed.client.actor_cookie({"id": "owner"})}
+    details = await ds_managed.client.get(
+        "/-/api/tokens/{}".format(token_id), cookies=cookies
+    )
+    cookies["ds_csrftoken"] = details.cookies["ds_csrftoken"]
+    revoke_response = await ds_managed.client.post(
+        "/-/api/tokens/{}".format(token_id),
+        data={"revoke": "1", "csrftoken": cookies["ds_csrftoken"]},
+        cookies=cookies,
+    )
+    assert revoke_response.status_code == 302
+    # And a second token that expires
+    expired_id, _ = await _create_token(ds_managed, "other")
+    await ds_managed.get_internal_database().execute_write(
+        "update _datasette_auth_tokens set created_timestamp = :created, expires_after_seconds = 60 where id=:id",
+        {"id": expired_id, "created": time.time() - 120},
+    )
+    admin_cookies = {"ds_actor": ds_managed.client.actor_cookie({"id": "admin"})}
+    await ds_managed.client.get("/-/api/tokens", cookies=admin_cookies)
+
+    response = await ds_managed.client.get(
+        "/-/api/tokens/events", cookies=admin_cookies
+    )
+    assert response.status_code == 200
+    events = [
+        (event["token_id"], event["event"], event["actor_id"])
+        for event in response.json()["events"]
+    ]
+    assert events == [
+        (expired_id, "expire", None),
+        (expired_id, "create", "other"),
+        (token_id, "revoke", "owner"),
+        (token_id, "first_use", None),
+        (token_id, "create", "owner"),
+    ]
+    # Owner can only see events for their own tokens
+    response = await ds_managed.client.get(
+        "/-/api/tokens/events", cookies={"ds_actor": cookies["ds_actor"]}
+    )
+    assert {event["token_id"] for event in response.json()["events"]} == {token_id}
+    # Anonymous users cannot see any
+    response = await ds_managed.client.get("/-/api/tokens/events")
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_token_events_pagination(ds_managed):
+    for _ in range(5):
+        await _create_token(ds_managed)
+    cookies = {"ds_actor": ds_managed.client.actor_cookie({"id": "admin"})}
+    collected = []
+    path = "/-/api/tokens/events?_size=2"
+    while path:
+        data = (await ds_managed.client.get(path, cookies=cookies)).json()
+        collected.extend(event["id"] for event in data["events"])
+        path = (
+            "/-/api/tokens/events?_size=2&before={}".format(data["next"])
+            if data["next"]
+            else None
+        )
+    assert collected == [5, 4, 3, 2, 1]
+    # Sizes below one are treated as one
+    for size in ("0", "-1"):
+        response = await ds_managed.client.get(
+            "/-/api/tokens/events?_size={}".format(size), cookies=cookies
+        )
+        assert response.status_code == 200
+        assert [event["id"] for event in response.json()["events"]] == [5]
+        assert response.json()["next"] == 5
+
+
+@pytest.mark.asyncio
+async def test_token_events_prune(ds_managed):
+    from datasette_auth_tokens.events import get_event_log
+
+    for _ in range(5):
+        await _create_token(ds_managed)
+    event_log = get_event_log(ds_managed)
+    await event_log.flush()
+    db = ds_managed.get_internal_database()
+    await db.execute_write(
+        "update _datasette_auth_tokens_events set timestamp = 0 where id <= 3"
+    )
+    assert await event_log.prune(time.time() - 60, chunk_size=2) == 3
+    remaining = await db.execute("select id from _datasette_auth_tokens_events")
+    assert [row["id"] for row in remaining.rows] == [4, 5]
+
+
+@pytest.mark.asyncio
+async def test_token_events_kept_when_flush_fails(ds_managed, monkeypatch):
+    import sqlite3
+    from datasette_auth_tokens.events import get_event_log
+
+    await _create_token(ds_managed)
+    event_log = get_event_log(ds_managed)
+    await event_log.flush()
+    db = ds_managed.get_internal_database()
+    execute_write_fn = db.execute_write_fn
+
+    async def busy(fn, *args, **kwargs):
+        raise sqlite3.OperationalError("database is locked")
+
+    event_log.record("first_use", 1)
+    monkeypatch.setattr(db, "execute_write_fn", busy)
+    with pytest.raises(sqlite3.OperationalError):
+        await event_log.flush()
+    monkeypatch.setattr(db, "execute_write_fn", execute_write_fn)
+    event_log.record("revoke", 1)
+    await event_log.flush()
+    events = await db.execute(
+        "select event from _datasette_auth_tokens_events order by id"
+    )
+    assert [row["event"] for row in events.rows] == ["create", "first_use", "revoke"]
+
+
+@pytest.mark.asyncio
+async def test_dedicated_token_store(db_path, tmp_path):
+    store_path = tmp_path / "token-store.db"
+    ds = Datasette(
+        [db_path],
+        plugin_config={
+            "datasette-auth-tokens": {
+                "manage_tokens": True,
+                "manage_tokens_path": str(store_path),
+                "manage_tokens_cache_size_kb": 4000,
+                "manage_tokens_mmap_size": 1024 * 1024,
+            }
+        },
+        config={"permissions": {"auth-tokens-create": {"id": "*"}}},
+    )
+    token_id, token = await _create_token(ds)
+    response = await ds.client.get(
+        "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+    )
+    assert response.json()["actor"] == {
+        "id": "root",
+        "token": "dsatok",
+        "token_id": token_id,
+    }
+    # Token lives in the dedicated file, not the internal database
+    assert "_datasette_auth_tokens" not in (
+        await ds.get_internal_database().table_names()
+    )
+    store = sqlite_utils.Database(store_path)
+    assert store.journal_mode == "wal"
+    assert store.execute("pragma auto_vacuum").fetchone()[0] == 2
+    assert [row["id"] for row in store["_datasette_auth_tokens"].rows] == [token_id]
+    # Read connections have the tuned pragmas applied
+    from datasette_auth_tokens.views import Config
+
+    db = Config(ds).db
+    assert (await db.execute("pragma cache_size")).first()[0] == -4000
+    assert (await db.execute("pragma mmap_size")).first()[0] == 1024 * 1024
+    assert Config(ds).db is db
+
+
+@pytest_asyncio.fixture
+async def ds_memory_index(db_path):
+    return Datasette(
+        [db_path],
+        plugin_config={
+            "datasette-auth-tokens": {
+                "manage_tokens": True,
+                "memory_index": True,
+                "memory_index_refresh_seconds": 60,
+            }
+        },
+        config={"permissions": {"auth-tokens-create": {"id": "*"}}},
+    )
+
+
+@pytest.mark.asyncio
+async def test_memory_index(ds_memory_index):
+    from datasette_auth_tokens.index import get_token_index
+
+    ds = ds_memory_index
+    db = ds.get_internal_database()
+
+    async def actor_for(token):
+        response = await ds.client.get(
+            "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+        )
+        return response.json()["actor"]
+
+    token_id, token = await _create_token(ds)
+    expected = {"id": "root", "token": "dsatok", "token_id": token_id}
+    assert await actor_for(token) == expected
+    index = get_token_index(ds)
+    assert set(index.tokens) == {token_id}
+    version = index.version
+
+    # Changes made by another process are not seen until the next refresh
+    await db.execute_write(
+        "update _datasette_auth_tokens set token_status = 'R' where id = :id",
+        {"id": token_id},
+    )
+    assert await actor_for(token) == expected
+    await index.refresh()
+    assert index.version > version
+    assert index.tokens == {}
+    assert await actor_for(token) is None
+
+    # A token created elsewhere is found, since its ID is higher than max_ids
+    await db.execute_write("""
+        insert into _datasette_auth_tokens
+        (token_status, actor_id, permissions, created_timestamp)
+        values ('A', 'other', 'null', 0)
+    """)
+    other_token = "dsatok_{}".format(ds.sign(token_id + 1, "dsatok"))
+    assert (await actor_for(other_token))["id"] == "other"
+
+    # Expiry deadlines are checked in memory
+    index.tokens[token_id + 1].expires_at = time.time() - 1
+    assert await actor_for(other_token) is None
+
+
+@pytest.mark.asyncio
+async def test_memory_index_sees_local_revoke(ds_memory_index):
+    ds = ds_memory_index
+    token_id, token = await _create_token(ds)
+    headers = {"Authorization": "Bearer {}".format(token)}
+    assert (await ds.client.get("/-/actor.json", headers=headers)).json()["actor"]
+    cookies = {"ds_actor": ds.client.actor_cookie({"id": "root"})}
+    details = await ds.client.get(f"/-/api/tokens/{token_id}", cookies=cookies)
+    cookies["ds_csrftoken"] = details.cookies["ds_csrftoken"]
+    await ds.client.post(
+        f"/-/api/tokens/{token_id}",
+        data={"revoke": "1", "csrftoken": cookies["ds_csrftoken"]},
+        cookies=cookies,
+    )
+    assert (await ds.client.get("/-/actor.json", headers=headers)).json() == {
+        "actor": None
+    }
+
+
+def test_memory_index_size_per_100k_tokens():
+    from datasette_auth_tokens.index import TokenRecord
+    import tracemalloc
+
+    tracemalloc.start()
+    try:
+        tokens = {}
+        parsed_permissions = {}
+        for i in range(100_000):
+            row = {
+                "id": i,
+                "actor_id": "user-{}".format(i % 1000),
+                "permissions": '{"r": {"demo": {"foo": ["vt"]}}}',
+                "created_timestamp": 1700000000,
+                "expires_after_seconds": 3600 if i % 2 else None,
+                "last_used_timestamp": 1700000000 + i,
+                "rate_limit_per_minute": None,
+            }
+            tokens[i] = TokenRecord.from_row(row, parsed_permissions)
+        used = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    # Documented in the README as roughly 21MB
+    assert used < 32 * 1024 * 1024
+
+
+def test_snapshot_file_roundtrip(tmp_path):
+    from datasette_auth_tokens.snapshot import SnapshotReader, write_snapshot
+
+    path = str(tmp_path / "tokens.snapshot")
+    restricted = '{"a": ["vi"]}'
+    write_snapshot(
+        path,
+        [
+            (5, "bob", restricted, None, None),
+            (2, "alice", "null", 1000, 60),
+            (9, 3, None, None, None),
+        ],
+        max_ids=[10],
+        version=7,
+    )
+    reader = SnapshotReader(path)
+    snapshot = reader.current()
+    assert (snapshot.count, snapshot.max_ids, snapshot.version) == (3, (10,), 7)
+    assert snapshot.covers(10) and not snapshot.covers(11)
+    assert snapshot.lookup(2) == ("alice", None, 1000, 60)
+    assert snapshot.lookup(5) == ("bob", {"a": ["vi"]}, None, None)
+    assert snapshot.lookup(9) == (3, None, None, None)
+    for missing in (1, 3, 10):
+        assert snapshot.lookup(missing) is None
+    # Same file means the same mapping
+    assert reader.current() is snapshot
+    # Replacing the file is picked up by the reader
+    write_snapshot(path, [(11, "carol", None, None, None)], max_ids=[11], version=8)
+    assert reader.current().lookup(11) == ("carol", None, None, None)
+    assert reader.current().lookup(5) is None
+
+
+@pytest.mark.asyncio
+async def test_snapshot_shared_between_workers(tmp_path, monkeypatch):
+    import asyncio
+    from datasette_auth_tokens.snapshot import get_snapshot_writer
+
+    tokens_path = tmp_path / "tokens.db"
+    sqlite_utils.Database(tokens_path).vacuum()
+
+    def worker():
+        return Datasette(
+            [tokens_path],
+            secret="shared-secret",
+            plugin_config={
+                "datasette-auth-tokens": {
+                    "manage_tokens": True,
+                    "manage_tokens_database": "tokens",
+                    "snapshot_path": str(tmp_path / "tokens.snapshot"),
+                }
+            },
+            config={"permissions": {"auth-tokens-create": {"id": "*"}}},
+        )
+
+    worker1, worker2 = worker(), worker()
+
+    async def actor_for(ds, token):
+        response = await ds.client.get(
+            "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+        )
+        return response.json()["actor"]
+
+    token_id, token = await _create_token(worker1)
+    await get_snapshot_writer(worker1).wait()
+    assert (await actor_for(worker2, token))["token_id"] == token_id
+    assert (tmp_path / "tokens.snapshot").exists()
+
+    # Hold the next export so the old snapshot stays in place
+    writer = get_snapshot_writer(worker1)
+    release = asyncio.Event()
+    export = writer.export
+
+    async def held_export():
+        await release.wait()
+        await export()
+
+    monkeypatch.setattr(writer, "export", held_export)
+
+    # Revoke through worker 1, worker 2 should see that once exported
+    cookies = {"ds_actor": worker1.client.actor_cookie({"id": "root"})}
+    details = await worker1.client.get(f"/-/api/tokens/{token_id}", cookies=cookies)
+    cookies["ds_csrftoken"] = details.cookies["ds_csrftoken"]
+    await worker1.client.post(
+        f"/-/api/tokens/{token_id}",
+        data={"revoke": "1", "csrftoken": cookies["ds_csrftoken"]},
+        cookies=cookies,
+    )
+    # Worker 1 stops accepting the token straight away
+    assert await actor_for(worker1, token) is None
+    assert (await actor_for(worker2, token))["token_id"] == token_id
+    release.set()
+    await writer.wait()
+    assert writer.ended == set()
+    assert await actor_for(worker2, token) is None
+    assert await actor_for(worker1, token) is None
+
+
+@pytest.mark.asyncio
+async def test_concurrent_lookups_are_coalesced(ds_managed, monkeypatch):
+    import asyncio
+
+    token_id, token = await _create_token(ds_managed)
+    db = ds_managed.get_internal_database()
+    queries = []
+    original_execute = db.execute
+
+    async def counting_execute(sql, *args, **kwargs):
+        if "from _datasette_auth_tokens where id" in sql:
+            queries.append(sql)
+        return await original_execute(sql, *args, **kwargs)
+
+    monkeypatch.setattr(db, "execute", counting_execute)
+    headers = {"Authorization": "Bearer {}".format(token)}
+    responses = await asyncio.gather(
+        *[ds_managed.client.get("/-/actor.json", headers=headers) for _ in range(50)]
+    )
+    assert all(
+        response.json()["actor"]["token_id"] == token_id for response in responses
+    )
+    # Without coalescing this would be 50 queries
+    assert len(queries) < 5
+
+
+@pytest.mark.asyncio
+async def test_stale_while_revalidate(db_path, monkeypatch):
+    import asyncio
+
+    ds = Datasette(
+        [db_path],
+        plugin_config={
+            "datasette-auth-tokens": {
+                "manage_tokens": True,
+                "lookup_timeout_ms": 50,
+                "stale_seconds": 60,
+            }
+        },
+        config={
+            "permissions": {
+                "auth-tokens-create": {"id": "*"},
+                "auth-tokens-view-all": {"id": "admin"},
+            }
+        },
+    )
+    token_id, token = await _create_token(ds)
+    revoked_id, revoked_token = await _create_token(ds)
+    db = ds.get_internal_database()
+    expected = {"id": "root", "token": "dsatok", "token_id": token_id}
+
+    async def actor_for(token):
+        response = await ds.client.get(
+            "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+        )
+        return response.json()["actor"]
+
+    # Prime the last-known-good cache
+    assert await actor_for(token) == expected
+    assert (await actor_for(revoked_token))["token_id"] == revoked_id
+    await db.execute_write(
+        "update _datasette_auth_tokens set token_status = 'R' where id = :id",
+        {"id": revoked_id},
+    )
+    assert await actor_for(revoked_token) is None
+
+    # Now make the database slow
+    release = asyncio.Event()
+    original_execute_write_fn = db.execute_write_fn
+
+    async def slow_execute_write_fn(*args, **kwargs):
+        await release.wait()
+        return await original_execute_write_fn(*args, **kwargs)
+
+    monkeypatch.setattr(db, "execute_write_fn", slow_execute_write_fn)
+    # Served from cache without waiting for the database
+    assert await actor_for(token) == expected
+
+    # Revocations that have been seen always win, even while slow
+    revoked_request = asyncio.ensure_future(actor_for(revoked_token))
+    await asyncio.sleep(0.2)
+    assert not revoked_request.done()
+    release.set()
+    assert await revoked_request is None
+
+    metrics = await ds.client.get(
+        "/-/api/tokens/metrics",
+        cookies={"ds_actor": ds.client.actor_cookie({"id": "admin"})},
+    )
+    assert metrics.json() == {
+        "lookup_timeouts": 2,
+        "stale_served": 1,
+        "stale_unavailable": 1,
+        "token_counts": {"active": 1, "revoked": 1, "expired": 0},
+    }
+    anonymous = await ds.client.get("/-/api/tokens/metrics")
+    assert anonymous.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_token(ds_managed):
+    root_cookie = ds_managed.client.actor_cookie({"id": "root"})
+    create_page = await ds_managed.client.get(
+        "/-/api/tokens/create", cookies={"ds_actor": root_cookie}
+    )
+    csrftoken = create_page.cookies["ds_csrftoken"]
+    response = await ds_managed.client.post(
+        "/-/api/tokens/create",
+        data={"csrftoken": csrftoken, "rate_limit_per_minute": "3"},
+        cookies={"ds_actor": root_cookie, "ds_csrftoken": csrftoken},
+    )
+    token = response.text.split('class="copyable" style="width: 40%" value="')[1].split(
+        '"'
+    )[0]
+    token_id = ds_managed.unsign(token.split("dsatok_")[1], namespace="dsatok")
+    headers = {"Authorization": "Bearer {}".format(token)}
+    statuses = [
+        (await ds_managed.client.get("/-/actor.json", headers=headers)).status_code
+        for _ in range(5)
+    ]
+    assert statuses == [200, 200, 200, 429, 429]
+    limited = await ds_managed.client.get("/-/actor.json", headers=headers)
+    assert limited.json()["status"] == 429
+    assert int(limited.headers["retry-after"]) >= 1
+    # Other tokens are unaffected
+    _, other_token = await _create_token(ds_managed)
+    other = await ds_managed.client.get(
+        "/-/actor.json", headers={"Authorization": "Bearer {}".format(other_token)}
+    )
+    assert other.status_code == 200
+    # Shown on the token page and counted in metrics
+    details = await ds_managed.client.get(
+        f"/-/api/tokens/{token_id}", cookies={"ds_actor": root_cookie}
+    )
+    assert "3 requests per minute" in details.text
+    metrics = await ds_managed.client.get(
+        "/-/api/tokens/metrics",
+        cookies={"ds_actor": ds_managed.client.actor_cookie({"id": "admin"})},
+    )
+    assert metrics.json()["rate_limited"] == 3
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "data,error",
+    (
+        ({"rate_limit_per_minute": "lots"}, "Invalid rate limit"),
+        ({"rate_limit_per_minute": "0"}, "Invalid rate limit"),
+        ({"expire_type": "hours", "expire_duration": "-1"}, "Invalid expire duration"),
+    ),
+)
+async def test_create_token_form_errors(ds_managed, data, error):
+    root_cookie = ds_managed.client.actor_cookie({"id": "root"})
+    create_page = await ds_managed.client.get(
+        "/-/api/tokens/create", cookies={"ds_actor": root_cookie}
+    )
+    csrftoken = create_page.cookies["ds_csrftoken"]
+    response = await ds_managed.client.post(
+        "/-/api/tokens/create",
+        data=dict(data, csrftoken=csrftoken),
+        cookies={"ds_actor": root_cookie, "ds_csrftoken": csrftoken},
+    )
+    assert response.status_code == 400
+    assert error in response.text
+    assert 'class="copyable"' not in response.text
+    # No token was created
+    db = ds_managed.get_internal_database()
+    assert (
+        await db.execute("select count(*) from _datasette_auth_tokens")
+    ).single_value() == 0
+
+
+def test_rate_limiter_refills(monkeypatch):
+    from collections import Counter
+    from datasette_auth_tokens import ratelimit
+
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    metrics = Counter()
+    limiter = ratelimit.RateLimiter(metrics, max_buckets=2)
+    for _ in range(60):
+        limiter.check(1, 60)
+    with pytest.raises(ratelimit.TokenRateLimited) as ex:
+        limiter.check(1, 60)
+    assert ex.value.retry_after == pytest.approx(1)
+    assert metrics["rate_limited"] == 1
+    # One request a second at 60 a minute
+    now[0] += 1
+    limiter.check(1, 60)
+    # Buckets beyond max_buckets are evicted, least recently used first
+    limiter.check(2, 60)
+    limiter.check(3, 60)
+    assert list(limiter._buckets) == [2, 3]
+
+
+@pytest.mark.asyncio
+async def test_archive_ended_tokens(db_path, tmp_path):
+    from datasette_auth_tokens.archive import archive_ended_tokens
+    from datasette_auth_tokens.views import Config
+
+    ds = Datasette(
+        [db_path],
+        plugin_config={
+            "datasette-auth-tokens": {
+                "manage_tokens": True,
+                "manage_tokens_path": str(tmp_path / "token-store.db"),
+            }
+        },
+        config={"permissions": {"auth-tokens-create": {"id": "*"}}},
+    )
+    ids = [(await _create_token(ds))[0] for _ in range(5)]
+    db = Config(ds).db
+    long_ago = int(time.time()) - 60 * 24 * 60 * 60
+    # Revoke all but the second token, three of them long ago
+    await db.execute_write(
+        """
+        update _datasette_auth_tokens set token_status = 'R', ended_timestamp = :ended
+        where id != :active
+        """,
+        {"ended": long_ago, "active": ids[1]},
+    )
+    await db.execute_write(
+        "update _datasette_auth_tokens set ended_timestamp = :now where id = :id",
+        {"now": int(time.time()), "id": ids[2]},
+    )
+    assert await archive_ended_tokens(ds, 30, batch_size=1) == 2
+    remaining = [
+        row["id"]
+        for row in (await db.execute("select id from _datasette_auth_tokens")).rows
+    ]
+    # The newest token is kept so its ID is never handed out again
+    assert remaining == [ids[1], ids[2], ids[4]]
+    archived = [
+        row["id"]
+        for row in (
+            await db.execute("select id from _datasette_auth_tokens_archive")
+        ).rows
+    ]
+    assert archived == [ids[0], ids[3]]
+    # Archived tokens can still be looked up
+    response = await ds.client.get(
+        "/-/api/tokens/{}".format(ids[0]),
+        cookies={"ds_actor": ds.client.actor_cookie({"id": "root"})},
+    )
+    assert response.status_code == 200
+    assert "(archived " in response.text
+    assert "Revoke this token" not in response.text
+    # Running again finds nothing new
+    assert await archive_ended_tokens(ds, 30, batch_size=1) == 0
+
+
+@pytest.mark.asyncio
+async def test_revoke_after_archive_reaches_memory_index(ds_memory_index):
+    from datasette_auth_tokens.archive import archive_ended_tokens
+    from datasette_auth_tokens.index import get_token_index
+
+    ds = ds_memory_index
+    db = ds.get_internal_database()
+    (first_id, _), (second_id, second_token), _ = [
+        await _create_token(ds) for _ in range(3)
+    ]
+    headers = {"Authorization": "Bearer {}".format(second_token)}
+    assert (await ds.client.get("/-/actor.json", headers=headers)).json()["actor"]
+    # The first token ended long ago and holds the latest changed_at
+    await db.execute_write(
+        """
+        update _datasette_auth_tokens set token_status = 'R', ended_timestamp = 0
+        where id = :id
+        """,
+        {"id": first_id},
+    )
+    index = get_token_index(ds)
+    await index.refresh()
+    assert await archive_ended_tokens(ds, 30) == 0
+    # Revoked by another process - the index must see it as a newer change
+    await db.execute_write(
+        "update _datasette_auth_tokens set token_status = 'R' where id = :id",
+        {"id": second_id},
+    )
+    await index.refresh()
+    assert second_id not in index.tokens
+    assert (await ds.client.get("/-/actor.json", headers=headers)).json() == {
+        "actor": None
+    }
+
+
+@pytest.mark.asyncio
+async def test_startup_skips_migrations_when_current(db_path, tmp_path, monkeypatch):
+    import datasette_auth_tokens
+
+    plugin_config = {
+        "datasette-auth-tokens": {
+            "manage_tokens": True,
+            "manage_tokens_path": str(tmp_path / "token-store.db"),
+        }
+    }
+    await Datasette([db_path], plugin_config=plugin_config).invoke_startup()
+
+    def migrate(conn):
+        assert False, "Should not have migrated"
+
+    monkeypatch.setattr(datasette_auth_tokens, "migrate", migrate)
+    await Datasette([db_path], plugin_config=plugin_config).invoke_startup()
+
+
+@pytest.mark.asyncio
+async def test_backfill_runs_in_batches(db_path):
+    from datasette_auth_tokens.backfill import Backfills, run_backfills
+    from datasette_auth_tokens.views import Config
+
+    ds = Datasette(
+        [db_path],
+        plugin_config={
+            "datasette-auth-tokens": {
+                "manage_tokens": True,
+                "backfill_batch_size": 2,
+            }
+        },
+        config={
+            "permissions": {
+                "auth-tokens-create": {"id": "*"},
+                "auth-tokens-view-all": {"id": "admin"},
+            }
+        },
+    )
+    ids = [(await _create_token(ds))[0] for _ in range(5)]
+    registered = Backfills()
+    batches = []
+
+    @registered()
+    def b001_mark_descriptions(conn, ids):
+        batches.append(ids)
+        conn.execute(
+            "update _datasette_auth_tokens set description = 'BACKFILLED' "
+            "where id in ({})".format(", ".join("?" for _ in ids)),
+            ids,
+        )
+
+    await run_backfills(ds, registered)
+    assert batches == [ids[0:2], ids[2:4], ids[4:]]
+    db = Config(ds).db
+    assert [
+        row[0]
+        for row in (
+            await db.execute("select description from _datasette_auth_tokens")
+        ).rows
+    ] == ["BACKFILLED"] * 5
+    response = await ds.client.get(
+        "/-/api/tokens/backfills",
+        cookies={"ds_actor": ds.client.actor_cookie({"id": "admin"})},
+    )
+    # The plugin's own backfills are listed too
+    progress = [
+        info
+        for info in response.json()["backfills"]
+        if info["name"] == "b001_mark_descriptions"
+    ]
+    assert len(progress) == 1
+    assert progress[0]["rows_done"] == 5
+    assert progress[0]["percent"] == 100.0
+    assert progress[0]["completed_timestamp"]
+    # Completed backfills are not run again
+    await run_backfills(ds, registered)
+    assert len(batches) == 3
+    response = await ds.client.get(
+        "/-/api/tokens/backfills",
+        cookies={"ds_actor": ds.client.actor_cookie({"id": "root"})},
+    )
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_no_create_token_link_when_managed_tokens_disabled(db_path):
+    ds = Datasette(
+        [db_path],
+        plugin_config={"datasette-auth-tokens": {"tokens": []}},
+        config={"permissions": {"auth-tokens-create": {"id": "*"}}},
+    )
+    response = await ds.client.get(
+        "/", cookies={"ds_actor": ds.client.actor_cookie({"id": "root"})}
+    )
+    assert response.status_code == 200
+    assert "/-/api/tokens/create" not in response.text
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("source", ("database", "memory_index", "snapshot"))
+async def test_introspect_tokens(db_path, tmp_path, source):
+    from datasette_auth_tokens.children import sign_child_token
+
+    plugin_config = {"manage_tokens": True, "introspect_max_tokens": 5}
+    if source == "memory_index":
+        plugin_config["memory_index"] = True
+    elif source == "snapshot":
+        plugin_config["snapshot_path"] = str(tmp_path / "tokens.snapshot")
+    ds = Datasette(
+        [db_path],
+        plugin_config={"datasette-auth-tokens": plugin_config},
+        config={
+            "permissions": {
+                "auth-tokens-create": {"id": "*"},
+                "auth-tokens-introspect": {"id": "gateway"},
+            }
+        },
+    )
+    await ds.invoke_startup()
+    active_id, active = await _create_token(ds)
+    revoked_id, revoked = await _create_token(ds)
+    expired_id, expired = await _create_token(ds)
+    db = ds.get_internal_database()
+    await db.execute_write(
+        "update _datasette_auth_tokens set token_status = 'R' where id = ?",
+        (revoked_id,),
+    )
+    await db.execute_write(
+        """
+        update _datasette_auth_tokens
+        set created_timestamp = :created, expires_after_seconds = 60
+        where id = :id
+        """,
+        {"created": int(time.time()) - 120, "id": expired_id},
+    )
+    if source == "memory_index":
+        from datasette_auth_tokens.index import get_token_index
+
+        await get_token_index(ds).refresh()
+    elif source == "snapshot":
+        from datasette_auth_tokens.snapshot import get_snapshot_writer
+
+        await get_snapshot_writer(ds).export()
+
+    gateway_cookie = ds.client.actor_cookie({"id": "gateway"})
+    # No CSRF token is needed
+    response = await ds.client.post(
+        "/-/api/tokens/introspect",
+        json={"tokens": [active, revoked, expired, "dsatok_garbage", 5]},
+        cookies={"ds_actor": gateway_cookie},
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        "ok": True,
+        "tokens": [
+            {
+                "active": True,
+                "token_id": active_id,
+                "actor": {"id": "root", "token": "dsatok", "token_id": active_id},
+                "restrictions": None,
+                "expires_at": None,
+            },
+            {"active": False},
+            {"active": False},
+            {"active": False},
+            {"active": False},
+        ],
+    }
+    # Child tokens are checked against their parent
+    deadline = int(time.time()) + 60
+    restrictions = {"a": ["vi"]}
+    response = await ds.client.post(
+        "/-/api/tokens/introspect",
+        json={
+            "tokens": [
+                sign_child_token(ds, active_id, deadline, restrictions),
+                sign_child_token(ds, revoked_id, deadline),
+                sign_child_token(ds, active_id, int(time.time()) - 1),
+                "dsatokc_garbage",
+            ]
+        },
+        cookies={"ds_actor": gateway_cookie},
+    )
+    assert response.json()["tokens"] == [
+        {
+            "active": True,
+            "token_id": active_id,
+            "actor": {
+                "id": "root",
+                "token": "dsatok_child",
+                "token_id": active_id,
+                "_r": restrictions,
+            },
+            "restrictions": restrictions,
+            "expires_at": deadline,
+        },
+        {"active": False},
+        {"active": False},
+        {"active": False},
+    ]
+    # Introspection does not count as using the token
+    assert (
+        await db.execute(
+            "select last_used_timestamp from _datasette_auth_tokens where id = ?",
+            (active_id,),
+        )
+    ).single_value() is None
+
+    too_many = await ds.client.post(
+        "/-/api/tokens/introspect",
+        json={"tokens": [active] * 6},
+        cookies={"ds_actor": gateway_cookie},
+    )
+    assert too_many.status_code == 400
+    assert too_many.json()["errors"] == ["Too many tokens, the maximum is 5"]
+    bad = await ds.client.post(
+        "/-/api/tokens/introspect",
+        content="not json",
+        cookies={"ds_actor": gateway_cookie},
+    )
+    assert bad.status_code == 400
+    forbidden = await ds.client.post(
+        "/-/api/tokens/introspect",
+        json={"tokens": [active]},
+        cookies={"ds_actor": ds.client.actor_cookie({"id": "root"})},
+    )
+    assert forbidden.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_child_tokens(ds_managed, monkeypatch):
+    import datasette_auth_tokens
+    from datasette_auth_tokens.children import sign_child_token
+
+    parent_id, parent = await _create_token(ds_managed)
+    db = ds_managed.get_internal_database()
+
+    async def mint(token, **body):
+        return await ds_managed.client.post(
+            "/-/api/tokens/child",
+            json=body,
+            headers={"Authorization": "Bearer {}".format(token)},
+        )
+
+    async def actor_for(token):
+        response = await ds_managed.client.get(
+            "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+        )
+        return response.json()["actor"]
+
+    response = await mint(parent, expires_after=60)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["parent_token_id"] == parent_id
+    assert data["expires_at"] == pytest.approx(time.time() + 60, abs=5)
+    child = data["token"]
+    assert child.startswith("dsatokc_")
+
+    # Only the parent's status is looked up, and it is then cached
+    lookups = []
+    original_lookup = datasette_auth_tokens._lookup_managed
+
+    async def counting_lookup(datasette, token_id):
+        lookups.append(token_id)
+        return await original_lookup(datasette, token_id)
+
+    monkeypatch.setattr(datasette_auth_tokens, "_lookup_managed", counting_lookup)
+    for _ in range(3):
+        assert await actor_for(child) == {
+            "id": "root",
+            "token": "dsatok_child",
+            "token_id": parent_id,
+        }
+    assert lookups == [parent_id]
+
+    # Expired children are rejected without a lookup
+    expired = sign_child_token(ds_managed, parent_id, int(time.time()) - 1)
+    assert await actor_for(expired) is None
+    assert lookups == [parent_id]
+
+    # Children cannot mint further children, or outlive the limit
+    assert (await mint(child, expires_after=60)).status_code == 403
+    too_long = await mint(parent, expires_after=24 * 60 * 60)
+    assert too_long.status_code == 400
+
+    # Children can be restricted further than their parent, but not less
+    await db.execute_write(
+        "update _datasette_auth_tokens set permissions = :p where id = :id",
+        {"p": '{"d": {"demo": ["vd", "vt"]}}', "id": parent_id},
+    )
+    datasette_auth_tokens.forget_token(ds_managed, parent_id)
+    narrower = await mint(
+        parent,
+        expires_after=60,
+        restrictions={"r": {"demo": {"foo": ["view-table"]}}},
+    )
+    assert narrower.status_code == 200
+    assert (await actor_for(narrower.json()["token"]))["_r"] == {
+        "r": {"demo": {"foo": ["view-table"]}}
+    }
+    inherited = await mint(parent, expires_after=60)
+    assert (await actor_for(inherited.json()["token"]))["_r"] == {
+        "d": {"demo": ["vd", "vt"]}
+    }
+    for restrictions in (
+        {"a": ["view-table"]},
+        {"d": {"other": ["vd"]}},
+        {"r": {"demo": {"foo": ["insert-row"]}}},
+    ):
+        wider = await mint(parent, expires_after=60, restrictions=restrictions)
+        assert wider.status_code == 400
+        assert wider.json()["errors"] == [
+            "Child token restrictions must be within those of the parent token"
+        ]
+    # A restricted parent can never mint an unrestricted child
+    for restrictions in ({}, {"a": [], "d": {}}, {"r": {"demo": {"foo": []}}}):
+        empty = await mint(parent, expires_after=60, restrictions=restrictions)
+        assert empty.status_code == 400
+        assert empty.json()["errors"] == [
+            "Child token restrictions must allow at least one action"
+        ]
+    for response in (narrower, inherited):
+        assert "_r" in await actor_for(response.json()["token"])
+    # Children signed with empty restrictions are allowed nothing
+    signed_empty = sign_child_token(ds_managed, parent_id, int(time.time()) + 60, {})
+    assert (await actor_for(signed_empty))["_r"] == {}
+
+    # Revoking the parent revokes its children
+    await db.execute_write(
+        "update _datasette_auth_tokens set token_status = 'R' where id = ?",
+        (parent_id,),
+    )
+    datasette_auth_tokens.forget_token(ds_managed, parent_id)
+    assert await actor_for(child) is None
+
+
+def _listed_token_ids(response):
+    return [
+        int(bit.split('">')[0])
+        for bit in response.text.split('<td><a href="tokens/')[1:]
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("source", ("database", "memory_index", "snapshot"))
+async def test_sharded_token_storage(db_path, tmp_path, source):
+    from datasette_auth_tokens import revoke_tokens
+    from datasette_auth_tokens.views import Config
+
+    shard_paths = [str(tmp_path / "shard-{}.db".format(i)) for i in range(3)]
+    plugin_config = {"manage_tokens": True, "manage_tokens_shards": shard_paths}
+    if source == "memory_index":
+        plugin_config["memory_index"] = True
+    elif source == "snapshot":
+        plugin_config["snapshot_path"] = str(tmp_path / "tokens.snapshot")
+    ds = Datasette(
+        [db_path],
+        plugin_config={"datasette-auth-tokens": plugin_config},
+        config={
+            "permissions": {
+                "auth-tokens-create": {"id": "*"},
+                "auth-tokens-view-all": {"id": "admin"},
+            }
+        },
+    )
+    await ds.invoke_startup()
+    # Every shard is migrated
+    for path in shard_paths:
+        assert "_datasette_auth_tokens" in sqlite_utils.Database(path).table_names()
+
+    actors = ["alice", "bob", "carol", "dave", "erin", "frank"]
+    tokens = {}
+    for actor_id in actors:
+        for _ in range(2):
+            token_id, token = await _create_token(ds, actor_id)
+            tokens[token_id] = (actor_id, token)
+    assert len(tokens) == len(actors) * 2
+    config = Config(ds)
+    for token_id, (actor_id, token) in tokens.items():
+        # Each token is stored in the shard its ID maps to, alongside the
+        # other tokens for the same actor
+        shard = config.shard_index_for_actor(actor_id)
+        assert (token_id - 1) % 3 == shard
+        assert token_id in [
+            row["id"]
+            for row in sqlite_utils.Database(shard_paths[shard]).query(
+                "select id from _datasette_auth_tokens"
+            )
+        ]
+        response = await ds.client.get(
+            "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+        )
+        assert response.json()["actor"] == {
+            "id": actor_id,
+            "token": "dsatok",
+            "token_id": token_id,
+        }
+    # Actors were spread across more than one shard
+    assert len({config.shard_index_for_actor(actor) for actor in actors}) > 1
+
+    admin = {"ds_actor": ds.client.actor_cookie({"id": "admin"})}
+    assert _listed_token_ids(await ds.client.get("/-/api/tokens", cookies=admin)) == (
+        sorted(tokens, reverse=True)
+    )
+    alice = {"ds_actor": ds.client.actor_cookie({"id": "alice"})}
+    assert _listed_token_ids(await ds.client.get("/-/api/tokens", cookies=alice)) == (
+        sorted(
+            (id for id, (actor_id, _) in tokens.items() if actor_id == "alice"),
+            reverse=True,
+        )
+    )
+    some_id = max(tokens)
+    response = await ds.client.get("/-/api/tokens/{}".format(some_id), cookies=admin)
+    assert response.status_code == 200
+
+    # Bulk revoke reaches every shard
+    revoked = await revoke_tokens(ds, token_ids=list(tokens)[:6], revoked_by="admin")
+    assert revoked == sorted(list(tokens)[:6])
+    assert await revoke_tokens(ds, actor_id="frank") == sorted(
+        id for id, (actor_id, _) in tokens.items() if actor_id == "frank"
+    )
+    if source == "snapshot":
+        from datasette_auth_tokens.snapshot import get_snapshot_writer
+
+        await get_snapshot_writer(ds).wait()
+    for token_id, (actor_id, token) in tokens.items():
+        response = await ds.client.get(
+            "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+        )
+        expected_active = token_id not in revoked and actor_id != "frank"
+        assert (response.json()["actor"] is not None) == expected_active
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("source", ("memory_index", "snapshot"))
+async def test_sharded_cache_covers_skewed_shards(
+    db_path, tmp_path, source, monkeypatch
+):
+    import datasette_auth_tokens.storage
+    from datasette_auth_tokens import revoke_tokens
+    from datasette_auth_tokens.index import get_token_index
+    from datasette_auth_tokens.snapshot import get_snapshot_writer
+    from datasette_auth_tokens.views import Config
+
+    shard_paths = [str(tmp_path / "shard-{}.db".format(i)) for i in range(2)]
+    plugin_config = {"manage_tokens": True, "manage_tokens_shards": shard_paths}
+    if source == "memory_index":
+        plugin_config["memory_index"] = True
+    else:
+        plugin_config["snapshot_path"] = str(tmp_path / "tokens.snapshot")
+    ds = Datasette(
+        [db_path],
+        plugin_config={"datasette-auth-tokens": plugin_config},
+        config={"permissions": {"auth-tokens-create": {"id": "*"}}},
+    )
+    await ds.invoke_startup()
+    config = Config(ds)
+    # One busy actor, and one token in the other shard
+    busy = "alice"
+    quiet = next(
+        actor_id
+        for actor_id in ("bob", "carol", "dave", "erin")
+        if config.shard_index_for_actor(actor_id) != config.shard_index_for_actor(busy)
+    )
+    tokens = [await _create_token(ds, quiet)]
+    tokens += [await _create_token(ds, busy) for _ in range(6)]
+    revoked_id, revoked_token = tokens.pop(3)
+    await revoke_tokens(ds, token_ids=[revoked_id])
+    if source == "snapshot":
+        await get_snapshot_writer(ds).wait()
+    else:
+        await get_token_index(ds).refresh()
+        refreshes = []
+
+        async def refresh():
+            refreshes.append(1)
+
+        monkeypatch.setattr(get_token_index(ds), "refresh", refresh)
+
+    def no_database(datasette):
+        raise AssertionError("Should not have gone to the database")
+
+    # Every token is found in the snapshot or index, in either shard
+    monkeypatch.setattr(datasette_auth_tokens.storage, "get_storage", no_database)
+    for token_id, token in tokens:
+        response = await ds.client.get(
+            "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+        )
+        assert response.json()["actor"]["token_id"] == token_id
+    # Including a miss, which is known to be inactive rather than newer
+    response = await ds.client.get(
+        "/-/actor.json", headers={"Authorization": "Bearer {}".format(revoked_token)}
+    )
+    assert response.json()["actor"] is None
+    if source == "memory_index":
+        assert refreshes == []
+
+
+@pytest.mark.asyncio
+async def test_tokens_index_only_lists_own_tokens(ds_managed):
+    root_id, _ = await _create_token(ds_managed, "root")
+    other_id, _ = await _create_token(ds_managed, "other")
+    response = await ds_managed.client.get(
+        "/-/api/tokens",
+        cookies={"ds_actor": ds_managed.client.actor_cookie({"id": "other"})},
+    )
+    assert _listed_token_ids(response) == [other_id]
+    # Anonymous requests see nothing at all
+    for path in ("/-/api/tokens", "/-/api/tokens.json"):
+        response = await ds_managed.client.get(path)
+        assert response.status_code == 403
+        assert "root" not in response.text
+
+
+@pytest.mark.asyncio
+async def test_read_replica(db_path, tmp_path):
+    import asyncio
+    import sqlite3
+    from datasette_auth_tokens.replica import get_replica_guard
+
+    primary_path = str(tmp_path / "primary.db")
+    replica_path = str(tmp_path / "replica.db")
+    ds = Datasette(
+        [db_path],
+        plugin_config={
+            "datasette-auth-tokens": {
+                "manage_tokens": True,
+                "manage_tokens_path": primary_path,
+                "manage_tokens_replica_path": replica_path,
+                "replica_max_lag_seconds": 0.5,
+                "replica_check_seconds": 0.1,
+            }
+        },
+        config={"permissions": {"auth-tokens-create": {"id": "*"}}},
+    )
+    await ds.invoke_startup()
+
+    def replicate():
+        source = sqlite3.connect(primary_path)
+        destination = sqlite3.connect(replica_path)
+        source.backup(destination)
+        source.close()
+        destination.close()
+
+    async def actor_for(token):
+        response = await ds.client.get(
+            "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+        )
+        return response.json()["actor"]
+
+    guard = get_replica_guard(ds)
+    token_id, token = await _create_token(ds)
+    # This process just wrote to the primary, which the replica does not have
+    await guard.check(0)
+    assert not guard.use_replica(0)
+    assert (await actor_for(token))["token_id"] == token_id
+
+    replicate()
+    await guard.check(0)
+    assert guard.use_replica(0)
+    assert (await actor_for(token))["token_id"] == token_id
+
+    # Revoked on the primary by another process: the lagging replica is
+    # trusted until replica_max_lag_seconds have passed
+    with sqlite3.connect(primary_path) as conn:
+        conn.execute(
+            "update _datasette_auth_tokens set token_status = 'R' where id = ?",
+            [token_id],
+        )
+    await guard.check(0)
+    assert guard.use_replica(0)
+    assert await actor_for(token) is not None
+    await asyncio.sleep(0.6)
+    assert not guard.use_replica(0)
+    assert await actor_for(token) is None
+
+    # Once it catches up the replica is used again
+    replicate()
+    await guard.check(0)
+    assert guard.use_replica(0)
+    assert await actor_for(token) is None
+
+
+@pytest.mark.asyncio
+async def test_token_details_json(ds_managed):
+    token_id, token = await _create_token(ds_managed)
+    cookies = {"ds_actor": ds_managed.client.actor_cookie({"id": "root"})}
+    path = "/-/api/tokens/{}.json".format(token_id)
+    response = await ds_managed.client.get(path, cookies=cookies)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["id"] == token_id
+    assert data["actor_id"] == "root"
+    assert data["status"] == "Active"
+    assert data["last_used_timestamp"] is None
+    assert data["can_revoke"]
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == "private, no-cache"
+
+    # Unchanged token gives a 304
+    response = await ds_managed.client.get(
+        path, cookies=cookies, headers={"if-none-match": etag}
+    )
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert response.text == ""
+
+    # Using the token changes last_used_timestamp and so the ETag
+    await ds_managed.client.get(
+        "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+    )
+    response = await ds_managed.client.get(
+        path, cookies=cookies, headers={"if-none-match": etag}
+    )
+    assert response.status_code == 200
+    assert response.json()["last_used_timestamp"] is not None
+    etag = response.headers["etag"]
+
+    # Other users cannot see it
+    response = await ds_managed.client.get(
+        path, cookies={"ds_actor": ds_managed.client.actor_cookie({"id": "other"})}
+    )
+    assert response.status_code == 403
+
+    # Revoking returns the updated token
+    response = await ds_managed.client.post(
+        path,
+        cookies=cookies,
+        content='{"revoke": true}',
+        headers={"content-type": "application/json"},
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["status"] == "Revoked"
+    assert data["ended_timestamp"] is not None
+    assert not data["can_revoke"]
+    assert response.headers["etag"] != etag
+
+
+@pytest.mark.asyncio
+async def test_token_details_revokes_without_a_second_read(ds_managed, monkeypatch):
+    token_id, _ = await _create_token(ds_managed)
+    db = ds_managed.get_internal_database()
+    reads = []
+    original_execute = db.execute
+
+    async def counting_execute(sql, *args, **kwargs):
+        if "from _datasette_auth_tokens" in sql:
+            reads.append(sql)
+        return await original_execute(sql, *args, **kwargs)
+
+    monkeypatch.setattr(db, "execute", counting_execute)
+    response = await ds_managed.client.post(
+        "/-/api/tokens/{}.json".format(token_id),
+        cookies={"ds_actor": ds_managed.client.actor_cookie({"id": "root"})},
+        content='{"revoke": true}',
+        headers={"content-type": "application/json"},
+    )
+    assert response.json()["status"] == "Revoked"
+    # The updated row comes back from the UPDATE ... RETURNING itself
+    assert len(reads) == 1
+
+
+@pytest.mark.asyncio
+async def test_token_details_expires_with_single_update(ds_managed):
+    token_id, _ = await _create_token(ds_managed)
+    db = ds_managed.get_internal_database()
+    await db.execute_write(
+        "update _datasette_auth_tokens set created_timestamp = :created, expires_after_seconds = 60 where id = :id",
+        {"id": token_id, "created": time.time() - 120},
+    )
+    response = await ds_managed.client.get(
+        "/-/api/tokens/{}.json".format(token_id),
+        cookies={"ds_actor": ds_managed.client.actor_cookie({"id": "root"})},
+    )
+    data = response.json()
+    assert data["status"] == "Expired"
+    assert data["ended_timestamp"] is not None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("path", ("/-/api/tokens", "/-/api/tokens.json"))
+async def test_tokens_index_etag(ds_managed, path, monkeypatch):
+    await ds_managed.invoke_startup()
+    cookies = {"ds_actor": ds_managed.client.actor_cookie({"id": "root"})}
+
+    async def fetch(etag=None):
+        headers = {"if-none-match": etag} if etag else {}
+        return await ds_managed.client.get(path, cookies=cookies, headers=headers)
+
+    token_id, token = await _create_token(ds_managed)
+    response = await fetch()
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    if path.endswith(".json"):
+        assert [t["id"] for t in response.json()["tokens"]] == [token_id]
+        assert response.json()["tokens"][0]["status"] == "Active"
+    response = await fetch(etag)
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+
+    # A different actor sees a different listing
+    other = await ds_managed.client.get(
+        path, cookies={"ds_actor": ds_managed.client.actor_cookie({"id": "other"})}
+    )
+    assert other.headers["etag"] != etag
+
+    # Using the token updates last_used_timestamp, changing the listing
+    await ds_managed.client.get(
+        "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+    )
+    response = await fetch(etag)
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+
+    # Once a token is due to expire the listing is no longer answered with
+    # a 304, even though nothing stored has changed yet
+    db = ds_managed.get_internal_database()
+    await db.execute_write(
+        "update _datasette_auth_tokens set expires_after_seconds = 60 where id = :id",
+        {"id": token_id},
+    )
+    response = await fetch()
+    etag = response.headers["etag"]
+    assert (await fetch(etag)).status_code == 304
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 120)
+    response = await fetch(etag)
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    if path.endswith(".json"):
+        assert response.json()["tokens"][0]["status"] == "Expired"
+
+
+@pytest.mark.asyncio
+async def test_tokens_index_search(ds_managed):
+    from datasette_auth_tokens.backfill import b001_index_token_search
+
+    db = ds_managed.get_internal_database()
+    ids = [(await _create_token(ds_managed, "bot"))[0] for _ in range(35)]
+    other_id, _ = await _create_token(ds_managed, "other")
+    for i, token_id in enumerate(ids):
+        await db.execute_write(
+            "update _datasette_auth_tokens set description = ? where id = ?",
+            ["nightly export {}".format(i), token_id],
+        )
+    admin = {"ds_actor": ds_managed.client.actor_cookie({"id": "admin"})}
+
+    async def search(q, cookies=admin, next=None):
+        params = {"q": q}
+        if next:
+            params["next"] = next
+        response = await ds_managed.client.get(
+            "/-/api/tokens.json", params=params, cookies=cookies
+        )
+        assert response.status_code == 200
+        return response.json()
+
+    # Keyset pagination through ranked results
+    page = await search("nightly export")
+    seen = [token["id"] for token in page["tokens"]]
+    assert len(seen) == 30
+    assert page["next"]
+    page = await search("nightly export", next=page["next"])
+    seen.extend(token["id"] for token in page["tokens"])
+    assert page["next"] is None
+    assert sorted(seen) == ids
+
+    # The best match comes first; actor IDs are searched too
+    page = await search("export 7")
+    assert page["tokens"][0]["description"] == "nightly export 7"
+    assert [t["id"] for t in (await search("other"))["tokens"]] == [other_id]
+    # Search syntax in the query is escaped rather than an error
+    assert (await search('"unbalanced OR'))["tokens"] == []
+    # Quotes alone escape to nothing, which lists every token
+    for q in ('"', '""'):
+        assert len((await search(q))["tokens"]) == 30
+
+    # Users without auth-tokens-view-all only find their own tokens
+    other = {"ds_actor": ds_managed.client.actor_cookie({"id": "other"})}
+    assert (await search("nightly", cookies=other))["tokens"] == []
+
+    # The HTML listing keeps the search in the next page link
+    response = await ds_managed.client.get(
+        "/-/api/tokens", params={"q": "nightly"}, cookies=admin
+    )
+    assert 'value="nightly"' in response.text
+    assert "?q=nightly&amp;next=" in response.text
+
+    # Rows that existed before the search index are added by a backfill
+    await db.execute_write("delete from _datasette_auth_tokens_fts")
+    assert (await search("nightly"))["tokens"] == []
+    await db.execute_write_fn(
+        lambda conn: b001_index_token_search(conn, ids + [other_id])
+    )
+    assert len((await search("nightly"))["tokens"]) == 30
+
+
+@pytest.mark.asyncio
+async def test_token_counts_match_tokens_table(ds_managed):
+    from datasette_auth_tokens import expire_tokens, revoke_tokens
+    from datasette_auth_tokens.counts import get_token_counts, rebuild_counts
+
+    db = ds_managed.get_internal_database()
+
+    async def counts_table():
+        return sorted(
+            tuple(row)
+            for row in (
+                await db.execute(
+                    "select actor_id, token_status, count from _datasette_auth_tokens_counts"
+                )
+            ).rows
+        )
+
+    async def grouped():
+        return sorted(tuple(row) for row in (await db.execute("""
+                    select actor_id, token_status, count(*)
+                    from _datasette_auth_tokens group by actor_id, token_status
+                    """)).rows)
+
+    ids = {}
+    for actor_id in ("alice", "bob", "carol"):
+        ids[actor_id] = [
+            (await _create_token(ds_managed, actor_id))[0] for _ in range(3)
+        ]
+    assert await counts_table() == await grouped()
+
+    # Revoke, expire, reassign and delete, as archiving does
+    await revoke_tokens(ds_managed, token_ids=ids["alice"][:2])
+    await db.execute_write(
+        "update _datasette_auth_tokens set expires_after_seconds = 1, created_timestamp = 0 where id = ?",
+        [ids["bob"][0]],
+    )
+    await expire_tokens(ds_managed)
+    await db.execute_write(
+        "update _datasette_auth_tokens set actor_id = 'dave' where id = ?",
+        [ids["carol"][0]],
+    )
+    await db.execute_write(
+        "delete from _datasette_auth_tokens where id = ?", [ids["alice"][2]]
+    )
+    # Updates that leave status and actor alone do not change anything
+    await db.execute_write(
+        "update _datasette_auth_tokens set last_used_timestamp = 1 where id = ?",
+        [ids["bob"][1]],
+    )
+    assert await counts_table() == await grouped()
+    assert await counts_table() == [
+        ("alice", "R", 2),
+        ("bob", "A", 2),
+        ("bob", "E", 1),
+        ("carol", "A", 2),
+        ("dave", "A", 1),
+    ]
+    assert await get_token_counts(ds_managed, "bob") == {
+        "active": 2,
+        "revoked": 0,
+        "expired": 1,
+    }
+    assert await get_token_counts(ds_managed) == {
+        "active": 5,
+        "revoked": 2,
+        "expired": 1,
+    }
+
+    # Rebuilding repairs a counts table that has drifted
+    await db.execute_write("update _datasette_auth_tokens_counts set count = 99")
+    await db.execute_write_fn(rebuild_counts)
+    assert await counts_table() == await grouped()
+
+    response = await ds_managed.client.get(
+        "/-/api/tokens.json",
+        cookies={"ds_actor": ds_managed.client.actor_cookie({"id": "bob"})},
+    )
+    assert response.json()["counts"] == {"active": 2, "revoked": 0, "expired": 1}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("memory_index", (False, True))
+async def test_slow_authentication_log_managed(db_path, memory_index):
+    from datasette_auth_tokens.metrics import get_metrics
+
+    plugin_config = {
+        "manage_tokens": True,
+        "slow_auth_ms": 0,
+        "slow_auth_log_size": 2,
+        "slow_auth_profile_rate": 1,
+    }
+    if memory_index:
+        plugin_config["memory_index"] = True
+    ds = Datasette(
+        [db_path],
+        plugin_config={"datasette-auth-tokens": plugin_config},
+        config={
+            "permissions": {
+                "auth-tokens-view-all": {"id": "admin"},
+                "auth-tokens-create": {"id": "*"},
+            }
+        },
+    )
+    await ds.invoke_startup()
+    token_id, token = await _create_token(ds, "alice")
+    for _ in range(3):
+        await ds.client.get(
+            "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+        )
+    admin = {"ds_actor": ds.client.actor_cookie({"id": "admin"})}
+    entries = (await ds.client.get("/-/api/tokens/slow", cookies=admin)).json()[
+        "entries"
+    ]
+    # The buffer only keeps the most recent calls
+    assert len(entries) == 2
+    assert get_metrics(ds)["slow_authentications"] == 3
+    for entry in entries:
+        assert entry["backend"] == "manage_tokens"
+        assert entry["token_id"] == token_id
+        assert "function calls" in entry["profile"]
+        assert "unsign" in entry["stages"]
+        if memory_index:
+            assert entry["cache"] == "hit"
+            assert "read" not in entry["stages"]
+        else:
+            assert entry["cache"] is None
+            assert {"expire", "read"} <= set(entry["stages"])
+            assert entry["database_ms"] >= entry["stages"]["read"]
+    alice = {"ds_actor": ds.client.actor_cookie({"id": "alice"})}
+    response = await ds.client.get("/-/api/tokens/slow", cookies=alice)
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("memory_index", (False, True))
+async def test_server_timing_header(db_path, memory_index):
+    plugin_config = {"manage_tokens": True, "server_timing": True}
+    if memory_index:
+        plugin_config["memory_index"] = True
+    ds = Datasette(
+        [db_path],
+        plugin_config={"datasette-auth-tokens": plugin_config},
+        config={"permissions": {"auth-tokens-create": {"id": "*"}}},
+    )
+    await ds.invoke_startup()
+    _, token = await _create_token(ds, "alice")
+    for _ in range(2):
+        # The second request finds the new token already in the memory index
+        response = await ds.client.get(
+            "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+        )
+    metrics = {
+        metric.split(";")[0]: metric.split(";")[1:]
+        for metric in response.headers["server-timing"].split(", ")
+    }
+    assert metrics["auth"][1] == 'desc="manage_tokens"'
+    assert "auth-unsign" in metrics
+    if memory_index:
+        assert metrics["auth-cache"] == ["desc=hit"]
+        assert "auth-read" not in metrics
+    else:
+        assert {"auth-expire", "auth-read", "auth-db"} <= set(metrics)
+        assert "auth-cache" not in metrics
+    total = float(metrics["auth"][0].split("=")[1])
+    assert total >= float(metrics["auth-unsign"][0].split("=")[1])
+    # Requests without a token are not timed
+    response = await ds.client.get("/-/actor.json")
+    assert "server-timing" not in response.headers
+
+
+def test_usage_sketches_accuracy():
+    from datasette_auth_tokens.usage import HyperLogLog, SpaceSaving
+
+    first, second = HyperLogLog(), HyperLogLog()
+    for i in range(20_000):
+        (first if i % 2 else second).add("10.0.{}.{}".format(i // 256, i % 256))
+    # Adding a value again changes nothing
+    first.add("10.0.0.1")
+    assert abs(first.count() - 10_000) < 1_000
+    first.merge(second.registers)
+    assert abs(first.count() - 20_000) < 2_000
+    small = HyperLogLog()
+    for ip in ("10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.1"):
+        small.add(ip)
+    assert small.count() == 3
+
+    top = SpaceSaving(k=3)
+    for i in range(1_000):
+        top.add("heavy" if i % 2 else "key-{}".format(i))
+    (key, count, error), *rest = top.top()
+    assert key == "heavy"
+    assert count - error <= 500 <= count
+    assert len(rest) == 2
+
+
+def test_usage_persist_reads_under_write_lock(tmp_path):
+    from datasette_auth_tokens.migrations import migration
+    from datasette_auth_tokens.usage import HyperLogLog, make_persist_function
+
+    db = sqlite_utils.Database(tmp_path / "tokens.db")
+    migration.apply(db)
+    sketch = HyperLogLog()
+    sketch.add("10.0.0.1")
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    make_persist_function({1: sketch}, [(1, 1, 0)])(db.conn)
+    db.conn.set_trace_callback(None)
+    # The registers are read inside the write transaction, not before it
+    assert statements[0].lower() == "begin immediate"
+    assert "select token_id, distinct_ips" in statements[1]
+    assert db.execute(
+        "select requests from _datasette_auth_tokens_usage where token_id = 1"
+    ).fetchone() == (1,)
+
+
+@pytest.mark.asyncio
+async def test_usage_sketches(db_path):
+    from datasette.utils.asgi import Request
+    from datasette_auth_tokens import actor_from_request
+    from datasette_auth_tokens.metrics import get_metrics
+    from datasette_auth_tokens.usage import get_usage_sketches
+
+    ds = Datasette(
+        [db_path],
+        plugin_config={
+            "datasette-auth-tokens": {
+                "manage_tokens": True,
+                "usage_sketches": True,
+                "usage_top_k": 3,
+                "usage_max_tokens": 2,
+            }
+        },
+        config={
+            "permissions": {
+                "auth-tokens-view-all": {"id": "admin"},
+                "auth-tokens-create": {"id": "*"},
+            }
+        },
+    )
+    await ds.invoke_startup()
+    tokens = [await _create_token(ds, actor_id) for actor_id in ("a", "b", "c")]
+
+    async def authenticate(token, ip):
+        request = Request(
+            {
+                "type": "http",
+                "method": "GET",
+                "path": "/",
+                "query_string": b"",
+                "client": (ip, 1234),
+                "headers": [(b"authorization", "Bearer {}".format(token).encode())],
+            },
+            None,
+        )
+        return await actor_from_request(ds, request)()
+
+    (a_id, a_token), (b_id, b_token), (c_id, c_token) = tokens
+    for i in range(30):
+        await authenticate(a_token, "10.0.0.{}".format(i % 5))
+    for i in range(10):
+        await authenticate(b_token, "10.0.1.1")
+    # The third token does not fit in the sketches until they are persisted
+    await authenticate(c_token, "10.0.2.1")
+    assert await authenticate("dsatok_bad", "10.0.3.1") is None
+    assert get_metrics(ds)["usage_tokens_dropped"] == 1
+    await get_usage_sketches(ds).persist()
+    for i in range(5):
+        await authenticate(c_token, "10.0.2.{}".format(i))
+    # Token pages only read what has been persisted, they never force it
+    sketches = get_usage_sketches(ds)
+    admin = {"ds_actor": ds.client.actor_cookie({"id": "admin"})}
+    details_path = "/-/api/tokens/{}.json".format(c_id)
+    response = await ds.client.get(details_path, cookies=admin)
+    assert c_id in sketches._distinct_ips
+    etag = response.headers["etag"]
+    await sketches.persist()
+    # Usage is not part of the ETag, so polling still gets a 304
+    response = await ds.client.get(
+        details_path, cookies=admin, headers={"if-none-match": etag}
+    )
+    assert response.status_code == 304
+
+    details = (
+        await ds.client.get("/-/api/tokens/{}.json".format(a_id), cookies=admin)
+    ).json()
+    assert details["usage"] == {"distinct_ips": 5, "requests": 30, "requests_error": 0}
+    response = await ds.client.get("/-/api/tokens/{}".format(c_id), cookies=admin)
+    assert "5 distinct IP address" in response.text
+
+    response = await ds.client.get("/-/api/tokens/top", cookies=admin)
+    top = response.json()["tokens"]
+    assert [(token["id"], token["actor_id"]) for token in top] == [
+        (a_id, "a"),
+        (b_id, "b"),
+        (c_id, "c"),
+    ]
+    assert top[1]["distinct_ips"] == 1
+    assert top[2]["requests"] == 6
+    for size in ("1", "0", "-1"):
+        response = await ds.client.get(
+            "/-/api/tokens/top?_size={}".format(size), cookies=admin
+        )
+        assert len(response.json()["tokens"]) == 1
+    alice = {"ds_actor": ds.client.actor_cookie({"id": "alice"})}
+    response = await ds.client.get("/-/api/tokens/top", cookies=alice)
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("storage", ("memory", "kv"))
+async def test_token_storage_backends(tmp_path, monkeypatch, storage):
+    from datasette_auth_tokens.storage import get_storage
+
+    plugin_config = {"manage_tokens": True, "storage": storage}
+    if storage == "kv":
+        plugin_config["storage_path"] = str(tmp_path / "tokens.kv")
+
+    def make_datasette():
+        return Datasette(
+            secret="storage-secret",
+            plugin_config={"datasette-auth-tokens": plugin_config},
+            config={
+                "permissions": {
+                    "auth-tokens-view-all": {"id": "admin"},
+                    "auth-tokens-create": {"id": "*"},
+                }
+            },
+        )
+
+    ds = make_datasette()
+    await ds.invoke_startup()
+    alice_id, alice_token = await _create_token(ds, "alice")
+    bob_id, bob_token = await _create_token(ds, "bob")
+    assert alice_id != bob_id
+
+    async def actor_for(token):
+        response = await ds.client.get(
+            "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+        )
+        return response.json()["actor"]
+
+    assert await actor_for(alice_token) == {
+        "id": "alice",
+        "token": "dsatok",
+        "token_id": alice_id,
+    }
+    admin = {"ds_actor": ds.client.actor_cookie({"id": "admin"})}
+    alice = {"ds_actor": ds.client.actor_cookie({"id": "alice"})}
+    details = (
+        await ds.client.get("/-/api/tokens/{}.json".format(alice_id), cookies=alice)
+    ).json()
+    assert details["last_used_timestamp"] is not None
+
+    listing = (await ds.client.get("/-/api/tokens.json", cookies=admin)).json()
+    assert [token["id"] for token in listing["tokens"]] == [bob_id, alice_id]
+    assert listing["counts"] == {"active": 2, "revoked": 0, "expired": 0}
+    searched = (await ds.client.get("/-/api/tokens.json?q=bob", cookies=admin)).json()
+    assert [token["id"] for token in searched["tokens"]] == [bob_id]
+    # Users only see their own tokens and their events
+    listing = (await ds.client.get("/-/api/tokens.json", cookies=alice)).json()
+    assert [token["id"] for token in listing["tokens"]] == [alice_id]
+    events = (await ds.client.get("/-/api/tokens/events", cookies=alice)).json()
+    assert {event["token_id"] for event in events["events"]} == {alice_id}
+
+    response = await ds.client.post(
+        "/-/api/tokens/{}.json".format(alice_id),
+        cookies=alice,
+        content='{"revoke": true}',
+        headers={"content-type": "application/json"},
+    )
+    assert response.json()["status"] == "Revoked"
+    assert await actor_for(alice_token) is None
+
+    expiring = await get_storage(ds).create("carol", expires_after_seconds=60)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 120)
+    listing = (await ds.client.get("/-/api/tokens.json", cookies=admin)).json()
+    assert {token["id"]: token["status"] for token in listing["tokens"]} == {
+        expiring["id"]: "Expired",
+        bob_id: "Active",
+        alice_id: "Revoked",
+    }
+
+    if storage == "kv":
+        # Tokens outlive the process
+        ds = make_datasette()
+        await ds.invoke_startup()
+        assert (await actor_for(bob_token))["token_id"] == bob_id
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "plugin_config,error",
+    (
+        ({"storage": "nope"}, "Unknown token storage: nope"),
+        (
+            {"storage": "memory", "memory_index": True},
+            "memory_index can only be used with sqlite token storage",
+        ),
+        ({"storage": "kv"}, "kv token storage needs storage_path"),
+    ),
+)
+async def test_token_storage_errors(plugin_config, error):
+    from datasette.utils import StartupError
+
+    ds = Datasette(
+        plugin_config={"datasette-auth-tokens": dict(plugin_config, manage_tokens=True)}
+    )
+    with pytest.raises(StartupError) as ex:
+        await ds.invoke_startup()
+    assert str(ex.value) == error
@@ -57,4 +57,61 @@ def test_migrate_from_original():
         "expires_after_seconds",
         "ended_timestamp",
         "secret_version",
+        "changed_at",
+        "rate_limit_per_minute",
     ]
+
+
+def test_schema_lists_every_migration():
+    from datasette_auth_tokens.schema import MIGRATIONS, pending_migrations
+
+    assert MIGRATIONS == tuple(m.name for m in migration._migrations)
+    db = sqlite_utils.Database(memory=True)
+    assert pending_migrations(db.conn) == list(MIGRATIONS)
+    migration.apply(db)
+    assert pending_migrations(db.conn) == []
+
+
+def test_existing_tokens_counted_by_backfill():
+    from datasette_auth_tokens.backfill import backfills, make_backfill_step_function
+
+    db = sqlite_utils.Database(memory=True)
+    migration.apply(db, stop_before="m011_create_counts_table")
+    db["_datasette_auth_tokens"].insert_all(
+        [
+            {"actor_id": "alice", "token_status": "A", "permissions": "null"},
+            {"actor_id": "alice", "token_status": "A", "permissions": "null"},
+            {"actor_id": "bob", "token_status": "A", "permissions": "null"},
+        ]
+    )
+    migration.apply(db)
+
+    def counts():
+        return sorted(
+            tuple(row)
+            for row in db.execute("select * from _datasette_auth_tokens_counts")
+        )
+
+    # The migration itself does not count the existing tokens
+    assert counts() == []
+    # Changes before the backfill reaches a row are left to the backfill
+    with db.conn:
+        db.execute("update _datasette_auth_tokens set token_status = 'R' where id = 2")
+        db.execute("delete from _datasette_auth_tokens where id = 1")
+        db.execute(
+            "insert into _datasette_auth_tokens (actor_id, permissions) "
+            "values ('carol', 'null')"
+        )
+    assert counts() == [("carol", "A", 1)]
+
+    (backfill,) = [b for b in backfills if b.name == "b002_count_tokens"]
+    step = make_backfill_step_function(backfill, batch_size=1)
+    while True:
+        with db.conn:
+            if step(db.conn):
+                break
+    assert counts() == [("alice", "R", 1), ("bob", "A", 1), ("carol", "A", 1)]
+    # Once counted, the triggers take over
+    with db.conn:
+        db.execute("update _datasette_auth_tokens set token_status = 'R' where id = 3")
+    assert counts() == [("alice", "R", 1), ("bob", "R", 1), ("carol", "A", 1)]
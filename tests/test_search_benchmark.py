@@ -0,0 +1,72 @@
+"""
+Compares the token search index with a LIKE scan over the tokens table.
+
+Skipped unless SEARCH_BENCHMARK_ROWS is set, as building the table is slow:
+
+    SEARCH_BENCHMARK_ROWS=1000000 pytest -s tests/test_search_benchmark.py
+"""
+
+from datasette_auth_tokens.migrations import migration
+import os
+import pytest
+import sqlite3
+import sqlite_utils
+import statistics
+import time
+
+ROWS = int(os.environ.get("SEARCH_BENCHMARK_ROWS") or 0)
+REPEATS = 5
+
+FTS_SQL = """
+select t.*, fts.rank as search_rank
+from _datasette_auth_tokens_fts fts
+join _datasette_auth_tokens t on t.id = fts.rowid
+where _datasette_auth_tokens_fts match :q
+order by fts.rank, t.id limit 31
+"""
+LIKE_SQL = """
+select * from _datasette_auth_tokens
+where description like :like or actor_id like :like
+order by id desc limit 31
+"""
+
+
+def _median_ms(conn, sql, params):
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        rows = conn.execute(sql, params).fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), rows
+
+
+@pytest.mark.skipif(not ROWS, reason="SEARCH_BENCHMARK_ROWS is not set")
+def test_search_index_beats_like_scan(tmp_path):
+    db = sqlite_utils.Database(tmp_path / "tokens.db")
+    migration.apply(db)
+    start = time.perf_counter()
+    with db.conn:
+        db.conn.executemany(
+            """
+            insert into _datasette_auth_tokens
+            (description, actor_id, permissions, created_timestamp)
+            values (?, ?, 'null', 1700000000)
+            """,
+            (
+                ("job {} export for team {}".format(i, i % 500), "user-{}".format(i))
+                for i in range(ROWS)
+            ),
+        )
+    db.conn.row_factory = sqlite3.Row
+    print("\nInserted {:,} rows in {:.1f}s".format(ROWS, time.perf_counter() - start))
+
+    # A single rare term is the worst case for LIKE, which has to scan
+    # every row to find it
+    needle = "user-{}".format(ROWS // 2)
+    fts_ms, fts_rows = _median_ms(db.conn, FTS_SQL, {"q": '"{}"'.format(needle)})
+    like_ms, like_rows = _median_ms(db.conn, LIKE_SQL, {"like": "%{}%".format(needle)})
+    print("FTS5 search: {:.2f}ms".format(fts_ms))
+    print("LIKE scan:   {:.2f}ms".format(like_ms))
+    assert needle in [row["actor_id"] for row in fts_rows]
+    assert needle in [row["actor_id"] for row in like_rows]
+    assert fts_ms < like_ms
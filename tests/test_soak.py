@@ -0,0 +1,260 @@
+"""
+Soak test for the authentication path: drives a long run of valid, expired,
+revoked and garbage tokens through an in-process Datasette and checks, using
+tracemalloc, that memory stops growing once the bounded caches are full.
+
+Skipped unless SOAK_REQUESTS is set, as it takes a while - the database
+mode manages a few hundred requests a second with tracemalloc running:
+
+    SOAK_REQUESTS=2000000 pytest -s tests/test_soak.py -k memory_index
+
+It also prints the memory allocated by a single authentication for each
+kind of token, to catch changes that make the hot path allocate more.
+"""
+
+from datasette.utils.asgi import Request
+from datasette_auth_tokens import actor_from_request
+from datasette_auth_tokens.children import sign_child_token
+from datasette_auth_tokens.ratelimit import TokenRateLimited
+from datasette_test import Datasette
+import gc
+import os
+import pytest
+import random
+import time
+import tracemalloc
+
+REQUESTS = int(os.environ.get("SOAK_REQUESTS") or 0)
+# Tokens of each kind in the database
+TOKENS_PER_KIND = 2_000
+# Smaller than the number of tokens in use, so the caches reach their limits
+CACHE_SIZE = 1_000
+# Mixed traffic after every token has been seen once, before memory is
+# measured - bounded caches take a while to settle
+WARM_UP_REQUESTS = 50_000
+# One request in this many goes through the full ASGI stack
+HTTP_EVERY = 100
+# Memory is measured after each of these slices of the run
+WINDOWS = 10
+# Allowed growth across the second half of the run, after warming up
+MAX_GROWTH_BYTES = 256 * 1024
+# Requests per kind of token when measuring allocations per request
+ALLOCATION_SAMPLES = 500
+# Relative weights of each kind of token in the traffic
+MIX = {
+    "valid": 50,
+    "child": 10,
+    "expiring": 5,
+    "expired": 5,
+    "revoked": 5,
+    "unknown": 5,
+    "forged": 10,
+    "garbage": 10,
+}
+
+
+async def _soak_datasette(tmp_path, mode):
+    plugin_config = {
+        "manage_tokens": True,
+        "lookup_timeout_ms": 1_000,
+        "stale_cache_size": CACHE_SIZE,
+        "rate_limit_max_tokens": CACHE_SIZE,
+    }
+    if mode == "memory_index":
+        plugin_config["memory_index"] = True
+    elif mode == "snapshot":
+        plugin_config["snapshot_path"] = str(tmp_path / "tokens.snapshot")
+    ds = Datasette(
+        internal=str(tmp_path / "internal.db"),
+        plugin_config={"datasette-auth-tokens": plugin_config},
+    )
+    await ds.invoke_startup()
+    now = int(time.time())
+    rows = []
+    statuses = {
+        "valid": ("A", None),
+        "expiring": ("A", 5),
+        "expired": ("E", 1),
+        "revoked": ("R", None),
+    }
+    for kind, (status, expires_after) in statuses.items():
+        for i in range(TOKENS_PER_KIND):
+            rows.append(
+                {
+                    "actor_id": "{}-{}".format(kind, i % 100),
+                    "token_status": status,
+                    "expires_after_seconds": expires_after,
+                    # A generous limit, so the rate limiter is exercised
+                    # without rejecting anything
+                    "rate_limit_per_minute": 1_000_000 if i % 2 else None,
+                }
+            )
+
+    def insert(conn):
+        conn.executemany(
+            """
+            insert into _datasette_auth_tokens
+            (token_status, permissions, actor_id, created_timestamp,
+            expires_after_seconds, rate_limit_per_minute)
+            values (:token_status, 'null', :actor_id, {},
+            :expires_after_seconds, :rate_limit_per_minute)
+            """.format(now),
+            rows,
+        )
+        return conn.execute(
+            "select id, actor_id from _datasette_auth_tokens order by id"
+        ).fetchall()
+
+    inserted = await ds.get_internal_database().execute_write_fn(insert)
+    if mode == "memory_index":
+        from datasette_auth_tokens.index import get_token_index
+
+        await get_token_index(ds).refresh()
+    elif mode == "snapshot":
+        from datasette_auth_tokens.snapshot import get_snapshot_writer
+
+        await get_snapshot_writer(ds).export()
+
+    tokens = {kind: [] for kind in MIX}
+    for (token_id, actor_id), row in zip(inserted, rows):
+        kind = actor_id.split("-")[0]
+        tokens[kind].append("dsatok_{}".format(ds.sign(token_id, "dsatok")))
+        if kind == "valid" and len(tokens["child"]) < TOKENS_PER_KIND:
+            tokens["child"].append(sign_child_token(ds, token_id, now + 24 * 60 * 60))
+    return ds, tokens
+
+
+class Traffic:
+    "Endless mix of tokens, weighted by MIX"
+
+    def __init__(self, ds, tokens, seed=0):
+        self._ds = ds
+        self._tokens = tokens
+        self._random = random.Random(seed)
+        self._kinds = list(MIX)
+        self._weights = [MIX[kind] for kind in self._kinds]
+        # Validly signed IDs that were never issued, a new one every time
+        self._next_unknown = 10_000_000
+
+    def token(self, kind=None):
+        if kind is None:
+            kind = self._random.choices(self._kinds, self._weights)[0]
+        if kind == "unknown":
+            self._next_unknown += 1
+            return "dsatok_{}".format(self._ds.sign(self._next_unknown, "dsatok"))
+        if kind == "forged":
+            valid = self._random.choice(self._tokens["valid"])
+            return valid[:-4] + "AAAA"
+        if kind == "garbage":
+            return "".join(
+                self._random.choices(
+                    "abcdefghijklmnopqrstuvwxyz0123456789_-.",
+                    k=self._random.randint(1, 80),
+                )
+            )
+        return self._random.choice(self._tokens[kind])
+
+
+async def _authenticate(ds, token):
+    request = Request(
+        {
+            "type": "http",
+            "method": "GET",
+            "path": "/",
+            "query_string": b"",
+            "headers": [(b"authorization", "Bearer {}".format(token).encode())],
+        },
+        None,
+    )
+    try:
+        return await actor_from_request(ds, request)()
+    except TokenRateLimited:
+        return None
+
+
+async def _warm_up(ds, tokens, traffic):
+    # Every issued token once, then a run of the usual mix
+    for kind_tokens in tokens.values():
+        for token in kind_tokens:
+            await _authenticate(ds, token)
+    await _drive(ds, traffic, WARM_UP_REQUESTS)
+
+
+async def _drive(ds, traffic, count, start=0):
+    for i in range(start, start + count):
+        token = traffic.token()
+        if i % HTTP_EVERY == 0:
+            response = await ds.client.get(
+                "/-/actor.json", headers={"Authorization": "Bearer {}".format(token)}
+            )
+            assert response.status_code == 200
+        else:
+            await _authenticate(ds, token)
+
+
+def _current_memory():
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+@pytest.mark.skipif(not REQUESTS, reason="SOAK_REQUESTS is not set")
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ("database", "memory_index", "snapshot"))
+async def test_authentication_memory_is_flat(tmp_path, mode):
+    ds, tokens = await _soak_datasette(tmp_path, mode)
+    traffic = Traffic(ds, tokens)
+    # Traced from the start, so entries replaced in the caches later on do
+    # not look like new memory
+    tracemalloc.start()
+    try:
+        await _warm_up(ds, tokens, traffic)
+        window = REQUESTS // WINDOWS
+        start = time.perf_counter()
+        samples = []
+        first_half_snapshot = None
+        for i in range(WINDOWS):
+            await _drive(ds, traffic, window, start=i * window)
+            samples.append(_current_memory())
+            if i == WINDOWS // 2 - 1:
+                first_half_snapshot = tracemalloc.take_snapshot()
+        elapsed = time.perf_counter() - start
+        growth = samples[-1] - samples[WINDOWS // 2 - 1]
+        print(
+            "\n{}: {:,} requests in {:.1f}s ({:,.0f}/s)".format(
+                mode, window * WINDOWS, elapsed, window * WINDOWS / elapsed
+            )
+        )
+        print(
+            "Traced memory after each {:,} requests (KB): {}".format(
+                window, " ".join("{:,.0f}".format(s / 1024) for s in samples)
+            )
+        )
+        print(
+            "Second half growth: {:,} bytes ({:.3f} bytes/request)".format(
+                growth, growth / (window * (WINDOWS - WINDOWS // 2))
+            )
+        )
+        if growth > MAX_GROWTH_BYTES:
+            diff = tracemalloc.take_snapshot().compare_to(first_half_snapshot, "lineno")
+            for stat in diff[:10]:
+                print(stat)
+        assert growth <= MAX_GROWTH_BYTES
+
+        print("Allocated per authentication (bytes):")
+        for kind in MIX:
+            peaks = []
+            for _ in range(ALLOCATION_SAMPLES):
+                token = traffic.token(kind)
+                gc.collect()
+                before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                await _authenticate(ds, token)
+                peaks.append(tracemalloc.get_traced_memory()[1] - before)
+            peaks.sort()
+            print(
+                "  {:<10} median {:>8,}  p99 {:>8,}".format(
+                    kind, peaks[len(peaks) // 2], peaks[int(len(peaks) * 0.99)]
+                )
+            )
+    finally:
+        tracemalloc.stop()
@@ -0,0 +1,149 @@
+"""
+Compare token authentication against the internal database and a dedicated
+token store.
+
+The same set of tokens is loaded into Datasette's internal database and into
+a file configured with manage_tokens_path. Concurrent authentications then run
+against each while a background task keeps Datasette's internal database busy
+with writes, as its catalog and other plugins do. The test reports throughput
+and latency percentiles for both, and fails if the dedicated store is slower.
+
+Skipped unless TOKEN_STORE_BENCHMARK_SECONDS is set:
+
+    TOKEN_STORE_BENCHMARK_SECONDS=10 pytest -s tests/test_token_store_benchmark.py
+"""
+
+from datasette_auth_tokens.cli import import_tokens, open_token_database
+import asyncio
+import os
+import pytest
+import random
+import time
+
+SECONDS = float(os.environ.get("TOKEN_STORE_BENCHMARK_SECONDS") or 0)
+CONCURRENCY = int(os.environ.get("TOKEN_STORE_BENCHMARK_CONCURRENCY") or 16)
+SECRET = "benchmark-secret"
+TOKENS = 10_000
+
+
+def _load_tokens(path):
+    conn = open_token_database(path)
+    token_ids = [
+        token_id
+        for batch in import_tokens(
+            [conn],
+            ({"actor_id": "user-{}".format(i % 100)} for i in range(TOKENS)),
+        )
+        for token_id in batch
+    ]
+    conn.close()
+    return token_ids
+
+
+async def _run(tmp_path, storage):
+    from datasette.utils.asgi import Request
+    from datasette_auth_tokens import actor_from_request
+    from datasette_test import Datasette
+
+    internal_path = str(tmp_path / "internal.db")
+    plugin_config = {"manage_tokens": True}
+    if storage == "internal":
+        token_ids = _load_tokens(internal_path)
+    else:
+        plugin_config["manage_tokens_path"] = str(tmp_path / "tokens.db")
+        token_ids = _load_tokens(plugin_config["manage_tokens_path"])
+    ds = Datasette(
+        [],
+        secret=SECRET,
+        internal=internal_path,
+        plugin_config={"datasette-auth-tokens": plugin_config},
+    )
+    await ds.invoke_startup()
+    tokens = ["dsatok_{}".format(ds.sign(token_id, "dsatok")) for token_id in token_ids]
+    internal_db = ds.get_internal_database()
+    await internal_db.execute_write(
+        "create table if not exists benchmark_writes (id integer primary key, value text)"
+    )
+
+    latencies = []
+    writes = 0
+    done = asyncio.Event()
+
+    async def write_internal():
+        nonlocal writes
+        while not done.is_set():
+            await internal_db.execute_write(
+                "insert into benchmark_writes (value) values (?)", ["x" * 200]
+            )
+            writes += 1
+
+    async def authenticate(seed):
+        rng = random.Random(seed)
+        while not done.is_set():
+            request = Request(
+                {
+                    "type": "http",
+                    "method": "GET",
+                    "path": "/",
+                    "query_string": b"",
+                    "headers": [
+                        (
+                            b"authorization",
+                            "Bearer {}".format(rng.choice(tokens)).encode(),
+                        )
+                    ],
+                },
+                None,
+            )
+            started = time.perf_counter()
+            actor = await actor_from_request(ds, request)()
+            latencies.append(time.perf_counter() - started)
+            assert actor is not None
+
+    async def stop():
+        await asyncio.sleep(SECONDS)
+        done.set()
+
+    await asyncio.gather(
+        stop(),
+        write_internal(),
+        *(authenticate(seed) for seed in range(CONCURRENCY)),
+    )
+    return sorted(latencies), writes
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+
+
+@pytest.mark.skipif(not SECONDS, reason="TOKEN_STORE_BENCHMARK_SECONDS is not set")
+def test_token_store_benchmark(tmp_path):
+    results = {}
+    for storage in ("internal", "store"):
+        path = tmp_path / storage
+        path.mkdir()
+        results[storage] = asyncio.run(_run(path, storage))
+
+    print(
+        "\n{} tokens, {} concurrent requests, {:.0f}s".format(
+            TOKENS, CONCURRENCY, SECONDS
+        )
+    )
+    print(
+        "{:<9} {:>8} {:>8} {:>9} {:>9} {:>9} {:>10}".format(
+            "storage", "auths", "auths/s", "p50 ms", "p99 ms", "max ms", "writes/s"
+        )
+    )
+    for storage, (latencies, writes) in results.items():
+        print(
+            "{:<9} {:>8,} {:>8,.0f} {:>9.2f} {:>9.2f} {:>9.2f} {:>10,.0f}".format(
+                storage,
+                len(latencies),
+                len(latencies) / SECONDS,
+                _percentile(latencies, 0.5),
+                _percentile(latencies, 0.99),
+                latencies[-1] * 1000,
+                writes / SECONDS,
+            )
+        )
+    assert len(results["store"][0]) >= len(results["internal"][0])
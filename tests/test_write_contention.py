@@ -0,0 +1,219 @@
+"""
+Write contention between several Datasette processes sharing one token file.
+
+Each worker process runs its own Datasette against the same SQLite file and
+replays a mix of authentications - which expire and touch tokens - token
+creation through the web interface and revocation. The test reports
+throughput, SQLITE_BUSY errors and latency percentiles for each kind of
+operation, and fails if any operation hit SQLITE_BUSY.
+
+Skipped unless STRESS_SECONDS is set:
+
+    STRESS_SECONDS=30 STRESS_WORKERS=8 pytest -s tests/test_write_contention.py
+
+Use this as the acceptance test for changes to the plugin's write patterns.
+"""
+
+from datasette_auth_tokens.cli import import_tokens, open_token_database
+import asyncio
+import multiprocessing
+import os
+import pytest
+import queue
+import random
+import sqlite3
+import time
+
+SECONDS = float(os.environ.get("STRESS_SECONDS") or 0)
+WORKERS = int(os.environ.get("STRESS_WORKERS") or 4)
+SECRET = "stress-test-secret"
+# Tokens created before the workers start, shared between them
+TOKENS = 2_000
+# Relative weights of each operation
+MIX = {"auth": 90, "create": 5, "revoke": 5}
+BUSY_MESSAGES = ("database is locked", "database table is locked", "busy")
+
+
+def _is_busy(ex):
+    return isinstance(ex, sqlite3.OperationalError) and any(
+        message in str(ex) for message in BUSY_MESSAGES
+    )
+
+
+def _plugin_config(storage, path):
+    if storage == "database":
+        # A database attached to Datasette, as with manage_tokens_database
+        return {"manage_tokens": True, "manage_tokens_database": "tokens"}
+    return {"manage_tokens": True, "manage_tokens_path": path}
+
+
+def _worker(storage, path, tokens, seconds, seed, start_event, results):
+    results.put(
+        asyncio.run(_run_worker(storage, path, tokens, seconds, seed, start_event))
+    )
+
+
+async def _run_worker(storage, path, tokens, seconds, seed, start_event):
+    from datasette.utils.asgi import Request
+    from datasette_auth_tokens import actor_from_request, revoke_tokens
+    from datasette_test import Datasette
+
+    ds = Datasette(
+        [path] if storage == "database" else [],
+        secret=SECRET,
+        plugin_config={"datasette-auth-tokens": _plugin_config(storage, path)},
+        config={"permissions": {"auth-tokens-create": {"id": "*"}}},
+    )
+    await ds.invoke_startup()
+    loop = asyncio.get_running_loop()
+    stats = {operation: {"latencies": [], "busy": 0, "errors": 0} for operation in MIX}
+    stats["background"] = {"latencies": [], "busy": 0, "errors": 0}
+
+    def exception_handler(loop, context):
+        # Writes the plugin runs in the background, like the audit log flush
+        ex = context.get("exception")
+        stats["background"]["busy" if _is_busy(ex) else "errors"] += 1
+
+    loop.set_exception_handler(exception_handler)
+    rng = random.Random(seed)
+    operations = list(MIX)
+    weights = [MIX[operation] for operation in operations]
+    cookies = {"ds_actor": ds.client.actor_cookie({"id": "worker-{}".format(seed)})}
+    created = []
+
+    async def auth():
+        request = Request(
+            {
+                "type": "http",
+                "method": "GET",
+                "path": "/",
+                "query_string": b"",
+                "headers": [
+                    (b"authorization", "Bearer {}".format(rng.choice(tokens)).encode())
+                ],
+            },
+            None,
+        )
+        await actor_from_request(ds, request)()
+
+    async def create():
+        page = await ds.client.get("/-/api/tokens/create", cookies=cookies)
+        csrftoken = page.cookies["ds_csrftoken"]
+        response = await ds.client.post(
+            "/-/api/tokens/create",
+            data={"csrftoken": csrftoken},
+            cookies=dict(cookies, ds_csrftoken=csrftoken),
+        )
+        if response.status_code != 200:
+            raise Exception("Create failed: {}".format(response.status_code))
+        token = response.text.split('value="dsatok_')[1].split('"')[0]
+        created.append(ds.unsign(token, "dsatok"))
+
+    async def revoke():
+        if created:
+            await revoke_tokens(ds, token_ids=[created.pop()], revoked_by="stress")
+
+    run = {"auth": auth, "create": create, "revoke": revoke}
+    start_event.wait()
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        operation = rng.choices(operations, weights)[0]
+        operation_started = time.perf_counter()
+        try:
+            await run[operation]()
+        except Exception as ex:
+            stats[operation]["busy" if _is_busy(ex) else "errors"] += 1
+        else:
+            stats[operation]["latencies"].append(
+                time.perf_counter() - operation_started
+            )
+    # Let queued background writes finish so their errors are counted
+    await asyncio.sleep(0.5)
+    return stats
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+
+
+@pytest.mark.skipif(not SECONDS, reason="STRESS_SECONDS is not set")
+@pytest.mark.parametrize("storage", ("database", "store"))
+def test_write_contention(tmp_path, storage):
+    path = str(tmp_path / "tokens.db")
+    conn = open_token_database(path)
+    token_ids = [
+        token_id
+        for batch in import_tokens(
+            [conn],
+            ({"actor_id": "user-{}".format(i % 100)} for i in range(TOKENS)),
+        )
+        for token_id in batch
+    ]
+    conn.close()
+    from itsdangerous import URLSafeSerializer
+
+    serializer = URLSafeSerializer(SECRET, "dsatok")
+    tokens = ["dsatok_{}".format(serializer.dumps(token_id)) for token_id in token_ids]
+
+    context = multiprocessing.get_context("spawn")
+    start_event = context.Event()
+    results = context.Queue()
+    processes = [
+        context.Process(
+            target=_worker,
+            args=(storage, path, tokens, SECONDS, seed, start_event, results),
+        )
+        for seed in range(WORKERS)
+    ]
+    for process in processes:
+        process.start()
+    # Give every worker time to start Datasette before the clock starts
+    time.sleep(3)
+    start_event.set()
+    try:
+        worker_stats = [results.get(timeout=SECONDS + 60) for _ in processes]
+    except queue.Empty:
+        pytest.fail(
+            "Workers failed, exit codes: {}".format(
+                [process.exitcode for process in processes]
+            )
+        )
+    finally:
+        for process in processes:
+            process.join(timeout=10)
+
+    print("\n{} storage, {} workers, {:.0f}s".format(storage, WORKERS, SECONDS))
+    print(
+        "{:<11} {:>8} {:>8} {:>6} {:>6} {:>9} {:>9} {:>9}".format(
+            "operation", "ok", "ops/s", "busy", "errors", "p50 ms", "p99 ms", "max ms"
+        )
+    )
+    total_busy = 0
+    for operation in (*MIX, "background"):
+        latencies = sorted(
+            latency
+            for stats in worker_stats
+            for latency in stats[operation]["latencies"]
+        )
+        busy = sum(stats[operation]["busy"] for stats in worker_stats)
+        errors = sum(stats[operation]["errors"] for stats in worker_stats)
+        total_busy += busy
+        if latencies:
+            timings = "{:>9.2f} {:>9.2f} {:>9.2f}".format(
+                _percentile(latencies, 0.5),
+                _percentile(latencies, 0.99),
+                latencies[-1] * 1000,
+            )
+        else:
+            timings = ""
+        print(
+            "{:<11} {:>8,} {:>8,.0f} {:>6,} {:>6,} {}".format(
+                operation,
+                len(latencies),
+                len(latencies) / SECONDS,
+                busy,
+                errors,
+                timings,
+            )
+        )
+    assert total_busy == 0